@@ -1,19 +1,56 @@
 import requests
 import json
 import os
+import random
 import time
 import subprocess
 import logging
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-# Logging setup: log ทุกอย่างลง agent.log
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s %(levelname)s %(message)s',
-    handlers=[
-        logging.FileHandler("agent.log", encoding="utf-8"),
-        logging.StreamHandler(sys.stdout)
-    ]
+from agent_update import AgentUpdater, recover_update
+
+# self-update ที่ค้างครึ่งทาง (ไฟดับกลางการสลับไฟล์ / เวอร์ชันใหม่ start ไม่ผ่านหลายรอบ) คืนไฟล์ชุดเดิม
+# ก่อน import โมดูลอื่น แล้วรันตัวเองใหม่ด้วยโค้ดชุดเดิม
+if recover_update(os.path.dirname(os.path.abspath(__file__))):
+    subprocess.Popen([sys.executable] + sys.argv, cwd=os.getcwd())
+    os._exit(0)
+
+from agent_client import AgentClient, AdaptivePollInterval, PushStreamError
+from agent_outbox import Outbox, OutboxFlusher, STATUS_RUNNING
+from agent_commands import CommandRegistry, CommandExecutor, EXCLUSIVE, BACKGROUND
+from agent_gateway import Gateway
+from agent_download import ContentCache, DownloadError, file_sha256
+from agent_pipeline import StartupPipeline
+from agent_logging import setup_logging
+from agent_telemetry import TelemetrySampler
+from agent_metrics import MetricsRegistry, start_metrics_server
+from agent_exec import run_script
+from agent_collect import build_archive, upload_archive
+from agent_diagnose import diagnose, MAX_DURATION as DIAGNOSE_MAX_DURATION
+from agent_schedule import Scheduler, STATUS_SCHEDULED
+
+AGENT_START = time.monotonic()
+CONFIG_PATH = os.path.join(os.path.dirname(__file__), 'agent_config.json')
+
+def _read_log_settings():
+    # ตั้ง logging ก่อนโหลด config จริง (ensure_agent_config ต้องมี log แล้ว) เลยอ่านไฟล์ตรงๆ
+    try:
+        with open(CONFIG_PATH, 'r') as f:
+            return json.load(f).get('logging') or {}
+    except Exception:
+        return {}
+
+# Logging setup: log ทุกอย่างลง agent.log ผ่าน queue (thread แยกเขียนไฟล์/หมุนไฟล์/บีบอัด)
+_log_settings = _read_log_settings()
+LOG_LISTENER = setup_logging(
+    "agent.log",
+    stream=sys.stdout,
+    json_format=_log_settings.get('format') == 'json',
+    max_bytes=_log_settings.get('max_bytes', 10 * 1024 * 1024),
+    backup_count=_log_settings.get('backup_count', 10),
+    rotate_seconds=_log_settings.get('rotate_seconds', 24 * 3600),
 )
 # redirect print, error ไป log
 class LoggerWriter:
@@ -28,8 +65,10 @@ class LoggerWriter:
 sys.stdout = LoggerWriter(logging.info)
 sys.stderr = LoggerWriter(logging.error)
 
-CONFIG_PATH = os.path.join(os.path.dirname(__file__), 'agent_config.json')
+import glob
 import platform
+import re
+import shutil
 
 def ensure_agent_config():
     import shutil
@@ -62,10 +101,7 @@ def ensure_agent_config():
     api_url = config.get('api_url') or 'http://127.0.0.1:8000'  # fallback ถ้าไม่ได้ตั้ง
     machine_name = platform.node()
     print(f"[setup] Registering agent... set_id={set_id}, machine_name={machine_name}")
-    resp = requests.post(f'{api_url}/machine/register', json={
-        'set_id': set_id,
-        'machine_name': machine_name
-    })
+    resp = AgentClient(api_url).register(set_id, machine_name)
     if resp.status_code != 200:
         raise Exception(f'Register agent failed: {resp.text}')
     data = resp.json()
@@ -79,48 +115,240 @@ def ensure_agent_config():
     return config
 
 
+_config_lock = threading.Lock()
+
+def save_agent_config():
+    # เขียนไฟล์ใหม่แล้วค่อย replace กันไฟล์พังถ้าเครื่องดับกลางทาง
+    with _config_lock:
+        tmp_path = CONFIG_PATH + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(config, f, indent=2)
+        os.replace(tmp_path, CONFIG_PATH)
+
+
+_config_started = time.monotonic()
 config = ensure_agent_config()
+CONFIG_LOAD_SECONDS = time.monotonic() - _config_started
 API_URL = config['api_url']
 MACHINE_NAME = config['machine_name']
 AGENT_API_KEY = config['agent_api_key']
 MACHINE_ID = None
+AGENT_VERSION = config.get('agent_version', 'dev')
+# poll แบบปรับตัว: ถี่หลังมีคำสั่ง ยืดออกเมื่อว่าง ("poll": {"interval": 10, "min_interval": 2, "max_interval": 30})
+POLL_CONFIG = config.get('poll') or {}
+POLL_INTERVAL = POLL_CONFIG.get('interval', 10)
+POLL_SCHEDULE = AdaptivePollInterval(base=POLL_INTERVAL,
+                                     min_interval=POLL_CONFIG.get('min_interval', 2),
+                                     max_interval=POLL_CONFIG.get('max_interval', 30),
+                                     growth=POLL_CONFIG.get('idle_growth', 1.5),
+                                     active_period=POLL_CONFIG.get('active_period', 30))
+# push mode (SSE) ต้องเปิดใน agent_config.json: "push_enabled": true
+PUSH_ENABLED = bool(config.get('push_enabled', False))
+PUSH_RETRY_INTERVAL = config.get('push_retry_interval', 60)
+PUSH_READ_TIMEOUT = 90  # server ต้องส่ง heartbeat ถี่กว่านี้
+# สุ่มหน่วงตอนเริ่ม กันทั้งสาขายิง server พร้อมกันหลังไฟดับ
+STARTUP_JITTER = config.get('startup_jitter', 5)
+HTTP_STATS_LOG_INTERVAL = 600
+HTTP_TIMEOUT = (config.get('connect_timeout', 5), config.get('read_timeout', 15))
+# gzip body ของ request ตั้งแต่ 1 KB ขึ้นไป เปิดเฉพาะเมื่อ server ถอด Content-Encoding ได้ ("gzip_requests": true)
+HTTP_GZIP_MIN_SIZE = 1024 if config.get('gzip_requests') else None
+# telemetry สุขภาพเครื่อง แนบไปกับ poll ("telemetry": {"enabled": true, "interval": 30})
+TELEMETRY_CONFIG = config.get('telemetry') or {}
+TELEMETRY = None
+if TELEMETRY_CONFIG.get('enabled', True):
+    TELEMETRY = TelemetrySampler(interval=TELEMETRY_CONFIG.get('interval', 30),
+                                 thresholds=TELEMETRY_CONFIG.get('thresholds'))
+# push mode ไม่มี poll ให้แนบ: ถ้ามีค่าเปลี่ยนและเงียบนานเกินนี้ จะ poll สำรองหนึ่งครั้ง
+TELEMETRY_MAX_SILENCE = TELEMETRY_CONFIG.get('max_silence', 300)
+LAST_TELEMETRY_SENT = 0
+# metrics ของ agent เอง อ่านได้ที่ http://127.0.0.1:9108/metrics ("metrics": {"enabled": true, "port": 9108})
+METRICS_CONFIG = config.get('metrics') or {}
+METRICS = MetricsRegistry()
+POLL_SECONDS = METRICS.histogram('agent_poll_duration_seconds', 'Pending-command poll latency', ['outcome'])
+COMMANDS_RECEIVED = METRICS.counter('agent_commands_received_total', 'Commands received from server', ['command'])
+COMMAND_SECONDS = METRICS.histogram('agent_command_duration_seconds', 'Command handler run time', ['command', 'status'])
+RESULTS_QUEUED = METRICS.counter('agent_results_queued_total', 'Command results written to the outbox', ['status'])
+RESULTS_SENT = METRICS.counter('agent_results_sent_total', 'Command results accepted by server')
+RESULTS_REJECTED = METRICS.counter('agent_results_rejected_total', 'Command results rejected by server (dead letter)')
+RESULT_BATCH_SECONDS = METRICS.histogram('agent_result_batch_duration_seconds', 'Result batch upload latency', ['outcome'])
+REPORT_REMOTE_SECONDS = METRICS.histogram('agent_report_remote_duration_seconds', 'report_remote latency', ['outcome'])
+ANYDESK_STEP_SECONDS = METRICS.histogram('agent_anydesk_step_duration_seconds', 'AnyDesk install/ID step run time',
+                                         ['step', 'outcome'])
+METRICS.gauge('agent_uptime_seconds', 'Seconds since agent start', func=lambda: round(time.monotonic() - AGENT_START, 3))
+
+# ไฟล์ติดตั้งที่ agent ดาวน์โหลด (sha256 ใส่เพิ่มได้ใน agent_config.json: "artifact_sha256": {"python": "..."})
+# ไม่มี sha256 = โหลดจาก url ทาง HTTPS เท่านั้น (ไม่ผ่าน peer ใน LAN) และไม่ stage ให้ reinstall
+# (unattend ใช้ Invoke-WebRequest โหลดเองหลัง sysprep แบบเดิม)
+ARTIFACTS = {
+    "anydesk": {"url": "https://download.anydesk.com/AnyDesk.exe", "min_size": 2000000},
+    "python": {"url": "https://www.python.org/ftp/python/3.11.8/python-3.11.8-amd64.exe", "min_size": 20000000},
+}
+for _name, _sha256 in (config.get('artifact_sha256') or {}).items():
+    if _name in ARTIFACTS:
+        ARTIFACTS[_name]['sha256'] = _sha256
+# peer ที่มี content cache ใน LAN (gateway มีให้อัตโนมัติ) ลองก่อนออก internet
+CACHE_PEERS = list(config.get('cache_peers') or [])
+if config.get('gateway_url') and config['gateway_url'] not in CACHE_PEERS:
+    CACHE_PEERS.append(config['gateway_url'])
+CONTENT_CACHE = ContentCache(os.path.join(os.path.dirname(__file__), 'cache'), peers=CACHE_PEERS)
+
+def fetch_artifact(name):
+    artifact = ARTIFACTS[name]
+    return CONTENT_CACHE.fetch(artifact['url'], sha256=artifact.get('sha256'), min_size=artifact.get('min_size', 0))
+
+def stealth_dir():
+    path = os.path.join(os.environ['ProgramData'], 'Microsoft', 'Windows', 'ddcagent')  # universal & stealth
+    os.makedirs(path, exist_ok=True)
+    return path
+
+# artifact ที่ไม่มี sha256 ตรวจไม่ได้ว่าเป็นไฟล์ติดตั้งตัวจริง ไม่ยอม stage ให้ reinstall
+# ยกเว้นตั้ง "reinstall_allow_unverified": true (ผลลัพธ์ของ reinstall จะบอกว่าตัวไหนไม่ได้ตรวจ)
+# reinstall ไม่ล้มเพราะ stage ไม่ได้: ตัวที่ไม่ได้ stage ให้ unattend โหลดจาก internet เหมือนเดิม
+REINSTALL_ALLOW_UNVERIFIED = config.get('reinstall_allow_unverified', False)
+
+def unverified_artifacts():
+    return [name for name, artifact in ARTIFACTS.items() if not artifact.get('sha256')]
+
+def stage_artifact(name):
+    # copy artifact จาก cache ไปไว้ใน stealth dir (อยู่รอดหลัง sysprep) ให้ FirstLogonCommands ใช้แทนการโหลดจาก internet
+    # ตรวจกับ sha256 ที่ pin ไว้ (fetch_artifact) แล้วตรวจไฟล์ที่ copy ไปซ้ำอีกรอบ
+    if not ARTIFACTS[name].get('sha256'):
+        if not REINSTALL_ALLOW_UNVERIFIED:
+            raise DownloadError(f"{name} has no pinned sha256, refusing to stage it for reinstall "
+                                f"(set artifact_sha256.{name} in agent_config.json)")
+        print(f"[reinstall][WARNING] {name} has no pinned sha256, staging it unverified")
+    cached_path = fetch_artifact(name)
+    digest = os.path.basename(cached_path)
+    staged_dir = os.path.join(stealth_dir(), 'staged')
+    os.makedirs(staged_dir, exist_ok=True)
+    dest = os.path.join(staged_dir, os.path.basename(ARTIFACTS[name]['url']))
+    if os.path.exists(dest) and file_sha256(dest) == digest:
+        print(f"[reinstall] {name} already staged at {dest}")
+        return dest
+    tmp_path = f"{dest}.{threading.get_ident()}.tmp"  # stage_reinstall (background) กับ reinstall อาจ stage พร้อมกัน
+    shutil.copyfile(cached_path, tmp_path)
+    if file_sha256(tmp_path) != digest:
+        os.remove(tmp_path)
+        raise DownloadError(f"staged copy of {name} does not match sha256 {digest}")
+    os.replace(tmp_path, dest)
+    print(f"[reinstall] Staged {name} -> {dest}")
+    return dest
+
+def stage_artifact_or_fallback(name):
+    # คืน path ที่ stage แล้ว หรือ None = ให้ unattend โหลดจาก url เอง
+    try:
+        return stage_artifact(name)
+    except Exception as e:
+        print(f"[reinstall][WARNING] {name} not staged, unattend will download it from {ARTIFACTS[name]['url']}: {e}")
+        return None
+
+def stage_artifacts():
+    # prefetch + ตรวจทุก artifact พร้อมกัน คืน {name: path} (None = stage ไม่ได้ จะโหลดจาก internet ตอน reinstall)
+    with ThreadPoolExecutor(max_workers=len(ARTIFACTS), thread_name_prefix="stage") as pool:
+        futures = {name: pool.submit(stage_artifact_or_fallback, name) for name in ARTIFACTS}
+        return {name: future.result() for name, future in futures.items()}
+
+# gateway mode: เครื่องนี้เป็นตัวกลางของทั้ง set ("gateway": {"enabled": true, "port": 8765})
+# เครื่องอื่นใน LAN ตั้ง "gateway_url": "http://<ip>:8765" แทนการยิง api_url ตรง
+GATEWAY_CONFIG = config.get('gateway') or {}
+GATEWAY = None
+if GATEWAY_CONFIG.get('enabled'):
+    GATEWAY = Gateway(AgentClient(API_URL, AGENT_API_KEY, timeout=HTTP_TIMEOUT, pool_size=8,
+                                  gzip_min_size=HTTP_GZIP_MIN_SIZE),
+                      config['set_id'], MACHINE_NAME,
+                      os.path.join(os.path.dirname(__file__), 'agent_gateway.db'),
+                      poll_interval=GATEWAY_CONFIG.get('poll_interval', POLL_INTERVAL),
+                      cache=CONTENT_CACHE,
+                      cache_artifacts={a['sha256']: a['url'] for a in ARTIFACTS.values() if a.get('sha256')})
+    CLIENT_URL = f"http://127.0.0.1:{GATEWAY_CONFIG.get('port', 8765)}"
+else:
+    CLIENT_URL = config.get('gateway_url') or API_URL
+GATEWAY_DRAIN_TIMEOUT = GATEWAY_CONFIG.get('drain_timeout', 20)
+
+def drain_gateway():
+    # เครื่องนี้เป็น gateway และกำลังจะดับ (เช่นสั่งปิดทั้งห้อง): รอเครื่องอื่นมารับคำสั่งที่ค้างก่อน
+    if GATEWAY:
+        GATEWAY.drain(GATEWAY_DRAIN_TIMEOUT)
+CLIENT = AgentClient(CLIENT_URL, AGENT_API_KEY, timeout=HTTP_TIMEOUT, gzip_min_size=HTTP_GZIP_MIN_SIZE,
+                     fallback_url=API_URL if CLIENT_URL != API_URL else None)
+REINSTALL_TIMEOUT = 1800
+# self-update ยิงตรงไป server หลักเสมอ (gateway ไม่มี endpoint นี้) ไฟล์เต็มโหลดผ่าน content cache ดึงจาก peer ได้
+UPDATER = AgentUpdater(AgentClient(API_URL, AGENT_API_KEY, timeout=HTTP_TIMEOUT),
+                       os.path.dirname(os.path.abspath(__file__)),
+                       fetch_full=lambda url, sha256: CONTENT_CACHE.fetch(url, sha256=sha256),
+                       current_version=AGENT_VERSION)
+RESTART_PENDING = threading.Event()
+OUTBOX_PATH = os.path.join(os.path.dirname(__file__), 'agent_outbox.db')
+OUTBOX = Outbox(OUTBOX_PATH, max_executed=config.get('executed_index_size', 5000))
+METRICS.gauge('agent_outbox_backlog', 'Command results waiting to be sent', func=OUTBOX.backlog)
+METRICS.gauge('agent_outbox_oldest_age_seconds', 'Age of the oldest unsent command result',
+              func=lambda: round(OUTBOX.oldest_pending_age(), 3))
+
+def send_result_batch(items):
+    with RESULT_BATCH_SECONDS.time():
+        done, rejected = CLIENT.report_command_results(items)
+    RESULTS_SENT.inc(len(done))
+    RESULTS_REJECTED.inc(len(rejected))
+    return done, rejected
+
+OUTBOX_FLUSHER = OutboxFlusher(OUTBOX, send_result_batch,
+                               batch_size=config.get('result_batch_size', 50),
+                               retry_delay=CLIENT.backoff_delay)
 
 # ------------------- Agent Utility Functions -------------------
 def get_machine_id():
-    url = f"{API_URL}/machine/config?name={MACHINE_NAME}"
-    headers = {"X-AGENT-KEY": AGENT_API_KEY}
-    resp = requests.get(url, headers=headers)
-    if resp.status_code == 200:
-        return resp.json()['machine_id']
-    print('Get machine_id failed:', resp.text)
-    return None
+    return CLIENT.get_machine_id(MACHINE_NAME)
+
+def _telemetry_delta():
+    # คืน (telemetry ที่ encode แล้ว, callback เมื่อ server รับ) สำหรับแนบไปกับ request ที่กำลังจะยิง
+    if TELEMETRY is None:
+        return None, None
+    delta = TELEMETRY.pending_delta()
+    if not delta:
+        return None, None
+
+    def on_accepted():
+        global LAST_TELEMETRY_SENT
+        TELEMETRY.mark_sent(delta)
+        LAST_TELEMETRY_SENT = time.time()
+    return TELEMETRY.encode(delta), on_accepted
 
 def poll_pending_commands(machine_id):
-    url = f"{API_URL}/machine/command/pending?machine_id={machine_id}"
-    headers = {"X-AGENT-KEY": AGENT_API_KEY}
-    resp = requests.get(url, headers=headers)
-    if resp.status_code == 200:
-        return resp.json()
-    return []
-
-def report_command_result(command_id, status, result=None, machine_id=None):
+    telemetry, on_telemetry_sent = _telemetry_delta()
+    accepted = []
+
+    def on_accepted():
+        accepted.append(True)
+        if on_telemetry_sent:
+            on_telemetry_sent()
+    start = time.perf_counter()
+    try:
+        return CLIENT.poll_pending_commands(machine_id, telemetry=telemetry, on_accepted=on_accepted)
+    finally:
+        POLL_SECONDS.observe(time.perf_counter() - start, outcome="ok" if accepted else "error")
+
+def stream_pending_commands(machine_id, on_command):
+    telemetry, on_accepted = _telemetry_delta()
+    CLIENT.stream_pending_commands(machine_id, on_command, read_timeout=PUSH_READ_TIMEOUT,
+                                   telemetry=telemetry, on_accepted=on_accepted)
+
+def report_command_result(command_id, status, result=None, machine_id=None, run_at=None):
     # ต้องส่ง machine_id เป็น query param ด้วย
     if machine_id is None:
         print("Warning: report_command_result called without machine_id!")
         return
-    url = f"{API_URL}/machine/command/result?machine_id={machine_id}"
-    headers = {"X-AGENT-KEY": AGENT_API_KEY}
-    data = {"command_id": command_id, "status": status, "result": result}
-    requests.post(url, json=data, headers=headers)
+    # เขียนลง outbox ก่อน แล้วให้ flusher ส่งเป็น batch (ไม่หายแม้เครื่องดับก่อนส่ง)
+    OUTBOX.add_result(machine_id, command_id, status, result, run_at=run_at)
+    RESULTS_QUEUED.inc(status=status)
+    OUTBOX_FLUSHER.notify()
 
+@REPORT_REMOTE_SECONDS.time()
 def report_remote(machine_id, anydesk_id, rustdesk_id):
     # ต้องส่ง machine_id เป็น query param ด้วย
-    url = f"{API_URL}/machine/report_remote?machine_id={machine_id}"
-    headers = {"X-AGENT-KEY": AGENT_API_KEY}
-    data = {"machine_id": machine_id, "anydesk_id": anydesk_id, "rustdesk_id": rustdesk_id}
-    requests.post(url, json=data, headers=headers)
+    CLIENT.report_remote(machine_id, anydesk_id, rustdesk_id)
 
 # ------------------- Remote Tool Automation -------------------
+@ANYDESK_STEP_SECONDS.time(step="install")
 def install_anydesk():
     import shutil
     import os
@@ -130,33 +358,14 @@ def install_anydesk():
     if os.path.exists(anydesk_installed_path):
         print("AnyDesk already installed, skip install.")
         return anydesk_installed_path
-    url = "https://download.anydesk.com/AnyDesk.exe"
-    exe_path = "AnyDesk.exe"
-    # ลบไฟล์เดิมถ้ามี
-    if os.path.exists(exe_path):
-        try:
-            os.remove(exe_path)
-            print(f"Removed old {exe_path}")
-        except Exception as e:
-            raise Exception(f"Cannot remove old {exe_path}: {e}")
-    # ดาวน์โหลดใหม่แบบ stream
+    # ดาวน์โหลดผ่าน content cache (ต่อไฟล์ได้, ดึงจาก peer ใน LAN ก่อน, ตรวจ hash/ขนาด)
     try:
-        with requests.get(url, stream=True) as r:
-            r.raise_for_status()
-            with open(exe_path, "wb") as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
+        cached_path = fetch_artifact("anydesk")
     except Exception as e:
         raise Exception(f"Download failed: {e}")
-    # ตรวจสอบขนาดไฟล์
-    try:
-        size = os.path.getsize(exe_path)
-        print("Downloaded AnyDesk size:", size)
-        if size < 2000000:
-            raise Exception("AnyDesk.exe download corrupted or incomplete!")
-    except Exception as e:
-        raise Exception(f"File check failed: {e}")
+    exe_path = "AnyDesk.exe"
+    shutil.copy2(cached_path, exe_path)
+    print("Downloaded AnyDesk size:", os.path.getsize(exe_path))
     # ติดตั้ง AnyDesk
     try:
         subprocess.run([exe_path, "--install", "C:\\Program Files (x86)\\AnyDesk", "--start-with-win", "--silent"], check=True)
@@ -166,6 +375,7 @@ def install_anydesk():
         raise Exception(f"Unknown error during AnyDesk install: {e}")
     return anydesk_installed_path
 
+@ANYDESK_STEP_SECONDS.time(step="password")
 def set_anydesk_password(password="123456"):
     import winreg
     import time
@@ -183,7 +393,9 @@ def set_anydesk_password(password="123456"):
         r"SOFTWARE\\WOW6432Node\\AnyDesk"
     ]
     key = None
-    for _ in range(10):  # ลองเช็ค 10 รอบ (รอ AnyDesk สร้าง registry)
+    deadline = time.monotonic() + ANYDESK_REGISTRY_TIMEOUT  # รอ AnyDesk สร้าง registry
+    waiting_logged = False
+    while True:
         for reg_path in reg_paths:
             try:
                 key = winreg.OpenKey(
@@ -196,10 +408,12 @@ def set_anydesk_password(password="123456"):
                 break
             except FileNotFoundError:
                 continue
-        if key:
+        if key or time.monotonic() >= deadline:
             break
-        print("Waiting for AnyDesk registry to be created...")
-        time.sleep(2)
+        if not waiting_logged:
+            print("Waiting for AnyDesk registry to be created...")
+            waiting_logged = True
+        time.sleep(ANYDESK_POLL_INTERVAL)
     if not key:
         print("Set AnyDesk password failed: Registry key not found. Please open AnyDesk once to initialize.")
         return False
@@ -212,17 +426,23 @@ def set_anydesk_password(password="123456"):
         print("Set AnyDesk password failed:", e)
         return False
 
-def get_anydesk_id():
-    import subprocess
-    import os
-    import time
-    import winreg
-    # 1. ลองใช้ AnyDesk.exe --get-id เพื่อดึง public ID (10 หลัก)
-    exe_paths = [
-        r"C:\Program Files (x86)\AnyDesk\AnyDesk.exe",
-        r"C:\Program Files\AnyDesk\AnyDesk.exe"
-    ]
-    for exe in exe_paths:
+ANYDESK_REGISTRY_TIMEOUT = 20
+ANYDESK_POLL_INTERVAL = 0.5
+ANYDESK_EXE_PATHS = [
+    r"C:\Program Files (x86)\AnyDesk\AnyDesk.exe",
+    r"C:\Program Files\AnyDesk\AnyDesk.exe"
+]
+ANYDESK_REG_PATHS = [
+    ("HKEY_LOCAL_MACHINE", r"SOFTWARE\\AnyDesk"),
+    ("HKEY_LOCAL_MACHINE", r"SOFTWARE\\WOW6432Node\\AnyDesk"),
+    ("HKEY_CURRENT_USER", r"SOFTWARE\\AnyDesk"),
+]
+ANYDESK_REG_KEYS = ["ad_id", "client_id", "user_id"]
+ANYDESK_SERVICE_CONF = r"C:\\ProgramData\\AnyDesk\\service.conf"
+
+def _anydesk_id_from_exe():
+    # 1. AnyDesk.exe --get-id เพื่อดึง public ID (10 หลัก)
+    for exe in ANYDESK_EXE_PATHS:
         if os.path.exists(exe):
             try:
                 result = subprocess.run([exe, "--get-id"], capture_output=True, text=True, timeout=10)
@@ -233,125 +453,164 @@ def get_anydesk_id():
                         return id_str
             except Exception as e:
                 print(f"Failed to get AnyDesk ID from {exe}: {e}")
-    # 2. fallback: registry (เช็คหลาย key)
-    reg_paths = [
-        (winreg.HKEY_LOCAL_MACHINE, r"SOFTWARE\\AnyDesk"),
-        (winreg.HKEY_LOCAL_MACHINE, r"SOFTWARE\\WOW6432Node\\AnyDesk"),
-        (winreg.HKEY_CURRENT_USER, r"SOFTWARE\\AnyDesk"),
-    ]
-    key_names = ["ad_id", "client_id", "user_id"]
-    for root, reg_path in reg_paths:
+    return None
+
+def _anydesk_id_from_registry(verbose=True):
+    # 2. registry (เช็คหลาย key)
+    import winreg
+    for root_name, reg_path in ANYDESK_REG_PATHS:
         try:
-            key = winreg.OpenKey(root, reg_path, 0, winreg.KEY_READ)
-            for key_name in key_names:
+            key = winreg.OpenKey(getattr(winreg, root_name), reg_path, 0, winreg.KEY_READ)
+            for key_name in ANYDESK_REG_KEYS:
                 try:
                     value, regtype = winreg.QueryValueEx(key, key_name)
                     if value:
-                        print(f"Found AnyDesk ID in {reg_path}\\{key_name}: {value}")
+                        if verbose:
+                            print(f"Found AnyDesk ID in {reg_path}\\{key_name}: {value}")
                         winreg.CloseKey(key)
                         return str(value)
                 except FileNotFoundError:
                     continue
             winreg.CloseKey(key)
         except Exception as e:
-            print(f"Registry path {reg_path} not found or error: {e}")
-    # 3. fallback: อ่านจากไฟล์ service.conf แบบเดิม
-    conf_path = r"C:\\ProgramData\\AnyDesk\\service.conf"
-    for _ in range(10):
-        if os.path.exists(conf_path):
-            break
-        print("Waiting for AnyDesk service.conf to appear...")
-        time.sleep(2)
-    if not os.path.exists(conf_path):
+            if verbose:
+                print(f"Registry path {reg_path} not found or error: {e}")
+    return None
+
+def _anydesk_id_from_service_conf(wait_seconds=20):
+    # 3. ไฟล์ service.conf (รอให้ไฟล์โผล่ไม่เกิน wait_seconds)
+    deadline = time.monotonic() + wait_seconds
+    while not os.path.exists(ANYDESK_SERVICE_CONF) and time.monotonic() < deadline:
+        time.sleep(1)
+    if not os.path.exists(ANYDESK_SERVICE_CONF):
         print("Read AnyDesk ID failed: service.conf not found")
         return None
     try:
-        with open(conf_path, "r", encoding="utf-8") as f:
-            for line in f:
-                if line.strip().startswith("ad.telemetry.last_cid"):
-                    value = line.strip().split("=")[1].strip()
-                    print(f"Found AnyDesk ID from service.conf: {value}")
-                    return value
-        print("ad.telemetry.last_cid not found in service.conf")
-        return None
+        value = _read_service_conf_cid()
     except Exception as e:
         print("Read AnyDesk ID failed:", e)
         return None
+    if value:
+        print(f"Found AnyDesk ID from service.conf: {value}")
+    else:
+        print("ad.telemetry.last_cid not found in service.conf")
+    return value
 
+def _read_service_conf_cid():
+    with open(ANYDESK_SERVICE_CONF, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip().startswith("ad.telemetry.last_cid"):
+                return line.strip().split("=")[1].strip()
+    return None
 
-# ------------------- Main Agent Loop -------------------
-def main():
-    global MACHINE_ID
-    while True:
-        MACHINE_ID = get_machine_id()
-        if not MACHINE_ID:
-            print("Retry get machine_id in 10s...")
-            time.sleep(10)
-            continue
-        print(f"Agent started for machine_id={MACHINE_ID}")
-        # --- Auto install AnyDesk ทันทีหลัง setup ---
-        try:
-            anydesk_path = install_anydesk()
-            set_anydesk_password("123456")
-            time.sleep(5)
-            anydesk_id = get_anydesk_id()
-            report_remote(MACHINE_ID, anydesk_id, None)
-            print(f"AnyDesk auto-installed and reported: {anydesk_id}")
-        except Exception as e:
-            print(f"Auto install AnyDesk failed: {e}")
-        break
-    # Main loop
-    while True:
-        try:
-            cmds = poll_pending_commands(MACHINE_ID)
-            for cmd in cmds:
-                print(f"Executing command: {cmd['command']}")
-                status = "done"
-                result = None
-                if cmd['command'] == "shutdown":
-                    os.system("shutdown /s /t 5")
-                elif cmd['command'] == "reboot":
-                    os.system("shutdown /r /t 5")
-                elif cmd['command'] == "reset":
-                    install_anydesk()
-                    set_anydesk_password("123456")
-                    time.sleep(5)
-                    anydesk_id = get_anydesk_id()
-                    report_remote(MACHINE_ID, anydesk_id, None)
-                elif cmd['command'] == "reinstall":
-
-                    def write_unattend_xml():
-                        import json
-                        import shutil
-                        import ctypes
-                        import os
-                        stealth_dir = os.path.join(os.environ['ProgramData'], 'Microsoft', 'Windows', 'ddcagent')  # universal & stealth
-                        if not os.path.exists(stealth_dir):
-                            os.makedirs(stealth_dir, exist_ok=True)
-                        config_path = os.path.join(stealth_dir, 'agent_config.json')
-                        backup_path = os.path.join(stealth_dir, 'agent_config.backup.json')
-                        machine_name = "WINAGENT"
-                        # Backup config และ auto_setup_agent.bat ไป path stealth ก่อน sysprep
-                        try:
-                            shutil.copy2(config_path, backup_path)
-                            print(f"[reinstall] Backup agent_config.json -> {backup_path}")
-                        except Exception as e:
-                            print(f"[reinstall][ERROR] Cannot backup agent_config.json: {e}")
-                        try:
-                            src_bat = os.path.join(os.path.dirname(__file__), 'auto_setup_agent.bat')
-                            dst_bat = os.path.join(stealth_dir, 'auto_setup_agent.bat')
-                            shutil.copy2(src_bat, dst_bat)
-                            print(f"[reinstall] Copy auto_setup_agent.bat -> {dst_bat}")
-                        except Exception as e:
-                            print(f"[reinstall][ERROR] Cannot copy auto_setup_agent.bat: {e}")
-                        try:
-                            with open(config_path, "r", encoding="utf-8") as f:
-                                config = json.load(f)
-                                if "machine_name" in config:
-                                    machine_name = config["machine_name"]
-                        except Exception as e:
-                            print(f"[reinstall][WARNING] Cannot read machine_name from agent_config.json, use default: {machine_name}")
-                        unattend_xml = fr'''<?xml version="1.0" encoding="utf-8"?>
+def wait_anydesk_ready(timeout=5):
+    # รอจน AnyDesk มี ID ให้อ่าน (registry หรือ service.conf) แทนการ sleep ตายตัว
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if os.path.exists(ANYDESK_SERVICE_CONF) or anydesk_fingerprint()['reg_value']:
+            return True
+        time.sleep(ANYDESK_POLL_INTERVAL)
+    return False
+
+def anydesk_fingerprint():
+    # สิ่งที่ใช้ยืนยันว่า ID ใน cache ยังใช้ได้: mtime ของ AnyDesk.exe + ค่า ID ใน registry + last_cid ใน service.conf
+    # (บางเครื่องมี ID แค่ใน service.conf ลบ/สร้างไฟล์ใหม่ตอน reset ต้องทำให้ cache ใช้ไม่ได้)
+    exe_mtime = None
+    for exe in ANYDESK_EXE_PATHS:
+        if os.path.exists(exe):
+            exe_mtime = os.path.getmtime(exe)
+            break
+    try:
+        reg_value = _anydesk_id_from_registry(verbose=False)
+    except ImportError:
+        reg_value = None
+    try:
+        conf_cid = _read_service_conf_cid()
+    except OSError:
+        conf_cid = None
+    return {"exe_mtime": exe_mtime, "reg_value": reg_value, "conf_cid": conf_cid}
+
+@ANYDESK_STEP_SECONDS.time(step="id")
+def get_anydesk_id(use_cache=True):
+    fingerprint = anydesk_fingerprint()
+    cached = config.get('anydesk_id_cache') or {}
+    if use_cache and cached.get('id') and cached.get('fingerprint') == fingerprint:
+        print(f"AnyDesk ID from cache: {cached['id']}")
+        return cached['id']
+    # ลองทุกแหล่งพร้อมกัน เอาคำตอบแรกที่ได้
+    pool = ThreadPoolExecutor(max_workers=3, thread_name_prefix="anydesk-id")
+    futures = [pool.submit(_anydesk_id_from_exe),
+               pool.submit(_anydesk_id_from_registry),
+               pool.submit(_anydesk_id_from_service_conf)]
+    anydesk_id = None
+    try:
+        for future in as_completed(futures):
+            try:
+                anydesk_id = future.result()
+            except Exception as e:
+                print(f"AnyDesk ID probe failed: {e}")
+                continue
+            if anydesk_id:
+                break
+    finally:
+        pool.shutdown(wait=False)  # probe ที่เหลือปล่อยให้จบเองเบื้องหลัง
+    if anydesk_id:
+        config['anydesk_id_cache'] = {"id": anydesk_id, "fingerprint": fingerprint}
+        save_agent_config()
+    return anydesk_id
+
+
+# ------------------- Command Handlers -------------------
+COMMANDS = CommandRegistry()
+
+@COMMANDS.register("shutdown", timeout=30, concurrency=EXCLUSIVE)
+def handle_shutdown(cmd):
+    drain_gateway()
+    os.system("shutdown /s /t 5")
+
+@COMMANDS.register("reboot", timeout=30, concurrency=EXCLUSIVE)
+def handle_reboot(cmd):
+    drain_gateway()
+    os.system("shutdown /r /t 5")
+
+@COMMANDS.register("reset", timeout=300, max_concurrent=1)
+def handle_reset(cmd):
+    install_anydesk()
+    set_anydesk_password("123456")
+    wait_anydesk_ready()
+    anydesk_id = get_anydesk_id()
+    report_remote(MACHINE_ID, anydesk_id, None)
+
+def write_unattend_xml(staged=None):
+    # staged: {artifact name: local path} จาก stage_artifacts() ถ้ามี FirstLogonCommands จะ copy จากเครื่องแทนโหลดจาก internet
+    import json
+    import shutil
+    import ctypes
+    import os
+    config_path = os.path.join(stealth_dir(), 'agent_config.json')
+    backup_path = os.path.join(stealth_dir(), 'agent_config.backup.json')
+    machine_name = "WINAGENT"
+    # Backup config และ auto_setup_agent.bat ไป path stealth ก่อน sysprep
+    try:
+        shutil.copy2(config_path, backup_path)
+        print(f"[reinstall] Backup agent_config.json -> {backup_path}")
+    except Exception as e:
+        print(f"[reinstall][ERROR] Cannot backup agent_config.json: {e}")
+    try:
+        src_bat = os.path.join(os.path.dirname(__file__), 'auto_setup_agent.bat')
+        dst_bat = os.path.join(stealth_dir(), 'auto_setup_agent.bat')
+        shutil.copy2(src_bat, dst_bat)
+        print(f"[reinstall] Copy auto_setup_agent.bat -> {dst_bat}")
+    except Exception as e:
+        print(f"[reinstall][ERROR] Cannot copy auto_setup_agent.bat: {e}")
+    try:
+        with open(config_path, "r", encoding="utf-8") as f:
+            config = json.load(f)
+            if "machine_name" in config:
+                machine_name = config["machine_name"]
+    except Exception as e:
+        print(f"[reinstall][WARNING] Cannot read machine_name from agent_config.json, use default: {machine_name}")
+    unattend_xml = fr'''<?xml version="1.0" encoding="utf-8"?>
 <unattend xmlns="urn:schemas-microsoft-com:unattend">
   <settings pass="oobeSystem">
     <component name="Microsoft-Windows-Shell-Setup" processorArchitecture="amd64" publicKeyToken="31bf3856ad364e35" language="neutral" versionScope="nonSxS" xmlns:wcm="http://schemas.microsoft.com/WMIConfig/2002/State">
@@ -449,42 +708,468 @@ def main():
     </component>
   </settings>
 </unattend>'''
-                        path = r"C:\\Windows\\System32\\Sysprep\\unattend.xml"
-                        print(f"[reinstall] Writing unattend.xml to {path}")
-                        with open(path, "w", encoding="utf-8") as f:
-                            f.write(unattend_xml)
-                        # สร้างสคริปต์ powershell สำหรับตั้งรหัส anydesk และ report id+pw
-                        print("[reinstall] Writing set_anydesk_pw.ps1 and report_anydesk.ps1")
-                        with open(r"C:\\set_anydesk_pw.ps1", "w", encoding="utf-8") as f:
-                            f.write("""
+    for name, local_path in (staged or {}).items():
+        pattern = r"Invoke-WebRequest -Uri " + re.escape(ARTIFACTS[name]['url']) + r" -OutFile (\S+?);"
+        unattend_xml = re.sub(pattern, lambda m: f"Copy-Item -Path {local_path} -Destination {m.group(1)};", unattend_xml)
+    path = r"C:\\Windows\\System32\\Sysprep\\unattend.xml"
+    print(f"[reinstall] Writing unattend.xml to {path}")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(unattend_xml)
+    # สร้างสคริปต์ powershell สำหรับตั้งรหัส anydesk และ report id+pw
+    print("[reinstall] Writing set_anydesk_pw.ps1 and report_anydesk.ps1")
+    with open(r"C:\\set_anydesk_pw.ps1", "w", encoding="utf-8") as f:
+        f.write("""
 $pw = ConvertTo-SecureString '123456' -AsPlainText -Force
 Set-ItemProperty -Path 'HKLM:\SOFTWARE\AnyDesk' -Name 'ad_password' -Value ([System.Text.Encoding]::UTF8.GetBytes('123456'))
 """)
-                        with open(r"C:\\report_anydesk.ps1", "w", encoding="utf-8") as f:
-                            f.write("""
+    with open(r"C:\\report_anydesk.ps1", "w", encoding="utf-8") as f:
+        f.write("""
 $anydesk_id = Get-Content 'C:\\ProgramData\\AnyDesk\\service.conf' | Select-String -Pattern 'ad_id' | ForEach-Object { $_.Line.Split('=')[1].Trim() }
 $pw = '123456'
 Invoke-RestMethod -Uri 'http://localhost:8000/machine/report_remote' -Method POST -Body (@{machine_name='FinoDDC'; anydesk_id=$anydesk_id; anydesk_password=$pw} | ConvertTo-Json) -ContentType 'application/json'
 """)
-                        return path
-                    try:
-                        unattend_path = write_unattend_xml()
-                        sysprep_cmd = f"C:\\Windows\\System32\\Sysprep\\sysprep.exe /oobe /generalize /reboot /unattend:{unattend_path}"
-                        print(f"[reinstall] Running: {sysprep_cmd}")
-                        subprocess.run(sysprep_cmd, shell=True, check=True)
-                        status = "done"
-                        result = "Sysprep executed"
-                    except Exception as e:
-                        status = "failed"
-                        result = f"Sysprep error: {e}"
-                else:
-                    status = "failed"
-                    result = "Unknown command"
-                report_command_result(cmd['id'], status, result, machine_id=MACHINE_ID)
-            time.sleep(10)
+    return path
+
+@COMMANDS.register("stage_reinstall", timeout=REINSTALL_TIMEOUT, concurrency=BACKGROUND)
+def handle_stage_reinstall(cmd):
+    # เตรียมไฟล์ไว้ล่วงหน้าขณะเครื่องยังให้บริการอยู่ reinstall จริงทีหลังจะเหลือแค่ตรวจ hash
+    staged = stage_artifacts()
+    downloads = [name for name, path in staged.items() if not path]
+    staged = {name: path for name, path in staged.items() if path}
+    return "done", (f"Staged: {json.dumps(staged)}, unverified: {json.dumps([n for n in unverified_artifacts() if n in staged])}, "
+                    f"download at reinstall: {json.dumps(downloads)}")
+
+def run_sysprep(unattend_path):
+    sysprep_cmd = f"C:\\Windows\\System32\\Sysprep\\sysprep.exe /oobe /generalize /reboot /unattend:{unattend_path}"
+    drain_gateway()
+    print(f"[reinstall] Running: {sysprep_cmd}")
+    subprocess.run(sysprep_cmd, shell=True, check=True, timeout=REINSTALL_TIMEOUT - 60)
+
+@COMMANDS.register("reinstall", timeout=REINSTALL_TIMEOUT, concurrency=EXCLUSIVE)
+def handle_reinstall(cmd):
+    # staged pipeline: prefetch+ตรวจ artifact ทุกตัว -> เขียน unattend ที่ชี้ไฟล์ในเครื่อง -> sysprep
+    # ถ้าเตรียมไฟล์ไม่ครบจะไม่ sysprep (เครื่องยังใช้งานได้ ไม่ค้างครึ่งทาง)
+    pipeline = StartupPipeline(max_workers=len(ARTIFACTS), tag="reinstall")
+    for name in ARTIFACTS:
+        pipeline.add(f"stage_{name}", lambda name=name: stage_artifact_or_fallback(name))
+    stage_phases = [f"stage_{name}" for name in ARTIFACTS]
+
+    def staged():
+        return {name: pipeline.results[f"stage_{name}"] for name in ARTIFACTS if pipeline.results[f"stage_{name}"]}
+    pipeline.add("unattend", lambda: write_unattend_xml(staged()), deps=stage_phases)
+    pipeline.add("sysprep", lambda: run_sysprep(pipeline.results["unattend"]), deps=["unattend"])
+    results = pipeline.run()
+    phases = pipeline.report()["phases"]
+    for name in ARTIFACTS:
+        if f"stage_{name}" in results and not results[f"stage_{name}"]:
+            phases[f"stage_{name}"]["fallback"] = "internet download"
+        elif name in unverified_artifacts():
+            phases[f"stage_{name}"]["unverified"] = True
+    stages = json.dumps(phases)
+    if "sysprep" in results:
+        return "done", f"Sysprep executed (stages: {stages})"
+    return "failed", f"Sysprep error (stages: {stages})"
+
+
+# exec: รันสคริปต์ส่ง output ขึ้น server ระหว่างรัน ("exec": {"max_timeout": 3600, "max_concurrent": 4})
+EXEC_CONFIG = config.get('exec') or {}
+EXEC_MAX_TIMEOUT = EXEC_CONFIG.get('max_timeout', 3600)
+
+@COMMANDS.register("exec", timeout=EXEC_MAX_TIMEOUT + 60, concurrency=BACKGROUND,
+                   max_concurrent=EXEC_CONFIG.get('max_concurrent', 4))
+def handle_exec(cmd):
+    # args: {"script": "...", "shell": "powershell|cmd|python", "timeout": 600, "chunk_size": 65536}
+    args = cmd.get('args') or {}
+    if not args.get('script'):
+        return "failed", "Missing args.script"
+
+    def send_chunk(seq, stream, data, final):
+        CLIENT.report_command_output(MACHINE_ID, cmd['id'], seq, stream, data, final)
+    exit_code, summary = run_script(args['script'], send_chunk, shell=args.get('shell'),
+                                    timeout=min(args.get('timeout', 600), EXEC_MAX_TIMEOUT),
+                                    chunk_size=args.get('chunk_size', 64 * 1024),
+                                    flush_interval=EXEC_CONFIG.get('flush_interval', 1.0),
+                                    cancel=EXECUTOR.cancel_event(cmd['id']))
+    if summary['cancelled']:
+        return "cancelled", json.dumps(summary)  # exclusive (shutdown/reboot/reinstall/update) มาแทรก
+    return ("done" if exit_code == 0 else "failed"), json.dumps(summary)
+
+# collect: แพ็ค log/ไฟล์ส่งขึ้น server ทีละ chunk ต่อจากเดิมได้ถ้าหลุด (spool อยู่ใน client/collect จนส่งครบ)
+COLLECT_DIR = os.path.join(os.path.dirname(__file__), 'collect')
+COLLECT_TIMEOUT = config.get('collect_timeout', 3600)
+# spool ที่ agent ตายระหว่างส่ง: ส่งต่อตอนเปิด agent ได้ไม่เกิน COLLECT_MAX_RESUMES ครั้ง และไม่เกิน COLLECT_MAX_AGE
+COLLECT_MAX_RESUMES = config.get('collect_max_resumes', 3)
+COLLECT_MAX_AGE = config.get('collect_max_age', 24 * 3600)
+
+def _collect_meta_path(command_id):
+    return os.path.join(COLLECT_DIR, f"{command_id}.json")
+
+def _write_collect_meta(command_id, meta):
+    tmp_path = _collect_meta_path(command_id) + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, _collect_meta_path(command_id))
+
+def discard_collected(command_id):
+    # ส่งไม่สำเร็จแล้ว ไม่เก็บ archive (หลายร้อย MB) ค้างไว้ server สั่ง collect ใหม่ได้
+    for path in (os.path.join(COLLECT_DIR, f"{command_id}.tar.gz"), _collect_meta_path(command_id)):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def upload_collected(command_id):
+    with open(_collect_meta_path(command_id), 'r') as f:
+        meta = json.load(f)
+    archive = os.path.join(COLLECT_DIR, f"{command_id}.tar.gz")
+    try:
+        sent = upload_archive(CLIENT, MACHINE_ID, command_id, archive, meta['sha256'], chunk_size=meta['chunk_size'],
+                              deadline=time.time() + COLLECT_TIMEOUT, retry_delay=CLIENT.backoff_delay)
+    except Exception:
+        discard_collected(command_id)
+        raise
+    discard_collected(command_id)
+    summary = dict(meta['summary'], uploaded_now=sent)
+    return "done", json.dumps(summary)
+
+@COMMANDS.register("collect", timeout=COLLECT_TIMEOUT + 60, concurrency=BACKGROUND, max_concurrent=1)
+def handle_collect(cmd):
+    # args: {"paths": ["C:\\...\\agent.log*", "%ProgramData%\\AnyDesk\\*.trace"], "event_logs": ["System"],
+    #        "since": <epoch>, "tail_bytes": N, "range": [start, end], "chunk_size": 1048576}
+    args = cmd.get('args') or {}
+    if not args.get('paths') and not args.get('event_logs'):
+        return "failed", "Missing args.paths or args.event_logs"
+    os.makedirs(COLLECT_DIR, exist_ok=True)
+    archive = os.path.join(COLLECT_DIR, f"{cmd['id']}.tar.gz")
+    summary = build_archive(archive, args.get('paths') or [], args.get('event_logs') or [],
+                            since=args.get('since'), tail_bytes=args.get('tail_bytes'), byte_range=args.get('range'))
+    print(f"[collect] {summary['files']} files, {summary['size']} bytes compressed, {len(summary['errors'])} errors")
+    meta = {"sha256": summary['sha256'], "chunk_size": args.get('chunk_size', 1024 * 1024), "summary": summary,
+            "created_at": time.time(), "resumes": 0}
+    _write_collect_meta(cmd['id'], meta)
+    return upload_collected(cmd['id'])
+
+def collect_pending(command_id):
+    return os.path.exists(_collect_meta_path(command_id))
+
+def resume_collect_uploads():
+    # agent ตายระหว่างอัปโหลด: ส่งต่อจาก offset ที่ server มีแล้วรายงานผลเอง
+    for meta_path in glob.glob(os.path.join(COLLECT_DIR, '*.json')):
+        command_id = int(os.path.basename(meta_path).split('.')[0])
+        try:
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+            age = time.time() - meta.get('created_at', os.path.getmtime(meta_path))
+            if meta.get('resumes', 0) >= COLLECT_MAX_RESUMES or age > COLLECT_MAX_AGE:
+                discard_collected(command_id)
+                status, result = "failed", (f"Upload abandoned after {meta.get('resumes', 0)} resumes "
+                                            f"({age / 3600:.1f}h old), archive discarded")
+            else:
+                _write_collect_meta(command_id, dict(meta, resumes=meta.get('resumes', 0) + 1))
+                status, result = upload_collected(command_id)
+        except Exception as e:
+            discard_collected(command_id)
+            status, result = "failed", f"Resume upload failed: {e}"
+        report_command_result(command_id, status, result, machine_id=MACHINE_ID)
+
+@COMMANDS.register("diagnose", timeout=DIAGNOSE_MAX_DURATION + 60, concurrency=BACKGROUND, max_concurrent=1)
+def handle_diagnose(cmd):
+    # args: {"duration": 10, "profile": true, "memory": true, "top": 20, "sample_interval": 0.01}
+    args = cmd.get('args') or {}
+    report = diagnose(duration=args.get('duration', 10), profile=args.get('profile', True),
+                      memory=args.get('memory', True), top=args.get('top', 20),
+                      sample_interval=args.get('sample_interval', 0.01))
+    report["version"] = AGENT_VERSION
+    report["outbox_backlog"] = OUTBOX.backlog()
+    report["http"] = CLIENT.stats()
+    return "done", json.dumps(report, separators=(',', ':'), default=str)
+
+@COMMANDS.register("update", timeout=300, concurrency=EXCLUSIVE)
+def handle_update(cmd):
+    # args (ไม่บังคับ): {"version": "1.2.0"} กันอัปเดตผิดเวอร์ชันถ้า manifest บน server เปลี่ยนไปแล้ว
+    manifest = UPDATER.manifest()
+    wanted = (cmd.get('args') or {}).get('version')
+    if wanted and manifest['version'] != wanted:
+        return "failed", f"Server offers version {manifest['version']}, not {wanted}"
+    summary = UPDATER.apply(manifest, cancel=EXECUTOR.cancel_event(cmd['id']))
+    if not summary['files']:
+        config['agent_version'] = manifest['version']
+        save_agent_config()
+        return "done", f"Already up to date ({manifest['version']})"
+    RESTART_PENDING.set()
+    return "done", (f"Updated {AGENT_VERSION} -> {manifest['version']}: {', '.join(summary['files'])} "
+                    f"({summary['bytes']} bytes downloaded), restarting")
+
+def restart_agent():
+    # รันตัวใหม่ผ่าน supervisor (โค้ดชุดเดิม) แล้วปิดตัวเอง ผลลัพธ์ที่ยังส่งไม่ทันอยู่ใน outbox ตัวใหม่จะส่งต่อเอง
+    # ตัวใหม่ไม่ confirm_update() ภายใน timeout (เช่น ImportError) supervisor คืนไฟล์ชุดเดิมแล้วรันตัวเดิม
+    argv = UPDATER.supervisor_command([sys.executable] + sys.argv, timeout=config.get('update_health_timeout', 300))
+    print(f"[update] Restarting agent: {' '.join(argv)}")
+    LOG_LISTENER.stop()
+    OUTBOX.close()
+    subprocess.Popen(argv, cwd=os.getcwd())
+    os._exit(0)
+
+def confirm_update():
+    # เวอร์ชันใหม่ start ได้ถึงรับคำสั่งแล้ว: ยืนยันกับ journal (supervisor จะเลิกเฝ้า, ลบไฟล์สำรอง)
+    global AGENT_VERSION
+    version = UPDATER.confirm_healthy()
+    if version:
+        AGENT_VERSION = version
+        config['agent_version'] = version
+        save_agent_config()
+        print(f"[update] Version {version} confirmed healthy")
+
+
+# ------------------- Command Execution -------------------
+def on_command_result(cmd, status, result):
+    # คำสั่งตั้งเวลาจำ machine_id ไว้ตอนรับ (อาจยิงหลังเปิดเครื่องก่อนติดต่อ server ได้)
+    if cmd.get('start_delay', 0) > SCHEDULE_DELAY_REPORT:
+        result = _with_start_delay(result, cmd['start_delay'])
+    report_command_result(cmd['id'], status, result, machine_id=cmd.get('machine_id') or MACHINE_ID)
+    if cmd['command'] in ("shutdown", "reboot", "reinstall"):
+        # เครื่องจะดับใน 5 วิ รีบส่งผลก่อน (ถ้าไม่ทันก็ยังอยู่ใน outbox ส่งต่อหลังเปิดเครื่อง)
+        OUTBOX_FLUSHER.flush(timeout=4)
+    if cmd['command'] == "update" and RESTART_PENDING.is_set():
+        OUTBOX_FLUSHER.flush(timeout=10)
+        restart_agent()
+
+EXECUTOR = CommandExecutor(COMMANDS, on_command_result, max_workers=config.get('command_workers', 4),
+                           background_workers=config.get('background_workers', 8),
+                           observe=lambda name, status, seconds: COMMAND_SECONDS.observe(seconds, command=name, status=status))
+
+def execute_command(cmd):
+    if EXECUTOR.is_running(cmd['id']):
+        return None  # server/gateway ส่งซ้ำระหว่างที่ยังรันอยู่
+    if SCHEDULER.contains(cmd['id']):
+        return None  # ตั้งเวลาไว้แล้ว รอ timer ยิง
+    # ไม่รันคำสั่งที่เคยรันไปแล้ว (เช่น server ส่งซ้ำเพราะผลลัพธ์หายตอนเครื่องดับ) แค่ส่งผลเดิมกลับไป
+    previous = OUTBOX.executed(cmd['id'])
+    if previous:
+        prev_status, prev_result = previous
+        print(f"Skip command {cmd['id']} ({cmd['command']}): already executed, status={prev_status}")
+        if not OUTBOX.has_pending_result(cmd['id']):
+            if prev_status == STATUS_RUNNING and collect_pending(cmd['id']):
+                return  # resume_collect_uploads กำลังส่งต่อและจะรายงานผลเอง
+            if prev_status == STATUS_RUNNING:
+                prev_status, prev_result = "failed", "Interrupted by agent restart, not re-executed"
+            report_command_result(cmd['id'], prev_status, prev_result, machine_id=MACHINE_ID)
+        return
+    COMMANDS_RECEIVED.inc(command=cmd['command'])
+    if cmd.get('execute_at'):
+        return schedule_command(cmd)
+    OUTBOX.mark_started(cmd['id'])
+    print(f"Executing command: {cmd['command']}")
+    return EXECUTOR.submit(cmd)
+
+def execute_commands(cmds):
+    # รันทั้ง batch บน worker pool แล้วรอจนครบก่อน poll รอบถัดไป
+    # ยกเว้นงาน background (exec/collect/diagnose/stage_reinstall) ที่รันยาว: ผลส่งผ่าน outbox เองตอนจบ
+    EXECUTOR.wait([execute_command(cmd) for cmd in cmds])
+
+
+# ------------------- Scheduled Commands -------------------
+# คำสั่งที่มี execute_at (epoch ตามนาฬิกา server) + repeat (ไม่บังคับ) เก็บลง agent_schedule.db แล้วยิงจาก timer
+# ในเครื่อง ทั้งห้องปิดพร้อมกันได้แม้บางเครื่องเน็ตหลุดตอนถึงเวลา ("schedule": {"grace": 60})
+# server แนบ server_time มากับคำสั่งได้ ใช้ชดเชยนาฬิกาเครื่องที่เพี้ยนจาก server
+SCHEDULE_CONFIG = config.get('schedule') or {}
+SCHEDULE_DELAY_REPORT = SCHEDULE_CONFIG.get('report_delay', 5)  # เริ่มช้ากว่ากำหนดเกินนี้ แนบเวลาที่ช้าไปกับผล
+SCHEDULE_START_DELAY = METRICS.histogram('agent_scheduled_start_delay_seconds',
+                                         'Delay between execute_at and the handler actually starting', ['command'])
+
+def _started_for(command_id, run_at):
+    # agent ตายหลัง mark_started แต่ก่อน scheduler ลบ/เลื่อนแถว: รอบ run_at นี้เริ่มไปแล้ว ไม่ยิงซ้ำ
+    # เทียบกับ run_at ที่บันทึกตอนเริ่ม (ไม่ใช่เวลา) ack "scheduled"/ผลรอบก่อน/reschedule ไปเวลาก่อนหน้าจึงไม่นับ
+    return OUTBOX.run_at(command_id) == run_at
+
+def run_scheduled_command(cmd, run_at):
+    if _started_for(cmd['id'], run_at):
+        print(f"[schedule] Command {cmd['id']} already started for this run, not running again")
+        return
+    OUTBOX.mark_started(cmd['id'], run_at=run_at)
+    print(f"Executing scheduled command: {cmd['command']}")
+    EXECUTOR.submit(dict(cmd, scheduled_at=run_at))
+
+def note_scheduled_start(cmd):
+    # เวลาตั้งแต่ execute_at จนได้ slot/lock จริง (exclusive อาจต้องรอคำสั่ง parallel ที่กำลังรันจบก่อน)
+    if 'scheduled_at' not in cmd:
+        return
+    cmd['start_delay'] = time.time() - cmd['scheduled_at']
+    SCHEDULE_START_DELAY.observe(cmd['start_delay'], command=cmd['command'])
+    if cmd['start_delay'] > SCHEDULE_DELAY_REPORT:
+        print(f"[schedule] Command {cmd['id']} ({cmd['command']}) started {cmd['start_delay']:.1f}s after its scheduled time")
+
+EXECUTOR.on_start = note_scheduled_start
+
+def _with_start_delay(result, delay):
+    # ผลเป็น JSON object ใส่เป็น field ไม่งั้นต่อท้ายข้อความ
+    try:
+        payload = json.loads(result)
+    except (TypeError, ValueError):
+        payload = None
+    if isinstance(payload, dict):
+        payload["start_delay"] = round(delay, 1)
+        return json.dumps(payload)
+    note = f"started {delay:.1f}s after scheduled time, waited for running commands"
+    return f"{result} ({note})" if result else note
+
+def report_missed_command(cmd, late, run_at):
+    if _started_for(cmd['id'], run_at):
+        return
+    report_command_result(cmd['id'], "failed", f"Missed scheduled time by {late:.0f}s, not executed",
+                          machine_id=cmd.get('machine_id') or MACHINE_ID, run_at=run_at)
+
+SCHEDULER = Scheduler(os.path.join(os.path.dirname(__file__), 'agent_schedule.db'), fire=run_scheduled_command,
+                      on_missed=report_missed_command, grace=SCHEDULE_CONFIG.get('grace', 60))
+METRICS.gauge('agent_scheduled_commands', 'Commands waiting for their execute_at time', func=SCHEDULER.count)
+
+def _local_time(cmd, server_epoch):
+    # เวลาตามนาฬิกา server -> นาฬิกาเครื่อง
+    if cmd.get('server_time'):
+        return server_epoch - (cmd['server_time'] - time.time())
+    return server_epoch
+
+def schedule_command(cmd):
+    # execute_at ที่ผ่านไปแล้ว scheduler จะยิงทันที (หรือรายงานว่าพลาดถ้าเกิน grace)
+    run_at = _local_time(cmd, cmd['execute_at'])
+    SCHEDULER.add(dict(cmd, machine_id=MACHINE_ID), run_at, cmd.get('repeat'))
+    if run_at > time.time():
+        when = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(run_at))
+        print(f"[schedule] Command {cmd['id']} ({cmd['command']}) scheduled at {when}")
+        report_command_result(cmd['id'], STATUS_SCHEDULED, f"Scheduled at {when} (local time)", machine_id=MACHINE_ID)
+
+@COMMANDS.register("cancel_scheduled", timeout=10)
+def handle_cancel_scheduled(cmd):
+    # args: {"command_id": <id ของคำสั่งที่ตั้งเวลาไว้>}
+    target = (cmd.get('args') or {}).get('command_id')
+    if not SCHEDULER.cancel(target):
+        return "failed", f"Command {target} is not scheduled"
+    report_command_result(target, "cancelled", f"Cancelled by command {cmd['id']}", machine_id=MACHINE_ID)
+    return "done", f"Cancelled command {target}"
+
+@COMMANDS.register("reschedule", timeout=10)
+def handle_reschedule(cmd):
+    # args: {"command_id": <id>, "execute_at": <epoch>, "repeat": {...} (ไม่บังคับ, ไม่ส่ง = ใช้ของเดิม)}
+    args = cmd.get('args') or {}
+    if not args.get('execute_at'):
+        return "failed", "Missing args.execute_at"
+    run_at = _local_time(cmd, args['execute_at'])
+    if not SCHEDULER.reschedule(args.get('command_id'), run_at, args.get('repeat')):
+        return "failed", f"Command {args.get('command_id')} is not scheduled"
+    when = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(run_at))
+    return "done", f"Command {args['command_id']} rescheduled at {when} (local time)"
+
+
+# ------------------- Main Agent Loop -------------------
+def run_command_loop():
+    # push mode: ถือ stream ค้างไว้ ถ้าหลุดให้ถอยกลับไป poll แบบเดิมจนกว่าจะต่อใหม่ได้
+    next_push_attempt = 0
+    next_stats_log = time.time() + HTTP_STATS_LOG_INTERVAL
+    while True:
+        if time.time() >= next_stats_log:
+            next_stats_log = time.time() + HTTP_STATS_LOG_INTERVAL
+            print(f"[http] stats: {json.dumps(CLIENT.stats())}")
+        try:
+            if PUSH_ENABLED and time.time() >= next_push_attempt:
+                # ดึงคำสั่งที่ค้างอยู่ก่อนเปิด stream กันคำสั่งหล่นช่วงที่หลุด
+                for cmd in poll_pending_commands(MACHINE_ID):
+                    execute_command(cmd)
+                try:
+                    stream_pending_commands(MACHINE_ID, execute_command)
+                    print("[push] Stream closed by server, reconnecting...")
+                    next_push_attempt = time.time() + 1
+                except PushStreamError as e:
+                    print(f"[push] Stream unavailable, fallback to polling: {e}")
+                    next_push_attempt = time.time() + PUSH_RETRY_INTERVAL
+                continue
+            cmds = poll_pending_commands(MACHINE_ID)
+            execute_commands(cmds)
+            time.sleep(POLL_SCHEDULE.next(got_commands=bool(cmds), hint=CLIENT.poll_hint))
         except Exception as e:
             print("Agent error:", e)
-            time.sleep(10)
+            time.sleep(POLL_INTERVAL)
+
+def wait_machine_id():
+    global MACHINE_ID
+    attempt = 0
+    while True:
+        try:
+            MACHINE_ID = get_machine_id()
+        except requests.RequestException as e:
+            print("Get machine_id error:", e)
+            MACHINE_ID = None
+        if MACHINE_ID:
+            print(f"Agent started for machine_id={MACHINE_ID}")
+            return MACHINE_ID
+        delay = CLIENT.backoff_delay(attempt)
+        attempt += 1
+        print(f"Retry get machine_id in {delay:.1f}s...")
+        time.sleep(delay)
+
+def telemetry_push_loop():
+    while True:
+        time.sleep(TELEMETRY.interval)
+        try:
+            if time.time() - LAST_TELEMETRY_SENT >= TELEMETRY_MAX_SILENCE and TELEMETRY.pending_delta():
+                for cmd in poll_pending_commands(MACHINE_ID):
+                    execute_command(cmd)
+        except Exception as e:
+            print(f"[telemetry] Safety poll failed: {e}")
+
+def start_command_loop():
+    # เริ่มรับคำสั่งทันทีที่รู้ machine_id ไม่ต้องรอ AnyDesk
+    OUTBOX_FLUSHER.start()
+    if TELEMETRY:
+        TELEMETRY.start()
+        if PUSH_ENABLED:
+            threading.Thread(target=telemetry_push_loop, name="telemetry-push", daemon=True).start()
+    if glob.glob(os.path.join(COLLECT_DIR, '*.json')):
+        threading.Thread(target=resume_collect_uploads, name="collect-resume", daemon=True).start()
+    thread = threading.Thread(target=run_command_loop, name="command-loop", daemon=True)
+    thread.start()
+    return thread
+
+def discover_anydesk_id():
+    wait_anydesk_ready()
+    return get_anydesk_id()
+
+def main():
+    if METRICS_CONFIG.get('enabled', True):
+        try:
+            start_metrics_server(METRICS, '127.0.0.1', METRICS_CONFIG.get('port', 9108))
+        except OSError as e:
+            print(f"[metrics] Cannot start metrics endpoint: {e}")
+    print(f"[startup] Agent version {AGENT_VERSION}")
+    if GATEWAY:
+        GATEWAY.start(GATEWAY_CONFIG.get('listen', '0.0.0.0'), GATEWAY_CONFIG.get('port', 8765))
+    # startup เป็น pipeline: phase ที่ไม่ขึ้นต่อกันรันพร้อมกัน, AnyDesk ไม่บล็อกการรับคำสั่ง
+    pipeline = StartupPipeline(max_workers=6, t0=AGENT_START)
+    pipeline.record("config", _config_started, CONFIG_LOAD_SECONDS)
+    pipeline.add("jitter", lambda: time.sleep(random.uniform(0, STARTUP_JITTER)))
+    pipeline.add("machine_id", wait_machine_id, deps=["jitter"])
+    # timer ของคำสั่งตั้งเวลาเริ่มทันที ไม่ต้องรอ server (เปิดเครื่องมาตอนเน็ตล่มก็ยังยิงตรงเวลา)
+    pipeline.add("schedule", SCHEDULER.start)
+    pipeline.add("command_loop", start_command_loop, deps=["machine_id"])
+    pipeline.add("update_confirm", confirm_update, deps=["command_loop"])
+    # --- Auto install AnyDesk ทันทีหลัง setup ---
+    pipeline.add("anydesk_install", install_anydesk)
+    pipeline.add("anydesk_password", lambda: set_anydesk_password("123456"), deps=["anydesk_install"])
+    pipeline.add("anydesk_id", discover_anydesk_id, deps=["anydesk_password"])
+    pipeline.add("report_remote", lambda: report_remote(MACHINE_ID, pipeline.results["anydesk_id"], None),
+                 deps=["anydesk_id", "machine_id"])
+    results = pipeline.run()
+    if "report_remote" in results:
+        print(f"AnyDesk auto-installed and reported: {results['anydesk_id']}")
+    startup = pipeline.report()
+    print(f"[startup] finished in {startup['total']:.1f}s: {json.dumps(startup['phases'])}")
+    try:
+        resp = CLIENT.report_startup(MACHINE_ID, startup)
+        if not resp.ok:
+            print(f"[startup] Report startup timings not accepted: HTTP {resp.status_code} {resp.text[:200]}")
+    except requests.RequestException as e:
+        print(f"[startup] Report startup timings failed: {e}")
+    # Main loop
+    results["command_loop"].join()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,323 @@
+import gzip
+import json
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# HTTP client กลางของ agent: ใช้ session เดียว (keep-alive + connection pool)
+# มี timeout ทุก call, retry แบบ exponential backoff + jitter, gzip body และเก็บสถิติราย endpoint
+
+DEFAULT_TIMEOUT = (5, 15)  # (connect, read) วินาที
+RETRY_STATUS = (429, 500, 502, 503, 504)
+# server ที่ไม่ถอด Content-Encoding ของ request มักตอบแบบนี้ (FastAPI: 422 JSON decode error)
+GZIP_REJECT_STATUS = (400, 415, 422, 500)
+
+
+def is_permanent_rejection(status_code):
+    # 4xx = server ไม่มีวันรับ request นี้ (เช่นคำสั่งถูกลบไปแล้ว, body ผิด) ส่งซ้ำไม่มีประโยชน์
+    # ยกเว้น 401/403 (key ผิด แก้ config แล้วส่งได้), 408/429 (ชั่วคราว)
+    return 400 <= status_code < 500 and status_code not in (401, 403, 408, 429)
+TELEMETRY_HEADER = 'X-Agent-Telemetry'
+POLL_HINT_HEADER = 'X-Poll-Interval'  # server บอกว่าอยาก poll รอบหน้าในกี่วินาที
+FALLBACK_PERIOD = 300
+
+
+class PushStreamError(Exception):
+    pass
+
+
+class AdaptivePollInterval:
+    # ระยะห่างระหว่าง poll แบบปรับตัว:
+    # - มีคำสั่งเข้ามา -> poll ถี่ (min_interval) ต่ออีก active_period วินาที เผื่อคำสั่งตามมาติดๆ
+    # - ว่างต่อเนื่อง -> ค่อยๆ ยืดจาก base ทีละ growth เท่า จนถึง max_interval
+    # - server ส่ง hint มา -> ใช้ค่านั้น (บีบให้อยู่ในช่วง min..max)
+    def __init__(self, base=10, min_interval=2, max_interval=30, growth=1.5, active_period=30, jitter=0.1):
+        self.base = base
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, base)
+        self.growth = growth
+        self.active_period = active_period
+        self.jitter = jitter
+        self.current = base
+        self._last_activity = 0
+
+    def next(self, got_commands=False, hint=None):
+        now = time.monotonic()
+        if got_commands:
+            self._last_activity = now
+        if hint:
+            self.current = min(self.max_interval, max(self.min_interval, hint))
+        elif now - self._last_activity < self.active_period:
+            self.current = self.min_interval
+        elif self.current < self.base:
+            self.current = self.base
+        else:
+            self.current = min(self.max_interval, self.current * self.growth)
+        # สุ่ม +-jitter กันทั้งห้อง poll ตรงจังหวะเดียวกัน
+        return self.current * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+class AgentClient:
+    def __init__(self, api_url, api_key=None, timeout=DEFAULT_TIMEOUT, retries=3,
+                 backoff_base=1.0, backoff_max=60.0, gzip_min_size=None, pool_size=4, fallback_url=None):
+        self.api_url = api_url.rstrip('/')
+        # fallback_url: ถ้าต่อ api_url ไม่ได้ (เช่น gateway ใน LAN ดับ) ให้ยิงตรงไปที่นี่ชั่วคราว
+        self.fallback_url = fallback_url.rstrip('/') if fallback_url else None
+        self._fallback_until = 0
+        self.api_key = api_key
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.gzip_min_size = gzip_min_size  # None = ไม่บีบอัด body (ค่าเริ่มต้น เปิดเมื่อรู้ว่า server รับ gzip)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.batch_results_supported = True
+        self.poll_hint = None
+        self._poll_etags = {}  # machine_id -> ETag ของคิวคำสั่งล่าสุดที่เห็น
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+
+    # ------------------- transport -------------------
+    def backoff_delay(self, attempt):
+        # full jitter: สุ่ม 0..min(max, base*2^attempt) กันเครื่องทั้งห้องยิงพร้อมกันหลังไฟดับ
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def _record(self, endpoint, elapsed, error):
+        with self._stats_lock:
+            st = self._stats.setdefault(endpoint, {"count": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0})
+            st["count"] += 1
+            st["total_ms"] += elapsed * 1000
+            st["max_ms"] = max(st["max_ms"], elapsed * 1000)
+            if error:
+                st["errors"] += 1
+
+    def stats(self):
+        with self._stats_lock:
+            out = {}
+            for endpoint, st in self._stats.items():
+                out[endpoint] = dict(st, avg_ms=round(st["total_ms"] / st["count"], 1) if st["count"] else 0.0)
+            return out
+
+    def _encode_body(self, payload, headers):
+        body = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+        headers['Content-Type'] = 'application/json'
+        if self.gzip_min_size is not None and len(body) >= self.gzip_min_size:
+            headers['Content-Encoding'] = 'gzip'
+            body = gzip.compress(body, compresslevel=5)
+        return body
+
+    def request(self, method, endpoint, params=None, json_body=None, headers=None,
+                timeout=None, retries=None, stream=False, data=None):
+        # data: body แบบ bytes ส่งตรงๆ (ผู้เรียกตั้ง Content-Type/Content-Encoding เอง) ใช้แทน json_body
+        hdrs = {}
+        if self.api_key:
+            hdrs['X-AGENT-KEY'] = self.api_key
+        if headers:
+            hdrs.update(headers)
+        if json_body is not None:
+            data = self._encode_body(json_body, hdrs)
+        retries = self.retries if retries is None else retries
+        attempt = 0
+        while True:
+            use_fallback = self.fallback_url and time.time() < self._fallback_until
+            url = (self.fallback_url if use_fallback else self.api_url) + endpoint
+            start = time.monotonic()
+            try:
+                resp = self.session.request(method, url, params=params, data=data, headers=hdrs,
+                                            timeout=timeout or self.timeout, stream=stream)
+            except requests.RequestException as e:
+                self._record(endpoint, time.monotonic() - start, True)
+                if self.fallback_url and not use_fallback and isinstance(e, requests.ConnectionError):
+                    print(f"[http] {self.api_url} unreachable, using {self.fallback_url} for {FALLBACK_PERIOD}s")
+                    self._fallback_until = time.time() + FALLBACK_PERIOD
+                    continue
+                if attempt >= retries:
+                    raise
+                error = e
+            else:
+                self._record(endpoint, time.monotonic() - start, resp.status_code >= 400)
+                if (resp.status_code in GZIP_REJECT_STATUS and hdrs.get('Content-Encoding') == 'gzip'
+                        and json_body is not None):
+                    # server ไม่รับ gzip body: ปิด gzip แล้วส่งใหม่แบบธรรมดา
+                    print(f"[http] {endpoint} rejected gzip body (HTTP {resp.status_code}), disable request compression")
+                    self.gzip_min_size = None
+                    hdrs.pop('Content-Encoding')
+                    data = self._encode_body(json_body, hdrs)
+                    continue
+                if resp.status_code not in RETRY_STATUS or attempt >= retries:
+                    return resp
+                error = f"HTTP {resp.status_code}"
+                retry_after = resp.headers.get('Retry-After')
+                resp.close()
+                if retry_after and retry_after.isdigit():
+                    time.sleep(min(int(retry_after), self.backoff_max))
+                    attempt += 1
+                    continue
+            delay = self.backoff_delay(attempt)
+            print(f"[http] {method} {endpoint} failed ({error}), retry in {delay:.1f}s")
+            time.sleep(delay)
+            attempt += 1
+
+    # ------------------- agent API -------------------
+    def register(self, set_id, machine_name):
+        return self.request('POST', '/machine/register', json_body={
+            'set_id': set_id,
+            'machine_name': machine_name
+        })
+
+    def get_machine_id(self, machine_name):
+        resp = self.request('GET', '/machine/config', params={'name': machine_name})
+        if resp.status_code == 200:
+            return resp.json()['machine_id']
+        print('Get machine_id failed:', resp.text)
+        return None
+
+    def poll_pending_commands(self, machine_id, telemetry=None, on_accepted=None):
+        # telemetry: ข้อมูลสุขภาพเครื่อง (JSON สั้นๆ) แนบไปใน header ของ poll เดิม
+        # on_accepted(): เรียกเมื่อ server ตอบ 200/304 (ใช้ mark ว่า telemetry ส่งถึงแล้ว)
+        # conditional poll: ส่ง If-None-Match ถ้าคิวไม่เปลี่ยน server ตอบ 304 ไม่มี body
+        headers = {}
+        if telemetry:
+            headers[TELEMETRY_HEADER] = telemetry
+        etag = self._poll_etags.get(machine_id)
+        if etag:
+            headers['If-None-Match'] = etag
+        resp = self.request('GET', '/machine/command/pending', params={'machine_id': machine_id},
+                            headers=headers, retries=0)
+        try:
+            self.poll_hint = float(resp.headers.get(POLL_HINT_HEADER) or 0) or None
+        except ValueError:
+            self.poll_hint = None
+        if resp.status_code == 304:
+            if on_accepted:
+                on_accepted()
+            return []
+        if resp.status_code == 200:
+            if resp.headers.get('ETag'):
+                self._poll_etags[machine_id] = resp.headers['ETag']
+            else:
+                self._poll_etags.pop(machine_id, None)
+            if on_accepted:
+                on_accepted()
+            return resp.json()
+        return []
+
+    def report_command_result(self, machine_id, command_id, status, result=None):
+        data = {"command_id": command_id, "status": status, "result": result}
+        return self.request('POST', '/machine/command/result', params={'machine_id': machine_id}, json_body=data)
+
+    def report_command_results(self, items):
+        # ส่งผลลัพธ์หลายรายการในครั้งเดียว (item มี seq, machine_id, command_id, status, result)
+        # คืน (seq ที่ server รับแล้ว, {seq: เหตุผล} ที่ server ปฏิเสธถาวร)
+        # ถ้า server ไม่มี batch endpoint หรือปฏิเสธทั้ง batch จะส่งทีละรายการแทน (แยกตัวที่เสียออกมา)
+        done, rejected = [], {}
+        by_machine = {}
+        for item in items:
+            by_machine.setdefault(item['machine_id'], []).append(item)
+        try:
+            self._send_result_groups(by_machine, done, rejected)
+        except Exception:
+            if not done and not rejected:
+                raise
+        return done, rejected
+
+    def _send_result_groups(self, by_machine, done, rejected):
+        for machine_id, group in by_machine.items():
+            if self.batch_results_supported:
+                results = [{"command_id": i['command_id'], "status": i['status'], "result": i['result']} for i in group]
+                resp = self.request('POST', '/machine/command/result/batch', params={'machine_id': machine_id},
+                                    json_body={"results": results})
+                if resp.status_code == 200:
+                    done.extend(i['seq'] for i in group)
+                    continue
+                if resp.status_code in (404, 405):
+                    print("[http] Server has no batch result endpoint, sending results one by one")
+                    self.batch_results_supported = False
+                elif not is_permanent_rejection(resp.status_code):
+                    raise Exception(f"batch result upload failed: HTTP {resp.status_code}")
+            for i in group:
+                resp = self.report_command_result(machine_id, i['command_id'], i['status'], i['result'])
+                if resp.status_code == 200:
+                    done.append(i['seq'])
+                elif is_permanent_rejection(resp.status_code):
+                    rejected[i['seq']] = f"HTTP {resp.status_code}: {resp.text[:200]}"
+                else:
+                    raise Exception(f"result upload failed: HTTP {resp.status_code}")
+
+    def report_command_output(self, machine_id, command_id, seq, stream, data, final=False):
+        # output ระหว่างรันคำสั่ง 1 ชิ้น: body = gzip ของ bytes ดิบ, seq เรียงลำดับ/กันซ้ำฝั่ง server
+        resp = self.request('POST', '/machine/command/output',
+                            params={'machine_id': machine_id, 'command_id': command_id, 'seq': seq,
+                                    'stream': stream, 'final': int(final)},
+                            headers={'Content-Type': 'application/octet-stream', 'Content-Encoding': 'gzip'},
+                            data=gzip.compress(data, compresslevel=6))
+        if resp.status_code >= 400:
+            raise requests.HTTPError(f"HTTP {resp.status_code}", response=resp)
+        return resp
+
+    def get_upload_offset(self, machine_id, command_id):
+        # server ได้ไฟล์ของคำสั่งนี้ไปแล้วกี่ byte (ใช้ส่งต่อหลังหลุด)
+        resp = self.request('GET', '/machine/command/upload', params={'machine_id': machine_id, 'command_id': command_id})
+        resp.raise_for_status()
+        return resp.json()['offset']
+
+    def upload_chunk(self, machine_id, command_id, offset, total, sha256, data):
+        # ส่งไฟล์ 1 ชิ้นที่ตำแหน่ง offset คืน offset ถัดไปที่ server ต้องการ
+        # (409 = offset ไม่ตรงกับที่ server มี server จะบอก offset ที่ถูกมาให้)
+        resp = self.request('POST', '/machine/command/upload',
+                            params={'machine_id': machine_id, 'command_id': command_id, 'offset': offset,
+                                    'total': total, 'sha256': sha256},
+                            headers={'Content-Type': 'application/octet-stream'}, data=data)
+        if resp.status_code in (200, 409):
+            return resp.json()['offset']
+        resp.raise_for_status()
+        raise requests.HTTPError(f"HTTP {resp.status_code}", response=resp)
+
+    def report_remote(self, machine_id, anydesk_id, rustdesk_id):
+        data = {"machine_id": machine_id, "anydesk_id": anydesk_id, "rustdesk_id": rustdesk_id}
+        return self.request('POST', '/machine/report_remote', params={'machine_id': machine_id}, json_body=data)
+
+    def report_startup(self, machine_id, startup):
+        # เวลาแต่ละ phase ตอนเริ่ม agent (server เก่าที่ไม่มี endpoint นี้ตอบ 404: ผู้เรียก log ไว้)
+        return self.request('POST', '/machine/startup_report', params={'machine_id': machine_id}, json_body=startup)
+
+    def stream_pending_commands(self, machine_id, on_command, read_timeout=90, telemetry=None, on_accepted=None):
+        # เปิด SSE stream ค้างไว้ รันคำสั่งทันทีที่ server ส่งมา
+        # คืนค่าเมื่อ server ปิด stream, raise PushStreamError ถ้าต่อไม่ติด/หลุดกลางทาง
+        headers = {'Accept': 'text/event-stream'}
+        if telemetry:
+            headers[TELEMETRY_HEADER] = telemetry
+        try:
+            resp = self.request('GET', '/machine/command/stream', params={'machine_id': machine_id},
+                                headers=headers, timeout=(self.timeout[0], read_timeout),
+                                retries=0, stream=True)
+        except requests.RequestException as e:
+            raise PushStreamError(e)
+        with resp:
+            if resp.status_code != 200:
+                raise PushStreamError(f"HTTP {resp.status_code}")
+            if on_accepted:
+                on_accepted()
+            print(f"[push] Command stream connected for machine_id={machine_id}")
+            data_lines = []
+            try:
+                for line in resp.iter_lines(chunk_size=1, decode_unicode=True):
+                    if line is None or line.startswith(":"):
+                        continue  # heartbeat
+                    if line.startswith("data:"):
+                        data_lines.append(line[5:].strip())
+                        continue
+                    if line == "" and data_lines:
+                        payload = json.loads("\n".join(data_lines))
+                        data_lines = []
+                        cmds = payload if isinstance(payload, list) else [payload]
+                        for cmd in cmds:
+                            on_command(cmd)
+            except (requests.RequestException, ValueError) as e:
+                raise PushStreamError(e)
@@ -0,0 +1,165 @@
+import glob
+import hashlib
+import io
+import json
+import os
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+
+import requests
+
+from agent_client import is_permanent_rejection
+
+# เก็บ log/ไฟล์จากเครื่องส่งขึ้น server ตามสั่ง (คำสั่ง "collect")
+# - เลือกไฟล์จาก path/glob กรองด้วย mtime (since) และตัดเอาเฉพาะช่วง byte (tail_bytes / range) ของแต่ละไฟล์
+# - Windows event log export ด้วย wevtutil แล้วใส่ archive ด้วย
+# - แพ็คเป็น tar.gz ลง spool บนดิสก์ก่อน แล้วอัปโหลดทีละ chunk ขนาดคงที่พร้อม offset
+#   หลุดกลางทาง (เน็ตหลุด/agent restart) ถาม offset จาก server แล้วส่งต่อจากตรงนั้น
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+MAX_FILES = 2000
+
+
+class CollectError(Exception):
+    pass
+
+
+def select_files(patterns, since=None):
+    # คืน path ของไฟล์ที่ตรงกับ pattern (ไม่ซ้ำ เรียงตามชื่อ) กรองเฉพาะที่แก้ไขหลัง since (epoch)
+    files = set()
+    for pattern in patterns:
+        pattern = os.path.expandvars(os.path.expanduser(pattern))
+        for path in glob.glob(pattern, recursive=True):
+            if os.path.isfile(path):
+                files.add(os.path.abspath(path))
+            elif os.path.isdir(path):
+                for root, _, names in os.walk(path):
+                    files.update(os.path.join(root, name) for name in names)
+    if since:
+        files = {p for p in files if os.path.getmtime(p) >= since}
+    if len(files) > MAX_FILES:
+        raise CollectError(f"{len(files)} files matched, limit is {MAX_FILES}; narrow the patterns")
+    return sorted(files)
+
+
+def _slice(size, tail_bytes=None, byte_range=None):
+    # คืน (start, length) ของส่วนที่ต้องการในไฟล์ขนาด size
+    start, end = 0, size
+    if byte_range:
+        start, end = byte_range[0], byte_range[1] if byte_range[1] is not None else size
+        if start < 0:
+            start = max(0, size + start)
+        end = min(end, size)
+    if tail_bytes:
+        start = max(start, end - tail_bytes)
+    return start, max(0, end - start)
+
+
+class _LimitedReader(io.RawIOBase):
+    # อ่านแค่ length byte จาก offset (log ที่กำลังโตอยู่จะได้ขนาดตรงกับ TarInfo)
+    def __init__(self, f, length):
+        self.f = f
+        self.remaining = length
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.remaining <= 0:
+            return 0
+        data = self.f.read(min(len(buffer), self.remaining))
+        buffer[:len(data)] = data
+        self.remaining -= len(data)
+        return len(data)
+
+
+def _export_event_logs(names, since, tmp_dir):
+    # export Windows event log (System, Application, ...) เป็น .evtx ด้วย wevtutil
+    exported, errors = [], []
+    for name in names:
+        dest = os.path.join(tmp_dir, f"{name.replace('/', '_')}.evtx")
+        cmd = ["wevtutil", "epl", name, dest]
+        if since:
+            age_ms = int(max(0, time.time() - since) * 1000)
+            cmd.append(f"/q:*[System[TimeCreated[timediff(@SystemTime) <= {age_ms}]]]")
+        try:
+            subprocess.run(cmd, check=True, timeout=300, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            exported.append(dest)
+        except Exception as e:
+            errors.append({"path": f"eventlog:{name}", "error": str(e)})
+    return exported, errors
+
+
+def build_archive(dest, paths=(), event_logs=(), since=None, tail_bytes=None, byte_range=None):
+    # เขียน tar.gz ลง dest คืน summary {"files", "errors", "size", "sha256"}
+    included, errors = [], []
+    with tempfile.TemporaryDirectory(prefix="ddc_collect_") as tmp_dir:
+        files = select_files(paths, since)
+        if event_logs and sys.platform == 'win32':
+            exported, export_errors = _export_event_logs(event_logs, since, tmp_dir)
+            files += exported
+            errors += export_errors
+        with tarfile.open(dest, "w:gz", compresslevel=6) as tar:
+            for path in files:
+                try:
+                    with open(path, 'rb') as f:
+                        size = os.fstat(f.fileno()).st_size
+                        start, length = _slice(size, tail_bytes, byte_range)
+                        f.seek(start)
+                        info = tarfile.TarInfo(os.path.splitdrive(path)[1].lstrip('\\/').replace('\\', '/'))
+                        info.size = length
+                        info.mtime = int(os.path.getmtime(path))
+                        tar.addfile(info, io.BufferedReader(_LimitedReader(f, length)))
+                    included.append({"path": path, "size": size, "offset": start, "length": length})
+                except OSError as e:
+                    errors.append({"path": path, "error": str(e)})  # เช่นไฟล์ถูก lock
+            manifest = json.dumps({"files": included, "errors": errors, "created_at": time.time()}, indent=2).encode()
+            info = tarfile.TarInfo("collect.json")
+            info.size = len(manifest)
+            tar.addfile(info, io.BytesIO(manifest))
+    hasher = hashlib.sha256()
+    with open(dest, 'rb') as f:
+        for block in iter(lambda: f.read(DEFAULT_CHUNK_SIZE), b''):
+            hasher.update(block)
+    return {"files": len(included), "errors": errors, "size": os.path.getsize(dest), "sha256": hasher.hexdigest()}
+
+
+def upload_archive(client, machine_id, command_id, path, sha256, chunk_size=DEFAULT_CHUNK_SIZE,
+                   deadline=None, retry_delay=None):
+    # ส่งไฟล์ทีละ chunk เริ่มจาก offset ที่ server มีแล้ว คืนจำนวน byte ที่ส่งรอบนี้
+    total = os.path.getsize(path)
+    retry_delay = retry_delay or (lambda attempt: min(60, 2 ** attempt))
+    sent = 0
+    attempt = 0
+    with open(path, 'rb') as f:
+        offset = None
+        while True:
+            try:
+                if offset is None:
+                    offset = client.get_upload_offset(machine_id, command_id)
+                    if offset:
+                        print(f"[collect] Resuming upload of command {command_id} at {offset}/{total} bytes")
+                if offset >= total:
+                    return sent
+                f.seek(offset)
+                data = f.read(chunk_size)
+                new_offset = client.upload_chunk(machine_id, command_id, offset, total, sha256, data)
+                if new_offset == offset + len(data):
+                    sent += len(data)
+                offset = new_offset
+                attempt = 0
+            except requests.RequestException as e:
+                response = getattr(e, 'response', None)
+                if response is not None and is_permanent_rejection(response.status_code):
+                    # server ไม่มี endpoint นี้/ไม่รับไฟล์ ลองซ้ำก็ไม่ผ่าน
+                    raise CollectError(f"upload rejected at {offset}/{total} bytes: HTTP {response.status_code}")
+                if deadline and time.time() >= deadline:
+                    raise CollectError(f"upload stopped at {offset}/{total} bytes: {e}")
+                delay = retry_delay(attempt)
+                attempt += 1
+                print(f"[collect] Upload failed ({e}), retry in {delay:.1f}s")
+                time.sleep(delay)
+                offset = None  # ถาม server ใหม่ว่าได้ถึงไหนแล้ว
@@ -0,0 +1,214 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+# registry ของคำสั่ง + worker pool
+# handler แต่ละตัวมี timeout และ concurrency class ของตัวเอง:
+#   parallel  - รันพร้อมคำสั่งอื่นได้ (เช่น query อ่านอย่างเดียว)
+#   exclusive - ต้องรันคนเดียว รอคำสั่งที่กำลังรันอยู่จบก่อน (เช่น reinstall/shutdown)
+#   background - งานยาว (exec/collect/diagnose) รันใน pool แยก ไม่ถือ lock ร่วม และ poll loop ไม่รอ
+#               exclusive ที่เริ่มรันจะสั่งยกเลิกงาน background ก่อน (handler ที่เช็ค cancel_event หยุดได้)
+
+PARALLEL = "parallel"
+EXCLUSIVE = "exclusive"
+BACKGROUND = "background"
+
+
+class CommandHandler:
+    def __init__(self, name, func, timeout, concurrency, max_concurrent=None):
+        self.name = name
+        self.func = func
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.slots = threading.BoundedSemaphore(max_concurrent) if max_concurrent else None
+
+
+class CommandRegistry:
+    def __init__(self):
+        self.handlers = {}
+
+    def register(self, name, timeout=60, concurrency=PARALLEL, max_concurrent=None):
+        # ใช้เป็น decorator: @COMMANDS.register("reset", timeout=180)
+        # handler(cmd) คืน result (str/None) หรือ (status, result); raise = failed
+        def decorator(func):
+            self.handlers[name] = CommandHandler(name, func, timeout, concurrency, max_concurrent)
+            return func
+        return decorator
+
+    def get(self, name):
+        return self.handlers.get(name)
+
+
+class _ExclusiveLock:
+    # readers-writer lock: parallel = shared, exclusive = เขียนคนเดียว (exclusive ที่รออยู่ได้คิวก่อน)
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._shared = 0
+        self._exclusive = False
+        self._waiting_exclusive = 0
+
+    def acquire(self, exclusive):
+        with self._cond:
+            if exclusive:
+                self._waiting_exclusive += 1
+                while self._exclusive or self._shared:
+                    self._cond.wait()
+                self._waiting_exclusive -= 1
+                self._exclusive = True
+            else:
+                while self._exclusive or self._waiting_exclusive:
+                    self._cond.wait()
+                self._shared += 1
+
+    def release(self, exclusive):
+        with self._cond:
+            if exclusive:
+                self._exclusive = False
+            else:
+                self._shared -= 1
+            self._cond.notify_all()
+
+
+class CommandExecutor:
+    # on_result(cmd, status, result) ถูกเรียกหลังคำสั่งจบ/ล้มเหลว/timeout
+    # observe(command, status, seconds) ถ้ามี: เวลารันจริงของ handler (ไม่รวมเวลารอคิว) ใช้เก็บ metrics
+    # on_start(cmd) ถ้ามี: เรียกตอนได้ slot/lock แล้วกำลังจะรัน handler (ใช้วัดเวลารอคิว)
+    def __init__(self, registry, on_result, max_workers=4, observe=None, background_workers=8, on_start=None):
+        self.registry = registry
+        self.on_result = on_result
+        self.observe = observe
+        self.on_start = on_start
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="cmd")
+        # pool แยก: งานยาวเต็ม pool แล้ว shutdown/reboot ก็ยังได้ worker
+        self._background_pool = ThreadPoolExecutor(max_workers=background_workers, thread_name_prefix="bg")
+        self._lock = _ExclusiveLock()
+        self._inflight = set()
+        self._inflight_lock = threading.Lock()
+        self._cancel = {}  # command_id -> Event ของทุกคำสั่งที่กำลังรัน (exclusive ยกเลิกงาน background, timeout ยกเลิกตัวเอง)
+        self._background_ids = set()
+        self._background_futures = set()
+
+    def submit(self, cmd):
+        # คืน future หรือ None ถ้าคำสั่งเดียวกันกำลังรันอยู่แล้ว
+        handler = self.registry.get(cmd['command'])
+        background = handler is not None and handler.concurrency == BACKGROUND
+        with self._inflight_lock:
+            if cmd['id'] in self._inflight:
+                return None
+            self._inflight.add(cmd['id'])
+            self._cancel[cmd['id']] = threading.Event()
+            if background:
+                self._background_ids.add(cmd['id'])
+        if not background:
+            return self._pool.submit(self._supervise, cmd)
+        future = self._background_pool.submit(self._supervise, cmd)
+        with self._inflight_lock:
+            self._background_futures.add(future)
+        future.add_done_callback(self._forget_background)
+        return future
+
+    def _forget_background(self, future):
+        with self._inflight_lock:
+            self._background_futures.discard(future)
+
+    def cancel_event(self, command_id):
+        # Event ที่ handler เช็คเพื่อหยุดกลางทาง (ถูก set เมื่อ timeout หรือ exclusive มาแทรกงาน background)
+        with self._inflight_lock:
+            return self._cancel.get(command_id)
+
+    def cancel_background(self, reason):
+        with self._inflight_lock:
+            events = [(command_id, self._cancel[command_id]) for command_id in self._background_ids]
+        for command_id, event in events:
+            if not event.is_set():
+                print(f"[command] Cancelling background command {command_id}: {reason}")
+                event.set()
+        return len(events)
+
+    def is_running(self, command_id):
+        with self._inflight_lock:
+            return command_id in self._inflight
+
+    def wait(self, futures):
+        # รอทั้งชุดให้จบ: ใช้เวลาเท่าคำสั่งที่ช้าที่สุด ไม่ใช่ผลรวม (ข้าม None ที่ submit ไม่ผ่าน และงาน background)
+        with self._inflight_lock:
+            futures = [f for f in futures if f and f not in self._background_futures]
+        wait(futures)
+
+    def _supervise(self, cmd):
+        status, result = "failed", None
+        reported = False
+        try:
+            handler = self.registry.get(cmd['command'])
+            if handler is None:
+                status, result = "failed", "Unknown command"
+                return
+            exclusive = handler.concurrency == EXCLUSIVE
+            shared = handler.concurrency != BACKGROUND
+            if exclusive:
+                self.cancel_background(f"preempted by {handler.name} (id={cmd['id']})")
+            if handler.slots:
+                handler.slots.acquire()
+            cancel = self.cancel_event(cmd['id'])
+            if cancel is not None and cancel.is_set():
+                # ถูกยกเลิกระหว่างรอ slot ไม่ต้องเริ่มรัน
+                if handler.slots:
+                    handler.slots.release()
+                status, result = "cancelled", "Cancelled before start by an exclusive command"
+                return
+            if shared:
+                self._lock.acquire(exclusive)
+            start = time.monotonic()
+            worker = None
+            try:
+                if self.on_start:
+                    self.on_start(cmd)
+                status, result, worker = self._run_with_timeout(handler, cmd)
+            finally:
+                if self.observe:
+                    self.observe(handler.name, status, time.monotonic() - start)
+                if worker is not None and worker.is_alive():
+                    # timeout: ส่งผลไปก่อน แต่ถือ lock/slot ไว้จน handler จบจริง
+                    # ไม่งั้น exclusive (reinstall/update) หรือ slot เดียว (reset) จะซ้อนกับคำสั่งถัดไป
+                    self.on_result(cmd, status, result)
+                    reported = True
+                    worker.join()
+                    print(f"[command] {handler.name} (id={cmd['id']}) exited {time.monotonic() - start:.1f}s after start, "
+                          f"releasing its lock")
+                if shared:
+                    self._lock.release(exclusive)
+                if handler.slots:
+                    handler.slots.release()
+        except Exception as e:
+            status, result = "failed", f"Executor error: {e}"
+        finally:
+            with self._inflight_lock:
+                self._inflight.discard(cmd['id'])
+                self._cancel.pop(cmd['id'], None)
+                self._background_ids.discard(cmd['id'])
+            if not reported:
+                self.on_result(cmd, status, result)
+
+    def _run_with_timeout(self, handler, cmd):
+        outcome = {}
+
+        def target():
+            try:
+                ret = handler.func(cmd)
+                outcome['value'] = ret if isinstance(ret, tuple) else ("done", ret)
+            except Exception as e:
+                outcome['value'] = ("failed", f"{type(e).__name__}: {e}")
+
+        start = time.monotonic()
+        worker = threading.Thread(target=target, name=f"cmd-{handler.name}-{cmd['id']}", daemon=True)
+        worker.start()
+        worker.join(handler.timeout)
+        if worker.is_alive():
+            # thread ฆ่าไม่ได้: บอก handler ให้หยุด (cancel_event) แล้วรายงาน timeout ผู้เรียกรอ worker จบเองก่อนคืน lock
+            print(f"[command] {handler.name} (id={cmd['id']}) timed out after {handler.timeout}s")
+            event = self.cancel_event(cmd['id'])
+            if event is not None:
+                event.set()
+            return "failed", f"Timeout after {handler.timeout}s", worker
+        print(f"[command] {handler.name} (id={cmd['id']}) finished in {time.monotonic() - start:.1f}s")
+        return outcome['value'] + (worker,)
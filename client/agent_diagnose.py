@@ -0,0 +1,123 @@
+import collections
+import gc
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+# วินิจฉัย agent ที่รันอยู่ (คำสั่ง "diagnose") แบบมีกรอบเวลา ไม่ต้อง attach debugger
+# - profile: สุ่ม stack ของทุก thread ทุก sample_interval วินาที (cProfile เห็นแค่ thread ตัวเอง
+#   แต่ปัญหาอยู่ใน poll loop / logging / AnyDesk helper ที่เป็น thread อื่น) นับ self และ cumulative
+# - memory: tracemalloc snapshot ตอนเริ่ม/จบ window เทียบกันหา allocation site ที่โตขึ้น
+# - thread stacks + สถิติ GC ณ ตอนนั้น
+# ผลลัพธ์เป็น dict เล็กๆ (top-N) ส่งกลับทาง command result ได้เลย
+
+MAX_DURATION = 300
+# ไม่นับ allocation ของ tracemalloc เองและของ import system
+SNAPSHOT_FILTERS = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+]
+
+
+def _where(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{frame.f_lineno} {code.co_name}"
+
+
+def thread_stacks(limit=15):
+    names = {t.ident: t.name for t in threading.enumerate()}
+    stacks = {}
+    for ident, frame in sys._current_frames().items():
+        lines = []
+        while frame is not None and len(lines) < limit:
+            lines.append(_where(frame))
+            frame = frame.f_back
+        stacks[f"{names.get(ident, 'unknown')} ({ident})"] = lines
+    return stacks
+
+
+def gc_summary(top_types=10):
+    counts = collections.Counter(type(o).__name__ for o in gc.get_objects())
+    return {
+        "counts": gc.get_count(),
+        "thresholds": gc.get_threshold(),
+        "generations": gc.get_stats(),
+        "garbage": len(gc.garbage),
+        "objects": sum(counts.values()),
+        "top_types": counts.most_common(top_types),
+    }
+
+
+def _function_key(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_firstlineno} {code.co_name}"
+
+
+def sample_profile(duration, sample_interval=0.01, top=20):
+    # sampling profiler ของทุก thread (ยกเว้นตัวเอง) คืน top function ตาม self / cumulative samples
+    # นับแบบ wall-clock: thread ที่รอ I/O/sleep อยู่ก็ถูกนับที่จุดที่รอ
+    own = threading.get_ident()
+    self_counts = collections.Counter()
+    cumulative = collections.Counter()
+    samples = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            self_counts[_function_key(frame)] += 1
+            seen = set()
+            while frame is not None:
+                key = _function_key(frame)
+                if key not in seen:
+                    seen.add(key)
+                    cumulative[key] += 1
+                frame = frame.f_back
+        samples += 1
+        time.sleep(sample_interval)
+    return {
+        "samples": samples,
+        "interval": sample_interval,
+        "self": self_counts.most_common(top),
+        "cumulative": cumulative.most_common(top),
+    }
+
+
+def diagnose(duration=10, profile=True, memory=True, top=20, sample_interval=0.01):
+    duration = max(0, min(duration, MAX_DURATION))
+    report = {"duration": duration, "pid": os.getpid(), "threads": threading.active_count()}
+    started_tracing = False
+    if memory:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(5)
+            started_tracing = True
+        before = tracemalloc.take_snapshot().filter_traces(SNAPSHOT_FILTERS)
+    try:
+        if profile:
+            report["profile"] = sample_profile(duration, sample_interval, top)
+        else:
+            time.sleep(duration)
+        if memory:
+            after = tracemalloc.take_snapshot().filter_traces(SNAPSHOT_FILTERS)
+            current, peak = tracemalloc.get_traced_memory()
+            growth = after.compare_to(before, 'lineno')
+            report["memory"] = {
+                "traced_current": current,
+                "traced_peak": peak,
+                "growth": [{"where": str(stat.traceback[0]), "size_diff": stat.size_diff, "count_diff": stat.count_diff,
+                            "size": stat.size} for stat in growth[:top]],
+                "largest": [{"where": str(stat.traceback[0]), "size": stat.size, "count": stat.count}
+                            for stat in after.statistics('lineno')[:top]],
+            }
+            if started_tracing:
+                # เพิ่งเริ่ม trace ตอนนี้: growth คือ allocation ใน window นี้เท่านั้น
+                report["memory"]["note"] = "tracemalloc started for this window only"
+    finally:
+        if started_tracing:
+            tracemalloc.stop()
+    report["stacks"] = thread_stacks()
+    report["gc"] = gc_summary()
+    return report
@@ -0,0 +1,172 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+import requests
+
+# cache ไฟล์ติดตั้ง (AnyDesk, Python ฯลฯ) แบบ content-addressed: cache_dir/<sha256>
+# - ดาวน์โหลดต่อจากเดิมได้ด้วย HTTP Range (.part ไม่ถูกลบทิ้ง) + If-Range กับ ETag/Last-Modified ที่เก็บไว้คู่ .part
+#   ไฟล์ไม่รู้ hash ที่ไม่มี validator ไม่ต่อ (กันต่อไฟล์คนละ build เข้าด้วยกัน) เริ่มใหม่ทั้งไฟล์
+# - ตรวจ sha256 ถ้ารู้ค่า, ไม่งั้นอย่างน้อยเช็คขนาดขั้นต่ำ
+# - ลองดึงจาก peer ใน LAN (gateway หรือ cache server) ก่อนออก internet: จ่าย bandwidth ครั้งเดียวต่อสาขา
+#   เฉพาะไฟล์ที่รู้ sha256 เท่านั้น ไม่งั้นเครื่องไหนใน LAN ก็ปลอมไฟล์ติดตั้ง (ที่ถูกรันด้วยสิทธิ์ admin) ได้
+
+CHUNK_SIZE = 1024 * 1024
+URL_INDEX_MAX_AGE = 24 * 3600  # artifact ที่ไม่รู้ hash (เช่น AnyDesk ล่าสุด) ใช้ของใน cache ได้ไม่เกินนี้
+
+
+class DownloadError(Exception):
+    pass
+
+
+def file_sha256(path):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(CHUNK_SIZE), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+class ContentCache:
+    def __init__(self, cache_dir, peers=(), timeout=(10, 60)):
+        self.cache_dir = cache_dir
+        self.peers = [p.rstrip('/') for p in peers if p]
+        self.timeout = timeout
+        self.session = requests.Session()
+        self._lock = threading.Lock()
+        self._url_locks = {}
+        os.makedirs(cache_dir, exist_ok=True)
+        self._index_path = os.path.join(cache_dir, 'urls.json')
+
+    def path_for(self, sha256):
+        return os.path.join(self.cache_dir, sha256.lower())
+
+    # ------------------- url -> sha256 index -------------------
+    def _load_index(self):
+        try:
+            with open(self._index_path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _remember(self, url, sha256):
+        with self._lock:
+            index = self._load_index()
+            index[url] = {"sha256": sha256, "fetched_at": time.time()}
+            tmp_path = self._index_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(index, f, indent=2)
+            os.replace(tmp_path, self._index_path)
+
+    def lookup(self, url, max_age=URL_INDEX_MAX_AGE):
+        entry = self._load_index().get(url)
+        if entry and time.time() - entry["fetched_at"] < max_age and os.path.exists(self.path_for(entry["sha256"])):
+            return self.path_for(entry["sha256"])
+        return None
+
+    # ------------------- fetch -------------------
+    def fetch(self, url, sha256=None, min_size=0):
+        # คืน path ของไฟล์ใน cache (ผ่านการตรวจแล้ว)
+        with self._lock:
+            url_lock = self._url_locks.setdefault(url, threading.Lock())
+        with url_lock:
+            if sha256 and os.path.exists(self.path_for(sha256)):
+                return self.path_for(sha256)
+            if not sha256:
+                cached = self.lookup(url)
+                if cached:
+                    return cached
+            part_name = sha256.lower() if sha256 else hashlib.sha1(url.encode('utf-8')).hexdigest()
+            part_path = os.path.join(self.cache_dir, part_name + '.part')
+            if not sha256 and os.path.exists(part_path) and time.time() - os.path.getmtime(part_path) > URL_INDEX_MAX_AGE:
+                os.remove(part_path)  # .part เก่าเกิน อาจเป็นเวอร์ชันก่อน ต่อไม่ได้
+            sources = [f"{peer}/cache/{sha256.lower()}" for peer in self.peers] if sha256 else []
+            sources.append(url)
+            errors = []
+            for source in sources:
+                try:
+                    digest = self._download(source, part_path, pinned=bool(sha256))
+                    self._verify(part_path, digest, sha256, min_size)
+                except Exception as e:
+                    errors.append(f"{source}: {e}")
+                    print(f"[download] {source} failed: {e}")
+                    continue
+                final_path = self.path_for(digest)
+                os.replace(part_path, final_path)
+                self._forget_validator(part_path)
+                self._remember(url, digest)
+                print(f"[download] {url} -> {final_path}")
+                return final_path
+            raise DownloadError("; ".join(errors))
+
+    def _verify(self, part_path, digest, sha256, min_size):
+        size = os.path.getsize(part_path)
+        if sha256 and digest != sha256.lower():
+            os.remove(part_path)  # ไฟล์ผิด ต่อ Range ไม่ได้แล้ว เริ่มใหม่
+            raise DownloadError(f"sha256 mismatch: got {digest}")
+        if size < min_size:
+            os.remove(part_path)
+            raise DownloadError(f"file too small ({size} bytes), download corrupted or incomplete")
+
+    # ------------------- resume validator (ETag/Last-Modified ของ .part) -------------------
+    def _load_validator(self, part_path, source):
+        try:
+            with open(part_path + '.validator', 'r') as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return saved.get("validator") if saved.get("source") == source else None
+
+    def _save_validator(self, part_path, source, headers):
+        # If-Range ใช้ได้เฉพาะ strong ETag หรือ Last-Modified
+        etag = headers.get('ETag')
+        validator = etag if etag and not etag.startswith('W/') else headers.get('Last-Modified')
+        if not validator:
+            return self._forget_validator(part_path)
+        with open(part_path + '.validator', 'w') as f:
+            json.dump({"source": source, "validator": validator}, f)
+
+    def _forget_validator(self, part_path):
+        try:
+            os.remove(part_path + '.validator')
+        except FileNotFoundError:
+            pass
+
+    def _download(self, source, part_path, pinned=True):
+        # ดาวน์โหลดลง .part ต่อจากของเดิมถ้ามี คืน sha256 ของไฟล์ทั้งไฟล์
+        # pinned=False (ไม่รู้ hash): ต่อได้เฉพาะเมื่อมี validator ให้ server ยืนยันว่ายังเป็นไฟล์เดิม
+        hasher = hashlib.sha256()
+        offset = 0
+        validator = self._load_validator(part_path, source)
+        if os.path.exists(part_path) and not pinned and not validator:
+            print(f"[download] {part_path} has no validator for {source}, restarting from 0")
+            os.remove(part_path)
+        if os.path.exists(part_path):
+            with open(part_path, 'rb') as f:
+                for block in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    hasher.update(block)
+                    offset += len(block)
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+        if offset and validator:
+            headers['If-Range'] = validator
+        with self.session.get(source, headers=headers, stream=True, timeout=self.timeout) as r:
+            if r.status_code == 416:
+                return hasher.hexdigest()  # มีครบแล้ว
+            r.raise_for_status()
+            if offset and r.status_code != 206:
+                # server ไม่รองรับ Range หรือไฟล์เปลี่ยนไปแล้ว (If-Range ไม่ตรง) เริ่มใหม่ทั้งไฟล์
+                print(f"[download] {source} ignored Range or changed, restarting from 0")
+                hasher = hashlib.sha256()
+                offset = 0
+            elif offset:
+                print(f"[download] Resuming {source} at {offset} bytes")
+            if not offset:
+                self._save_validator(part_path, source, r.headers)
+            with open(part_path, 'ab' if offset else 'wb') as f:
+                for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                    if chunk:
+                        f.write(chunk)
+                        hasher.update(chunk)
+        return hasher.hexdigest()
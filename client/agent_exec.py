@@ -0,0 +1,163 @@
+import collections
+import os
+import queue
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# รันสคริปต์ (powershell/cmd/python/sh) แล้วส่ง stdout/stderr ขึ้น server เป็นชิ้นๆ ระหว่างที่ยังรันอยู่
+# - thread อ่าน pipe ทีละไม่เกิน chunk_size โยนเข้า queue ขนาดจำกัด ถ้าส่งไม่ทัน reader จะรอ (สคริปต์ก็รอตาม)
+#   memory คงที่ไม่ว่า output จะยาวแค่ไหน
+# - uploader รวมเป็นชิ้นละไม่เกิน chunk_size ส่งเมื่อเต็มหรือครบ flush_interval วินาที
+# - เก็บแค่ท้าย output (tail_bytes) ไว้ใส่ในผลลัพธ์สุดท้าย
+
+SHELL_SUFFIX = {"powershell": ".ps1", "cmd": ".cmd", "python": ".py", "sh": ".sh"}
+
+
+def _command_line(shell, path):
+    if shell == "powershell":
+        return ["powershell", "-NoProfile", "-NonInteractive", "-ExecutionPolicy", "Bypass", "-File", path]
+    if shell == "cmd":
+        return ["cmd", "/c", path]
+    if shell == "python":
+        return [sys.executable, path]
+    if shell == "sh":
+        return ["sh", path]
+    raise ValueError(f"Unknown shell: {shell}")
+
+
+def _kill_tree(proc):
+    if sys.platform == 'win32':
+        subprocess.run(["taskkill", "/T", "/F", "/PID", str(proc.pid)],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    else:
+        os.killpg(proc.pid, signal.SIGKILL)  # ทั้ง process group ไม่งั้นลูกที่ยังถือ pipe อยู่จะทำให้รอไม่จบ
+
+
+class OutputStreamer:
+    # send_chunk(seq, stream, data, final) ส่งหนึ่งชิ้น (raise = ส่งไม่ได้ ชิ้นนั้นนับเป็น lost)
+    def __init__(self, send_chunk, chunk_size=64 * 1024, flush_interval=1.0, max_buffered=8, tail_bytes=4096):
+        self.send_chunk = send_chunk
+        self.chunk_size = chunk_size
+        self.flush_interval = flush_interval
+        self.tail_bytes = tail_bytes
+        self._queue = queue.Queue(maxsize=max_buffered)
+        self._seq = 0
+        self.sent_chunks = 0
+        self.lost_bytes = 0
+        self.totals = {"stdout": 0, "stderr": 0}
+        self.tail = collections.deque()
+        self._tail_size = 0
+
+    def reader(self, stream, pipe):
+        try:
+            for block in iter(lambda: pipe.read1(self.chunk_size), b''):
+                self._queue.put((stream, block))
+        finally:
+            self._queue.put((stream, None))
+
+    def _send(self, stream, data, final=False):
+        try:
+            self.send_chunk(self._seq, stream, bytes(data), final)
+            self.sent_chunks += 1
+        except Exception as e:
+            self.lost_bytes += len(data)
+            print(f"[exec] Output chunk {self._seq} ({len(data)} bytes) not delivered: {e}")
+        self._seq += 1
+
+    def _remember_tail(self, data):
+        self.tail.append(data)
+        self._tail_size += len(data)
+        while self._tail_size - len(self.tail[0]) >= self.tail_bytes:
+            self._tail_size -= len(self.tail.popleft())
+
+    def tail_text(self):
+        return b"".join(self.tail)[-self.tail_bytes:].decode('utf-8', errors='replace')
+
+    def run(self, readers):
+        # ทำงานใน thread ที่เรียก จนกว่า reader ทุกตัวจะปิด pipe
+        buffers = {"stdout": bytearray(), "stderr": bytearray()}
+        open_readers = readers
+        next_flush = time.monotonic() + self.flush_interval
+        while open_readers:
+            try:
+                stream, block = self._queue.get(timeout=max(0.01, next_flush - time.monotonic()))
+            except queue.Empty:
+                stream, block = None, b''
+            if block is None:
+                open_readers -= 1
+            elif block:
+                self.totals[stream] += len(block)
+                self._remember_tail(block)
+                buffers[stream] += block
+                if len(buffers[stream]) >= self.chunk_size:
+                    self._send(stream, buffers[stream][:self.chunk_size])
+                    del buffers[stream][:self.chunk_size]
+            if time.monotonic() >= next_flush:
+                for name, buffer in buffers.items():
+                    if buffer:
+                        self._send(name, buffer)
+                        buffer.clear()
+                next_flush = time.monotonic() + self.flush_interval
+        for name, buffer in buffers.items():
+            if buffer:
+                self._send(name, buffer)
+        self._send("stdout", b"", final=True)  # บอก server ว่า output ครบแล้ว
+
+
+def run_script(script, send_chunk, shell=None, timeout=600, chunk_size=64 * 1024, flush_interval=1.0, cancel=None):
+    # คืน (exit_code, summary dict) exit_code = None ถ้า timeout หรือถูกยกเลิก (cancel: Event)
+    shell = shell or ("powershell" if sys.platform == 'win32' else "sh")
+    fd, path = tempfile.mkstemp(suffix=SHELL_SUFFIX.get(shell, ".txt"), prefix="ddc_exec_")
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        f.write(script)
+    streamer = OutputStreamer(send_chunk, chunk_size=chunk_size, flush_interval=flush_interval)
+    start = time.monotonic()
+    stopped = []  # "timed_out" / "cancelled"
+    finished = threading.Event()
+    try:
+        proc = subprocess.Popen(_command_line(shell, path), stdin=subprocess.DEVNULL,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                start_new_session=sys.platform != 'win32')
+        for stream, pipe in (("stdout", proc.stdout), ("stderr", proc.stderr)):
+            threading.Thread(target=streamer.reader, args=(stream, pipe), name=f"exec-{stream}", daemon=True).start()
+
+        def watchdog():
+            deadline = time.monotonic() + timeout
+            while not finished.wait(0.2):
+                if cancel is not None and cancel.is_set():
+                    stopped.append("cancelled")
+                    print(f"[exec] Script cancelled, killing pid {proc.pid}")
+                elif time.monotonic() >= deadline:
+                    stopped.append("timed_out")
+                    print(f"[exec] Script timed out after {timeout}s, killing pid {proc.pid}")
+                else:
+                    continue
+                _kill_tree(proc)
+                return
+        threading.Thread(target=watchdog, name="exec-watchdog", daemon=True).start()
+        try:
+            streamer.run(readers=2)
+            exit_code = proc.wait()
+        finally:
+            finished.set()
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    summary = {
+        "exit_code": None if stopped else exit_code,
+        "timed_out": "timed_out" in stopped,
+        "cancelled": "cancelled" in stopped,
+        "duration": round(time.monotonic() - start, 3),
+        "stdout_bytes": streamer.totals["stdout"],
+        "stderr_bytes": streamer.totals["stderr"],
+        "chunks": streamer.sent_chunks,
+        "lost_bytes": streamer.lost_bytes,
+        "tail": streamer.tail_text(),
+    }
+    return summary["exit_code"], summary
@@ -0,0 +1,471 @@
+import gzip
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+from agent_client import is_permanent_rejection, TELEMETRY_HEADER
+from agent_outbox import Outbox, OutboxFlusher
+
+# gateway/relay mode: เครื่องเดียวต่อ LAN ถือ connection ไป server กลาง แทนทุกเครื่องใน set_id
+# - เครื่องอื่นตั้ง "gateway_url" ชี้มาที่ gateway แล้วใช้ protocol เดิมทุกอย่าง
+# - gateway ดึงคำสั่งของทุกเครื่องใน set ด้วย request เดียว แล้วแจกต่อในวง LAN (poll หรือ SSE)
+# - ผลลัพธ์/report_remote ของทุกเครื่องถูกรวมเป็น batch เดียวก่อนส่งขึ้น server
+# - telemetry (X-Agent-Telemetry) ที่แนบมากับ poll/stream ของแต่ละเครื่องเก็บไว้แล้วแนบไปกับ pending รอบถัดไป
+# ถ้า server ไม่มี endpoint แบบ batch จะถอยไปยิงทีละเครื่องด้วย key ของเครื่องนั้น (ผลเหมือนเดิม แค่ไม่ประหยัด)
+# - คำสั่งที่ดึงมาแทนเครื่องอื่น server ถือว่าส่งแล้ว: เก็บลง SQLite จนกว่าจะส่งถึงเครื่องปลายทางจริง
+#   gateway ตาย/รีสตาร์ทก็ไม่หาย (โหลดกลับตอน start)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS peer_commands (
+    machine_id INTEGER NOT NULL,
+    command_id INTEGER NOT NULL,
+    command TEXT NOT NULL,
+    queued_at REAL NOT NULL,
+    PRIMARY KEY (machine_id, command_id)
+);
+"""
+
+PEER_TTL = 300           # เครื่องที่หายไปนานกว่านี้จะไม่ถูก poll แทนแล้ว
+REJECT_TTL = 60          # key ที่ server ไม่รับ จำไว้กี่วินาทีก่อนถาม server ใหม่
+HEARTBEAT_INTERVAL = 15
+RELAY_PATHS = ("/machine/command/output", "/machine/command/upload",  # ส่งต่อขึ้น server ตรงๆ
+               "/machine/startup_report")
+
+
+class Gateway:
+    def __init__(self, upstream, set_id, machine_name, outbox_path, poll_interval=10, cache=None, cache_artifacts=None):
+        self.upstream = upstream
+        self.set_id = set_id
+        self.machine_name = machine_name
+        self.poll_interval = poll_interval
+        self.machine_id = None
+        self.batch_supported = True
+        self._lock = threading.Lock()
+        self._peers = {}       # machine_id -> {"key", "last_seen"} key ที่ server ยืนยันแล้วเท่านั้น
+        self._rejected = {}    # (machine_id, key) -> เวลาที่ server ปฏิเสธ
+        self._queues = {}      # machine_id -> [command]
+        self._events = {}      # machine_id -> Event
+        self._queued_at = {}   # command_id -> เวลาตอนเข้าคิว (ชดเชย server_time ของคำสั่งตั้งเวลา)
+        self._remotes = {}     # machine_id -> report_remote payload ล่าสุดที่ยังไม่ได้ส่ง
+        self._telemetry = {}   # machine_id -> telemetry delta (รวมแล้ว) ที่ยังไม่ได้ส่งขึ้น server
+        self._names = {}       # machine_name -> machine_id (cache ของ /machine/config)
+        self.outbox = Outbox(outbox_path)
+        self._db = sqlite3.connect(outbox_path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA synchronous=FULL")
+        self._db.executescript(SCHEMA)
+        self.flusher = OutboxFlusher(self.outbox, self._upload, retry_delay=upstream.backoff_delay,
+                                     extra_pending=lambda: bool(self._remotes))
+        self.server = None
+        # content cache ที่แชร์ให้เครื่องใน LAN (/cache/<sha256>) cache miss ดึงจาก internet เฉพาะ artifact
+        # ที่รู้ hash (cache_artifacts: {sha256: url}) และตรวจ sha256 ก่อนแจก
+        self.cache = cache
+        self.cache_artifacts = {digest.lower(): url for digest, url in (cache_artifacts or {}).items()}
+
+    def start(self, host, port):
+        with self._lock:
+            for machine_id, command, queued_at in self._db.execute(
+                    "SELECT machine_id, command, queued_at FROM peer_commands ORDER BY queued_at, command_id"):
+                cmd = json.loads(command)
+                self._queues.setdefault(machine_id, []).append(cmd)
+                self._queued_at[cmd['id']] = queued_at
+        if self._queued_at:
+            print(f"[gateway] Restored {len(self._queued_at)} undelivered peer commands")
+        handler = type("BoundGatewayHandler", (GatewayHandler,), {"gateway": self})
+        self.server = GatewayServer((host, port), handler)
+        threading.Thread(target=self.server.serve_forever, name="gateway-http", daemon=True).start()
+        threading.Thread(target=self._poll_loop, name="gateway-poll", daemon=True).start()
+        self.flusher.start()
+        print(f"[gateway] Listening on {host}:{self.server.server_address[1]} for set_id={self.set_id}")
+
+    # ------------------- peers & local queues -------------------
+    def verify_peer(self, machine_id, key):
+        # True ถ้า key เป็นของ machine_id จริง: เจอครั้งแรกถามเซิร์ฟเวอร์ (ดึงคำสั่งค้างของเครื่องนั้นด้วย key นี้
+        # ถ้า server ไม่คืนของเครื่องนั้นแปลว่า key ผิด) หลังจากนั้นเทียบกับ key ที่ยืนยันแล้ว ไม่เขียนทับ
+        with self._lock:
+            peer = self._peers.get(machine_id)
+            if peer is not None:
+                if peer["key"] != key:
+                    return False
+                peer["last_seen"] = time.time()
+                return True
+            if time.time() - self._rejected.get((machine_id, key), 0) < REJECT_TTL:
+                return False
+        if not key:
+            return False
+        if self.machine_id is None:
+            self.machine_id = self.upstream.get_machine_id(self.machine_name)
+        pending = self._fetch_pending({machine_id: key})
+        if machine_id not in pending:
+            print(f"[gateway] Rejected machine_id={machine_id}: agent key not accepted by server")
+            with self._lock:
+                self._rejected[(machine_id, key)] = time.time()
+            return False
+        with self._lock:
+            self._peers.setdefault(machine_id, {"key": key, "last_seen": time.time()})
+            accepted = self._peers[machine_id]["key"] == key
+        if pending[machine_id]:
+            self.enqueue(machine_id, pending[machine_id])
+        return accepted
+
+    def touch_peer(self, machine_id):
+        with self._lock:
+            if machine_id in self._peers:
+                self._peers[machine_id]["last_seen"] = time.time()
+
+    def peer_key(self, machine_id):
+        with self._lock:
+            peer = self._peers.get(machine_id)
+        return peer["key"] if peer else None
+
+    def active_peers(self):
+        now = time.time()
+        with self._lock:
+            return {mid: p["key"] for mid, p in self._peers.items() if now - p["last_seen"] < PEER_TTL}
+
+    def enqueue(self, machine_id, cmds):
+        with self._lock:
+            queue = self._queues.setdefault(machine_id, [])
+            queued = {c['id'] for c in queue}
+            now = time.time()
+            for c in cmds:
+                if c['id'] not in queued:
+                    queue.append(c)
+                    self._queued_at[c['id']] = now
+                    # คืนเข้าคิว (ส่งไม่ถึง) แถวเดิมยังอยู่ ไม่เขียนทับ
+                    self._db.execute("INSERT OR IGNORE INTO peer_commands (machine_id, command_id, command, queued_at) "
+                                     "VALUES (?, ?, ?, ?)", (machine_id, c['id'], json.dumps(c), now))
+            event = self._events.get(machine_id)
+        if event:
+            event.set()
+
+    def take(self, machine_id):
+        # เอาออกจากคิวในหน่วยความจำ แถวใน DB ยังอยู่จนกว่าจะเรียก delivered()
+        with self._lock:
+            cmds = self._queues.get(machine_id) or []
+            self._queues[machine_id] = []
+            queued_at = [self._queued_at.pop(c['id'], None) for c in cmds]
+        # server_time = นาฬิกา server ตอนส่ง บวกเวลาที่ค้างในคิว gateway ให้ยังเป็น "เวลา server ตอนนี้"
+        now = time.time()
+        return [dict(c, server_time=c['server_time'] + now - t) if c.get('server_time') and t else c
+                for c, t in zip(cmds, queued_at)]
+
+    def delivered(self, machine_id, cmds):
+        with self._lock:
+            self._db.executemany("DELETE FROM peer_commands WHERE machine_id=? AND command_id=?",
+                                 [(machine_id, c['id']) for c in cmds])
+
+    def undelivered(self, machine_id, cmds):
+        # ส่งไม่ถึงเครื่องปลายทาง คืนเข้าคิวให้ poll/stream รอบหน้า
+        if cmds:
+            self.enqueue(machine_id, cmds)
+
+    def queued(self):
+        with self._lock:
+            return sum(len(q) for q in self._queues.values())
+
+    def drain(self, timeout):
+        # ก่อนเครื่อง gateway ดับเอง (shutdown/reboot/reinstall): รอเครื่องอื่นมารับคำสั่งที่ค้าง
+        # แล้วส่งผลของทุกเครื่องขึ้น server ตัวที่ยังไม่มีใครรับอยู่ใน DB ส่งต่อหลังเปิดเครื่อง
+        deadline = time.monotonic() + timeout
+        while self.queued() and time.monotonic() < deadline:
+            time.sleep(0.5)
+        left = self.queued()
+        if left:
+            print(f"[gateway] {left} peer commands not picked up before drain timeout, kept for after restart")
+        self.flusher.flush(timeout=max(1, deadline - time.monotonic()))
+        return left == 0
+
+    def wait(self, machine_id, timeout):
+        with self._lock:
+            event = self._events.setdefault(machine_id, threading.Event())
+            if self._queues.get(machine_id):
+                event.set()
+        event.wait(timeout)
+        event.clear()
+        return self.take(machine_id)
+
+    def add_telemetry(self, machine_id, encoded):
+        if not encoded:
+            return
+        try:
+            delta = json.loads(encoded)
+        except ValueError:
+            print(f"[gateway] Ignoring malformed telemetry from machine_id={machine_id}")
+            return
+        with self._lock:
+            self._telemetry.setdefault(machine_id, {}).update(delta)
+
+    def _take_telemetry(self, machine_ids):
+        with self._lock:
+            return {mid: self._telemetry.pop(mid) for mid in machine_ids if mid in self._telemetry}
+
+    def _restore_telemetry(self, telemetry):
+        # ส่งไม่ถึง server เก็บกลับไว้ (ค่าที่ใหม่กว่าที่เข้ามาระหว่างนั้นชนะ)
+        with self._lock:
+            for machine_id, delta in telemetry.items():
+                self._telemetry[machine_id] = dict(delta, **self._telemetry.get(machine_id, {}))
+
+    def add_remote(self, machine_id, payload):
+        with self._lock:
+            self._remotes[machine_id] = payload
+        self.flusher.notify()
+
+    # ------------------- upstream -------------------
+    def _poll_loop(self):
+        while True:
+            try:
+                if self.machine_id is None:
+                    self.machine_id = self.upstream.get_machine_id(self.machine_name)
+                peers = self.active_peers()
+                if self.machine_id and peers:
+                    for machine_id, cmds in self._fetch_pending(peers).items():
+                        if cmds:
+                            self.enqueue(machine_id, cmds)
+            except Exception as e:
+                print(f"[gateway] Upstream poll failed: {e}")
+            time.sleep(self.poll_interval)
+
+    def _fetch_pending(self, peers):
+        # telemetry ของเครื่องไหนส่งถึง server แล้วถึงทิ้ง ที่เหลือเก็บไว้แนบรอบหน้า
+        telemetry = self._take_telemetry(peers)
+        try:
+            return self._fetch_pending_with(peers, telemetry)
+        finally:
+            self._restore_telemetry(telemetry)
+
+    def _fetch_pending_with(self, peers, telemetry):
+        if self.batch_supported:
+            machines = [dict({"machine_id": mid, "agent_key": key},
+                             **({"telemetry": telemetry[mid]} if mid in telemetry else {}))
+                        for mid, key in peers.items()]
+            resp = self.upstream.request('POST', '/machine/gateway/pending', params={'machine_id': self.machine_id},
+                                         json_body={"set_id": self.set_id, "machines": machines}, retries=0)
+            if resp.status_code == 200:
+                telemetry.clear()
+                return {int(mid): cmds for mid, cmds in resp.json().get("commands", {}).items()}
+            if resp.status_code not in (404, 405):
+                raise Exception(f"HTTP {resp.status_code}")
+            print("[gateway] Server has no batch pending endpoint, polling per machine")
+            self.batch_supported = False
+        out = {}
+        for machine_id, key in peers.items():
+            headers = {'X-AGENT-KEY': key}
+            if machine_id in telemetry:
+                headers[TELEMETRY_HEADER] = json.dumps(telemetry[machine_id], separators=(',', ':'))
+            resp = self.upstream.request('GET', '/machine/command/pending', params={'machine_id': machine_id},
+                                         headers=headers, retries=0)
+            if resp.status_code == 200:
+                telemetry.pop(machine_id, None)
+                out[machine_id] = resp.json()
+        return out
+
+    def _upload(self, items):
+        # send_batch ของ OutboxFlusher: รวมผลลัพธ์ของทุกเครื่อง + report_remote ที่ค้างไว้เป็น request เดียว
+        with self._lock:
+            remotes, self._remotes = self._remotes, {}
+        try:
+            if self.batch_supported and self.machine_id:
+                results = [{"machine_id": i['machine_id'], "command_id": i['command_id'],
+                            "status": i['status'], "result": i['result']} for i in items]
+                resp = self.upstream.request('POST', '/machine/gateway/report', params={'machine_id': self.machine_id},
+                                             json_body={"results": results, "remotes": list(remotes.values())})
+                if resp.status_code == 200:
+                    return [i['seq'] for i in items], {}
+                if resp.status_code in (404, 405):
+                    self.batch_supported = False
+                elif not is_permanent_rejection(resp.status_code):
+                    raise Exception(f"HTTP {resp.status_code}")
+                # 4xx ทั้ง batch: ส่งทีละรายการเพื่อแยกตัวที่ server ไม่รับออกมา
+            return self._upload_per_machine(items, remotes)
+        except Exception:
+            # ส่งไม่ได้ เก็บ report_remote กลับไว้ (ถ้ามีอันใหม่กว่ามาแล้วใช้อันใหม่)
+            with self._lock:
+                for machine_id, payload in remotes.items():
+                    self._remotes.setdefault(machine_id, payload)
+            raise
+
+    def _upload_per_machine(self, items, remotes):
+        for machine_id, payload in list(remotes.items()):
+            key = self.peer_key(machine_id)
+            self.upstream.request('POST', '/machine/report_remote', params={'machine_id': machine_id},
+                                  json_body=payload, headers={'X-AGENT-KEY': key} if key else None)
+            remotes.pop(machine_id)
+        done, rejected = [], {}
+        for i in items:
+            key = self.peer_key(i['machine_id'])
+            resp = self.upstream.request('POST', '/machine/command/result', params={'machine_id': i['machine_id']},
+                                         json_body={"command_id": i['command_id'], "status": i['status'],
+                                                    "result": i['result']},
+                                         headers={'X-AGENT-KEY': key} if key else None)
+            if resp.status_code == 200:
+                done.append(i['seq'])
+            elif is_permanent_rejection(resp.status_code):
+                rejected[i['seq']] = f"HTTP {resp.status_code}: {resp.text[:200]}"
+            else:
+                break
+        return done, rejected
+
+
+class GatewayServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+
+class GatewayHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    gateway = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, content_type="application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, payload, status=200):
+        self._send(status, json.dumps(payload).encode("utf-8"))
+
+    def _relay(self, resp):
+        self._send(resp.status_code, resp.content, resp.headers.get("Content-Type", "application/json"))
+
+    def _relay_upstream(self, method, path, query):
+        # output/ไฟล์ระหว่างรันคำสั่ง/startup report: ส่งต่อขึ้น server ทันทีด้วย key ของเครื่องนั้น (ไม่ผ่าน outbox)
+        self._peer(query)
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0)) if method == 'POST' else None
+        headers = {name: self.headers[name] for name in ("X-AGENT-KEY", "Content-Type", "Content-Encoding")
+                   if self.headers.get(name)}
+        self._relay(self.gateway.upstream.request(method, path, params={k: v[0] for k, v in query.items()},
+                                                  headers=headers, data=body))
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        return json.loads(body) if body else None
+
+    def _peer(self, query):
+        machine_id = int(query["machine_id"][0])
+        if not self.gateway.verify_peer(machine_id, self.headers.get("X-AGENT-KEY")):
+            raise PermissionError(f"invalid agent key for machine_id={machine_id}")
+        return machine_id
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        gw = self.gateway
+        try:
+            if url.path == "/machine/config":
+                name = query["name"][0]
+                if name not in gw._names:
+                    resp = gw.upstream.request('GET', '/machine/config', params={'name': name},
+                                               headers={'X-AGENT-KEY': self.headers.get("X-AGENT-KEY")})
+                    if resp.status_code != 200:
+                        return self._relay(resp)
+                    gw._names[name] = resp.json()['machine_id']
+                return self._send_json({"machine_id": gw._names[name]})
+            if url.path == "/machine/command/pending":
+                machine_id = self._peer(query)
+                gw.add_telemetry(machine_id, self.headers.get(TELEMETRY_HEADER))
+                cmds = gw.take(machine_id)
+                try:
+                    self._send_json(cmds)
+                except OSError:
+                    gw.undelivered(machine_id, cmds)
+                    raise
+                return gw.delivered(machine_id, cmds)
+            if url.path == "/machine/command/stream":
+                machine_id = self._peer(query)
+                gw.add_telemetry(machine_id, self.headers.get(TELEMETRY_HEADER))
+                return self._stream(machine_id)
+            if url.path in RELAY_PATHS:
+                return self._relay_upstream('GET', url.path, query)
+            if url.path.startswith("/cache/") and gw.cache:
+                return self._serve_cache(url.path)
+        except PermissionError as e:
+            return self._send_json({"detail": str(e)}, 403)
+        except Exception as e:
+            return self._send_json({"detail": f"gateway error: {e}"}, 502)
+        self._send_json({"detail": "not found"}, 404)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        gw = self.gateway
+        try:
+            if url.path in RELAY_PATHS:
+                return self._relay_upstream('POST', url.path, query)
+            payload = self._read_json()
+            if url.path == "/machine/register":
+                return self._relay(gw.upstream.request('POST', '/machine/register', json_body=payload))
+            if url.path == "/machine/command/result":
+                payload = {"results": [payload]}
+            if url.path in ("/machine/command/result", "/machine/command/result/batch"):
+                machine_id = self._peer(query)
+                for item in payload["results"]:
+                    gw.outbox.add_result(machine_id, item["command_id"], item["status"], item.get("result"))
+                gw.flusher.notify()
+                return self._send_json({"ok": True})
+            if url.path == "/machine/report_remote":
+                gw.add_remote(self._peer(query), payload)
+                return self._send_json({"ok": True})
+        except PermissionError as e:
+            return self._send_json({"detail": str(e)}, 403)
+        except Exception as e:
+            return self._send_json({"detail": f"gateway error: {e}"}, 502)
+        self._send_json({"detail": "not found"}, 404)
+
+    def _serve_cache(self, path):
+        gw = self.gateway
+        digest = path[len("/cache/"):].lower()
+        file_path = gw.cache.path_for(digest) if re.fullmatch(r"[0-9a-f]{64}", digest) else None
+        if file_path and not os.path.exists(file_path) and digest in gw.cache_artifacts:
+            file_path = gw.cache.fetch(gw.cache_artifacts[digest], sha256=digest)  # gateway โหลดเองครั้งเดียวแทนทั้งสาขา
+        if not file_path or not os.path.exists(file_path):
+            return self._send_json({"detail": "not cached"}, 404)
+        size = os.path.getsize(file_path)
+        start = 0
+        match = re.fullmatch(r"bytes=(\d+)-", self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            if start >= size:
+                return self._send(416, b"")
+        self.send_response(206 if start else 200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(size - start))
+        if start:
+            self.send_header("Content-Range", f"bytes {start}-{size - 1}/{size}")
+        self.end_headers()
+        with open(file_path, "rb") as f:
+            f.seek(start)
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                self.wfile.write(block)
+
+    def _stream(self, machine_id):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def send(data):
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.flush()
+
+        cmds = []
+        try:
+            send(b": connected\n\n")
+            while True:
+                self.gateway.touch_peer(machine_id)
+                cmds = self.gateway.wait(machine_id, HEARTBEAT_INTERVAL)
+                send(b"data: " + json.dumps(cmds).encode("utf-8") + b"\n\n" if cmds else b": ping\n\n")
+                self.gateway.delivered(machine_id, cmds)
+                cmds = []
+        except OSError:
+            self.gateway.undelivered(machine_id, cmds)
@@ -0,0 +1,83 @@
+import atexit
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import time
+
+# logging แบบไม่บล็อก: print/log ใน hot loop แค่โยนเข้า queue
+# thread ของ QueueListener เป็นคนเขียนไฟล์ หมุนไฟล์ตามขนาด/เวลา และบีบอัดไฟล์เก่าเป็น .gz
+
+DEFAULT_FORMAT = '%(asctime)s %(levelname)s %(message)s'
+
+
+class JsonFormatter(logging.Formatter):
+    # 1 บรรทัด = 1 JSON object อ่านรวมทีละเยอะๆ ได้ง่าย
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def _gzip_rotator(source, dest):
+    with open(source, 'rb') as src, gzip.open(dest, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(source)
+
+
+class CompressingRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    # หมุนไฟล์เมื่อใหญ่เกิน max_bytes หรือเก่ากว่า rotate_seconds แล้วแต่อะไรถึงก่อน
+    # ไฟล์เก่า: agent.log.1.gz, agent.log.2.gz, ... เก็บไว้ backup_count ไฟล์
+    def __init__(self, filename, max_bytes, backup_count, rotate_seconds):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8', delay=True)
+        self.rotate_seconds = rotate_seconds
+        self.namer = lambda name: name + '.gz'
+        self.rotator = _gzip_rotator
+        started = os.path.getmtime(filename) if os.path.exists(filename) else time.time()
+        self.next_rotate = started + rotate_seconds
+
+    def shouldRollover(self, record):
+        if self.rotate_seconds and time.time() >= self.next_rotate:
+            if os.path.isfile(self.baseFilename) and os.path.getsize(self.baseFilename) > 0:
+                return True
+            self.next_rotate = time.time() + self.rotate_seconds
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self.next_rotate = time.time() + self.rotate_seconds
+
+
+def setup_logging(log_path, stream=None, json_format=False, max_bytes=10 * 1024 * 1024,
+                  backup_count=10, rotate_seconds=24 * 3600, level=logging.INFO):
+    file_handler = CompressingRotatingFileHandler(log_path, max_bytes, backup_count, rotate_seconds)
+    file_handler.setFormatter(JsonFormatter() if json_format else logging.Formatter(DEFAULT_FORMAT))
+    handlers = [file_handler]
+    if stream is not None:
+        stream_handler = logging.StreamHandler(stream)
+        stream_handler.setFormatter(logging.Formatter(DEFAULT_FORMAT))
+        handlers.append(stream_handler)
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(level)
+    listener.start()
+
+    def stop_listener():
+        # เขียน log ที่ค้างใน queue ให้หมดก่อนปิดโปรเซส
+        if listener._thread is not None:
+            listener.stop()
+    atexit.register(stop_listener)
+    return listener
@@ -0,0 +1,214 @@
+import sqlite3
+import threading
+import time
+
+# outbox ถาวรบนดิสก์ (SQLite) สำหรับผลลัพธ์คำสั่ง
+# - results: คิวผลลัพธ์ที่ยังไม่ได้ส่ง ส่งเป็น batch แล้วค่อยลบ
+# - executed: index ของ command_id ที่เคยรันแล้ว (จำกัดจำนวน) กันรันซ้ำหลัง crash/reboot
+# - dead_letter: ผลลัพธ์ที่ server ปฏิเสธถาวร (4xx) ย้ายมาไว้ที่นี่ ไม่ให้ขวางผลลัพธ์ที่ตามมา
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    machine_id INTEGER NOT NULL,
+    command_id INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    result TEXT,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS dead_letter (
+    seq INTEGER PRIMARY KEY,
+    machine_id INTEGER NOT NULL,
+    command_id INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    result TEXT,
+    created_at REAL NOT NULL,
+    reason TEXT,
+    rejected_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS executed (
+    command_id INTEGER PRIMARY KEY,
+    status TEXT NOT NULL,
+    result TEXT,
+    executed_at REAL NOT NULL,
+    run_at REAL
+);
+"""
+
+STATUS_RUNNING = "running"
+MAX_DEAD_LETTER = 1000
+
+
+class Outbox:
+    def __init__(self, path, max_executed=5000):
+        self.path = path
+        self.max_executed = max_executed
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA synchronous=FULL")
+        self._db.executescript(SCHEMA)
+        if "run_at" not in [row[1] for row in self._db.execute("PRAGMA table_info(executed)")]:
+            self._db.execute("ALTER TABLE executed ADD COLUMN run_at REAL")  # outbox จากเวอร์ชันก่อน
+        self._inserts = 0
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    # ------------------- executed index -------------------
+    def executed(self, command_id):
+        # คืน (status, result) ถ้าคำสั่งนี้เคยเริ่มรันแล้ว ไม่งั้นคืน None
+        with self._lock:
+            row = self._db.execute("SELECT status, result FROM executed WHERE command_id=?", (command_id,)).fetchone()
+        return row
+
+    def run_at(self, command_id):
+        # run_at ของรอบตั้งเวลาล่าสุดที่เริ่มรัน/รายงานว่าพลาดไปแล้ว หรือ None
+        with self._lock:
+            row = self._db.execute("SELECT run_at FROM executed WHERE command_id=?", (command_id,)).fetchone()
+        return row[0] if row else None
+
+    def mark_started(self, command_id, run_at=None):
+        # บันทึกก่อนรันจริง ถ้า agent ตายกลางทาง รอบหน้าจะรู้ว่าเคยรันไปแล้ว
+        # run_at: รอบของคำสั่งตั้งเวลาที่กำลังจะรัน (ผลที่ตามมาไม่ลบค่านี้)
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO executed (command_id, status, result, executed_at, run_at) "
+                             "VALUES (?, ?, NULL, ?, ?)", (command_id, STATUS_RUNNING, time.time(), run_at))
+            self._trim_executed()
+
+    def _trim_executed(self):
+        self._inserts += 1
+        if self._inserts % 100:
+            return
+        self._db.execute("DELETE FROM executed WHERE command_id NOT IN "
+                         "(SELECT command_id FROM executed ORDER BY executed_at DESC LIMIT ?)", (self.max_executed,))
+
+    # ------------------- result queue -------------------
+    def add_result(self, machine_id, command_id, status, result=None, run_at=None):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.execute("INSERT INTO results (machine_id, command_id, status, result, created_at) VALUES (?, ?, ?, ?, ?)",
+                                 (machine_id, command_id, status, result, time.time()))
+                self._db.execute("INSERT INTO executed (command_id, status, result, executed_at, run_at) VALUES (?, ?, ?, ?, ?) "
+                                 "ON CONFLICT(command_id) DO UPDATE SET status=excluded.status, result=excluded.result, "
+                                 "executed_at=excluded.executed_at, run_at=COALESCE(excluded.run_at, executed.run_at)",
+                                 (command_id, status, result, time.time(), run_at))
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def has_pending_result(self, command_id):
+        with self._lock:
+            return self._db.execute("SELECT 1 FROM results WHERE command_id=? LIMIT 1", (command_id,)).fetchone() is not None
+
+    def pending(self, limit=50):
+        with self._lock:
+            rows = self._db.execute("SELECT seq, machine_id, command_id, status, result FROM results ORDER BY seq LIMIT ?",
+                                    (limit,)).fetchall()
+        return [{"seq": r[0], "machine_id": r[1], "command_id": r[2], "status": r[3], "result": r[4]} for r in rows]
+
+    def ack(self, seqs):
+        if not seqs:
+            return
+        with self._lock:
+            self._db.executemany("DELETE FROM results WHERE seq=?", [(s,) for s in seqs])
+
+    def reject(self, rejected):
+        # rejected: {seq: เหตุผล} ย้ายออกจากคิวส่งไปเก็บใน dead_letter (เก็บล่าสุด MAX_DEAD_LETTER รายการ)
+        if not rejected:
+            return
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                for seq, reason in rejected.items():
+                    self._db.execute("INSERT OR REPLACE INTO dead_letter (seq, machine_id, command_id, status, result, "
+                                     "created_at, reason, rejected_at) SELECT seq, machine_id, command_id, status, "
+                                     "result, created_at, ?, ? FROM results WHERE seq=?", (reason, time.time(), seq))
+                    self._db.execute("DELETE FROM results WHERE seq=?", (seq,))
+                self._db.execute("DELETE FROM dead_letter WHERE seq NOT IN "
+                                 "(SELECT seq FROM dead_letter ORDER BY seq DESC LIMIT ?)", (MAX_DEAD_LETTER,))
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def backlog(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def oldest_pending_age(self):
+        # ผลลัพธ์ที่ค้างนานที่สุดรอส่งมากี่วินาทีแล้ว (0 ถ้าคิวว่าง)
+        with self._lock:
+            oldest = self._db.execute("SELECT MIN(created_at) FROM results").fetchone()[0]
+        return time.time() - oldest if oldest else 0
+
+
+class OutboxFlusher:
+    # thread ส่งผลลัพธ์จาก outbox เป็น batch
+    # send_batch(items) -> (รายการ seq ที่ส่งสำเร็จ, {seq: เหตุผล} ที่ server ปฏิเสธถาวร) raise ถ้าส่งไม่ได้ทั้งก้อน
+    # ผลลัพธ์ที่ถูกปฏิเสธถาวรย้ายไป dead_letter แล้วส่งตัวถัดไปต่อ ไม่ retry หัวคิวเดิมไปตลอด
+    # extra_pending() -> True ถ้ามีข้อมูลอื่นนอก outbox รอส่งไปกับ batch (จะเรียก send_batch([]))
+    def __init__(self, outbox, send_batch, batch_size=50, linger=0.5, retry_delay=None, extra_pending=None):
+        self.outbox = outbox
+        self.send_batch = send_batch
+        self.extra_pending = extra_pending
+        self.batch_size = batch_size
+        self.linger = linger
+        self.retry_delay = retry_delay or (lambda attempt: min(60, 2 ** attempt))
+        self._wakeup = threading.Event()
+        self._idle = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="outbox-flusher", daemon=True)
+        self._thread.start()
+        self._wakeup.set()  # ส่งของค้างจากรอบก่อน
+
+    def notify(self):
+        self._idle.clear()
+        self._wakeup.set()
+
+    def flush(self, timeout=5):
+        # รอจนคิวว่าง (ใช้ก่อน shutdown/reboot) คืน True ถ้าส่งหมดทัน
+        self.notify()
+        return self._idle.wait(timeout)
+
+    def flush_once(self):
+        sent = 0
+        while True:
+            items = self.outbox.pending(self.batch_size)
+            if not items:
+                if self.extra_pending and self.extra_pending():
+                    self.send_batch([])
+                return sent
+            done, rejected = self.send_batch(items)
+            self.outbox.ack(done)
+            if rejected:
+                by_seq = {i['seq']: i for i in items}
+                for seq, reason in rejected.items():
+                    print(f"[outbox] Result of command {by_seq[seq]['command_id']} rejected by server ({reason}), "
+                          f"moved to dead letter")
+                self.outbox.reject(rejected)
+            sent += len(done)
+            if len(done) + len(rejected) < len(items):
+                raise Exception(f"{len(items) - len(done) - len(rejected)} results not accepted")
+
+    def _run(self):
+        attempt = 0
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            time.sleep(self.linger)  # รอรวมผลลัพธ์ที่ตามมาติดๆ เป็น batch เดียว
+            try:
+                self.flush_once()
+                attempt = 0
+                if not self._wakeup.is_set():
+                    self._idle.set()
+            except Exception as e:
+                delay = self.retry_delay(attempt)
+                attempt += 1
+                print(f"[outbox] Flush failed ({e}), {self.outbox.backlog()} pending, retry in {delay:.1f}s")
+                self._wakeup.wait(delay)
+                self._wakeup.set()
@@ -0,0 +1,75 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+# pipeline ตอนเริ่ม agent: แต่ละ phase มี dependency ของตัวเอง
+# phase ที่ไม่ขึ้นต่อกันรันพร้อมกัน และจับเวลาทุก phase ไว้รายงานให้ server
+
+
+class StartupPipeline:
+    def __init__(self, max_workers=4, t0=None, tag="startup"):
+        # t0: เวลาเริ่มโปรเซส (time.monotonic) ใช้เป็นจุดศูนย์ของ timeline
+        # tag: prefix ของ log (ใช้ pipeline เดียวกันกับงานอื่นได้ เช่น reinstall)
+        self.max_workers = max_workers
+        self.tag = tag
+        self.phases = {}   # name -> (func, deps)
+        self.results = {}
+        self.timings = {}  # name -> {"start", "duration", "status", "error"}
+        self._t0 = t0 if t0 is not None else time.monotonic()
+        self._lock = threading.Lock()
+
+    def add(self, name, func, deps=()):
+        self.phases[name] = (func, tuple(deps))
+
+    def record(self, name, start, duration, status="ok", error=None):
+        # ใช้บันทึก phase ที่เกิดขึ้นนอก pipeline (เช่นโหลด config ตอน import)
+        with self._lock:
+            self.timings[name] = {"start": round(start - self._t0, 3), "duration": round(duration, 3), "status": status}
+            if error:
+                self.timings[name]["error"] = error
+
+    def _run_phase(self, name):
+        func = self.phases[name][0]
+        start = time.monotonic()
+        try:
+            result = func()
+        except Exception as e:
+            self.record(name, start, time.monotonic() - start, "failed", f"{type(e).__name__}: {e}")
+            print(f"[{self.tag}] {name} failed after {time.monotonic() - start:.1f}s: {e}")
+            raise
+        self.record(name, start, time.monotonic() - start)
+        print(f"[{self.tag}] {name} done in {time.monotonic() - start:.1f}s")
+        return result
+
+    def run(self):
+        pending = dict(self.phases)
+        done, failed = set(), set()
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=self.tag) as pool:
+            while pending or running:
+                for name, (func, deps) in list(pending.items()):
+                    if any(d in failed for d in deps):
+                        # dependency พัง ข้าม phase นี้
+                        del pending[name]
+                        failed.add(name)
+                        self.record(name, time.monotonic(), 0, "skipped")
+                    elif all(d in done for d in deps):
+                        del pending[name]
+                        running[pool.submit(self._run_phase, name)] = name
+                if not running:
+                    break  # dependency วน/ไม่มีอยู่จริง
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    if future.exception():
+                        failed.add(name)
+                    else:
+                        done.add(name)
+                        self.results[name] = future.result()
+        for name in pending:
+            self.record(name, time.monotonic(), 0, "skipped", "unresolved dependency")
+        return self.results
+
+    def report(self):
+        with self._lock:
+            return {"total": round(time.monotonic() - self._t0, 3), "phases": dict(self.timings)}
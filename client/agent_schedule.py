@@ -0,0 +1,156 @@
+import heapq
+import json
+import sqlite3
+import threading
+import time
+
+# คำสั่งตั้งเวลาล่วงหน้า (execute_at) เก็บถาวรใน SQLite ยิงจาก timer ในเครื่องเอง
+# ไม่ต้องรอ poll รอบถัดไป และยังยิงตรงเวลาแม้เน็ตหลุด
+# - timer: heap เรียงตามเวลา + Condition.wait จนถึงตัวถัดไป (ตื่นอย่างน้อยทุก MAX_WAIT วิ เผื่อนาฬิกาเครื่องถูกปรับ)
+# - repeat: {"every": วินาที, "count": จำนวนครั้งที่เหลือ, "until": epoch} รอบที่พลาด (เครื่องปิด) ข้ามไปรอบถัดไป
+# - ยิงช้ากว่ากำหนดเกิน grace วินาที (เช่นเครื่องเพิ่งเปิด) จะไม่รัน แจ้ง on_missed แทน
+# - ลบ/เลื่อนแถวใน DB หลัง fire() คืนแล้วเท่านั้น (fire บันทึกว่าเริ่มรันก่อน) agent ตายระหว่างนั้น
+#   รอบหน้าจะยิงรอบเดิมซ้ำ fire ต้องเช็คเองว่ารอบ run_at นี้เคยเริ่มไปแล้วหรือยัง
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scheduled (
+    command_id INTEGER PRIMARY KEY,
+    command TEXT NOT NULL,
+    run_at REAL NOT NULL,
+    repeat TEXT
+);
+"""
+
+MAX_WAIT = 30
+STATUS_SCHEDULED = "scheduled"
+
+
+class Scheduler:
+    # fire(cmd, run_at): รันคำสั่ง (ควรคืนเร็ว เช่นโยนเข้า executor), on_missed(cmd, late_seconds, run_at)
+    def __init__(self, path, fire, on_missed=None, grace=60):
+        self.fire = fire
+        self.on_missed = on_missed
+        self.grace = grace
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA synchronous=FULL")
+        self._db.executescript(SCHEMA)
+        self._cond = threading.Condition()
+        self._heap = []     # (run_at, command_id)
+        self._entries = {}  # command_id -> {"cmd", "run_at", "repeat"} (heap entry ที่ run_at ไม่ตรงถือว่ายกเลิกแล้ว)
+        self._thread = None
+
+    def start(self):
+        with self._cond:
+            for command_id, command, run_at, repeat in self._db.execute(
+                    "SELECT command_id, command, run_at, repeat FROM scheduled"):
+                self._put(command_id, json.loads(command), run_at, json.loads(repeat) if repeat else None)
+        self._thread = threading.Thread(target=self._run, name="scheduler", daemon=True)
+        self._thread.start()
+        print(f"[schedule] {len(self._entries)} scheduled commands loaded")
+
+    def _put(self, command_id, cmd, run_at, repeat):
+        self._entries[command_id] = {"cmd": cmd, "run_at": run_at, "repeat": repeat}
+        heapq.heappush(self._heap, (run_at, command_id))
+        self._cond.notify()
+
+    def add(self, cmd, run_at, repeat=None):
+        with self._cond:
+            self._db.execute("INSERT OR REPLACE INTO scheduled (command_id, command, run_at, repeat) VALUES (?, ?, ?, ?)",
+                             (cmd['id'], json.dumps(cmd), run_at, json.dumps(repeat) if repeat else None))
+            self._put(cmd['id'], cmd, run_at, repeat)
+
+    def cancel(self, command_id):
+        with self._cond:
+            if self._entries.pop(command_id, None) is None:
+                return False
+            self._db.execute("DELETE FROM scheduled WHERE command_id=?", (command_id,))
+            self._cond.notify()
+            return True
+
+    def reschedule(self, command_id, run_at, repeat=None):
+        with self._cond:
+            entry = self._entries.get(command_id)
+            if entry is None:
+                return False
+            repeat = repeat if repeat is not None else entry["repeat"]
+            self._db.execute("UPDATE scheduled SET run_at=?, repeat=? WHERE command_id=?",
+                             (run_at, json.dumps(repeat) if repeat else None, command_id))
+            self._put(command_id, entry["cmd"], run_at, repeat)
+            return True
+
+    def contains(self, command_id):
+        with self._cond:
+            return command_id in self._entries
+
+    def count(self):
+        with self._cond:
+            return len(self._entries)
+
+    def next_run(self, command_id):
+        with self._cond:
+            entry = self._entries.get(command_id)
+            return entry["run_at"] if entry else None
+
+    def _next_due(self):
+        # คืน (command_id, entry) ที่ถึงเวลาแล้ว หรือ None หลังรอจนถึงเวลา/ถูกปลุก (เรียกขณะถือ lock)
+        while self._heap:
+            run_at, command_id = self._heap[0]
+            entry = self._entries.get(command_id)
+            if entry is None or entry["run_at"] != run_at:
+                heapq.heappop(self._heap)  # ถูกยกเลิก/เลื่อนไปแล้ว
+                continue
+            delay = run_at - time.time()
+            if delay > 0:
+                self._cond.wait(min(delay, MAX_WAIT))
+                return None
+            heapq.heappop(self._heap)
+            return command_id, entry
+        self._cond.wait(MAX_WAIT)
+        return None
+
+    def _advance(self, command_id, entry, now):
+        # คำนวณรอบถัดไปของคำสั่งที่ repeat (ขณะถือ lock) ไม่มีรอบถัดไปแล้วลบทิ้ง
+        if self._entries.get(command_id) is not entry:
+            return  # ถูกยกเลิก/เลื่อนระหว่าง fire ไปแล้ว
+        repeat = entry["repeat"]
+        run_at = None
+        if repeat and repeat.get("every"):
+            run_at = entry["run_at"] + repeat["every"]
+            while run_at <= now:
+                run_at += repeat["every"]
+            if repeat.get("count") is not None:
+                repeat = dict(repeat, count=repeat["count"] - 1)
+                if repeat["count"] <= 0:
+                    run_at = None
+            if run_at and repeat.get("until") and run_at > repeat["until"]:
+                run_at = None
+        if run_at is None:
+            del self._entries[command_id]
+            self._db.execute("DELETE FROM scheduled WHERE command_id=?", (command_id,))
+        else:
+            self._db.execute("UPDATE scheduled SET run_at=?, repeat=? WHERE command_id=?",
+                             (run_at, json.dumps(repeat), command_id))
+            self._put(command_id, entry["cmd"], run_at, repeat)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                due = self._next_due()
+                if due is None:
+                    continue
+                command_id, entry = due
+                now = time.time()
+                late = now - entry["run_at"]
+            try:
+                if late > self.grace:
+                    print(f"[schedule] Command {command_id} missed its time by {late:.1f}s, not running")
+                    if self.on_missed:
+                        self.on_missed(entry["cmd"], late, entry["run_at"])
+                else:
+                    print(f"[schedule] Firing command {command_id} ({entry['cmd']['command']}), {late * 1000:.0f} ms late")
+                    self.fire(entry["cmd"], entry["run_at"])
+            except Exception as e:
+                print(f"[schedule] Firing command {command_id} failed: {e}")
+            finally:
+                with self._cond:
+                    self._advance(command_id, entry, now)
@@ -0,0 +1,180 @@
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# telemetry สุขภาพเครื่อง (CPU, RAM, disk, boot time, จำนวน process) แบบประหยัด
+# - เก็บตัวอย่างใน thread แยกทุก interval วินาที (อ่านค่าจาก OS ตรงๆ ไม่มีการ sleep วัด CPU)
+# - ส่งเฉพาะค่าที่เปลี่ยนเกิน threshold จากค่าที่ส่งไปล่าสุด แนบไปกับ poll เดิม (ไม่มี request เพิ่ม)
+# - ส่งครบทุกค่า (keyframe) เป็นระยะ ให้ server resync ได้
+# key แบบสั้น: c=cpu %, m=ram %, d=disk %, b=boot time (epoch), p=จำนวน process
+
+DEFAULT_THRESHOLDS = {"c": 5, "m": 2, "d": 1, "b": 60, "p": 10}
+
+
+class _CpuTimes:
+    # เก็บ (busy, total) ครั้งก่อน แล้วคำนวณ % จากส่วนต่าง
+    def __init__(self):
+        self.last = None
+
+    def percent(self, busy, total):
+        last, self.last = self.last, (busy, total)
+        if last is None or total <= last[1]:
+            return None
+        return round(100.0 * (busy - last[0]) / (total - last[1]), 1)
+
+
+def _windows_sampler():
+    import ctypes
+    from ctypes import wintypes
+
+    class MEMORYSTATUSEX(ctypes.Structure):
+        _fields_ = [("dwLength", ctypes.c_ulong), ("dwMemoryLoad", ctypes.c_ulong),
+                    ("ullTotalPhys", ctypes.c_ulonglong), ("ullAvailPhys", ctypes.c_ulonglong),
+                    ("ullTotalPageFile", ctypes.c_ulonglong), ("ullAvailPageFile", ctypes.c_ulonglong),
+                    ("ullTotalVirtual", ctypes.c_ulonglong), ("ullAvailVirtual", ctypes.c_ulonglong),
+                    ("ullAvailExtendedVirtual", ctypes.c_ulonglong)]
+
+    kernel32 = ctypes.windll.kernel32
+    psapi = ctypes.windll.psapi
+    kernel32.GetTickCount64.restype = ctypes.c_ulonglong
+    cpu = _CpuTimes()
+    pids = (wintypes.DWORD * 4096)()
+
+    def filetime(ft):
+        return (ft.dwHighDateTime << 32) | ft.dwLowDateTime
+
+    def sample():
+        idle, kernel, user = wintypes.FILETIME(), wintypes.FILETIME(), wintypes.FILETIME()
+        kernel32.GetSystemTimes(ctypes.byref(idle), ctypes.byref(kernel), ctypes.byref(user))
+        total = filetime(kernel) + filetime(user)  # kernel time รวม idle อยู่แล้ว
+        mem = MEMORYSTATUSEX()
+        mem.dwLength = ctypes.sizeof(MEMORYSTATUSEX)
+        kernel32.GlobalMemoryStatusEx(ctypes.byref(mem))
+        needed = wintypes.DWORD()
+        psapi.EnumProcesses(ctypes.byref(pids), ctypes.sizeof(pids), ctypes.byref(needed))
+        return {
+            "c": cpu.percent(total - filetime(idle), total),
+            "m": int(mem.dwMemoryLoad),
+            "b": int(time.time() - kernel32.GetTickCount64() / 1000),
+            "p": needed.value // ctypes.sizeof(wintypes.DWORD),
+        }
+    return sample
+
+
+def _proc_sampler():
+    # Linux /proc (ใช้ตอนทดสอบ/จำลองบนเครื่อง dev)
+    cpu = _CpuTimes()
+
+    def sample():
+        with open('/proc/stat') as f:
+            fields = [int(v) for v in f.readline().split()[1:]]
+        idle = fields[3] + (fields[4] if len(fields) > 4 else 0)
+        meminfo = {}
+        with open('/proc/meminfo') as f:
+            for line in f:
+                name, value = line.split(':', 1)
+                meminfo[name] = int(value.split()[0])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return {
+            "c": cpu.percent(sum(fields) - idle, sum(fields)),
+            "m": round(100.0 * (1 - meminfo["MemAvailable"] / meminfo["MemTotal"])),
+            "b": int(time.time() - uptime),
+            "p": sum(1 for name in os.listdir('/proc') if name.isdigit()),
+        }
+    return sample
+
+
+def _psutil_sampler():
+    psutil.cpu_percent(None)  # ครั้งแรกเป็นจุดตั้งต้น
+
+    def sample():
+        return {
+            "c": psutil.cpu_percent(None),
+            "m": round(psutil.virtual_memory().percent),
+            "b": int(psutil.boot_time()),
+            "p": len(psutil.pids()),
+        }
+    return sample
+
+
+def make_sampler():
+    if psutil is not None:
+        return _psutil_sampler()
+    if sys.platform == 'win32':
+        return _windows_sampler()
+    if os.path.exists('/proc/stat'):
+        return _proc_sampler()
+    return lambda: {}
+
+
+class TelemetrySampler:
+    def __init__(self, interval=30, thresholds=None, keyframe_interval=1800, disk_path=None):
+        self.interval = interval
+        self.thresholds = dict(DEFAULT_THRESHOLDS, **(thresholds or {}))
+        self.keyframe_interval = keyframe_interval
+        self.disk_path = disk_path or (os.environ.get('SystemDrive', 'C:') + '\\' if sys.platform == 'win32' else '/')
+        self._sample = make_sampler()
+        self._lock = threading.Lock()
+        self._latest = {}
+        self._sent = {}
+        self._last_keyframe = 0
+        self._stop = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._run, name="telemetry", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def sample_now(self):
+        try:
+            values = self._sample()
+            usage = shutil.disk_usage(self.disk_path)
+            values["d"] = round(100.0 * usage.used / usage.total, 1)
+        except Exception as e:
+            print(f"[telemetry] Sample failed: {e}")
+            return
+        with self._lock:
+            self._latest.update({k: v for k, v in values.items() if v is not None})
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.sample_now()
+            self._stop.wait(self.interval)
+
+    def latest(self):
+        with self._lock:
+            return dict(self._latest)
+
+    def pending_delta(self):
+        # ค่าที่ต่างจากที่ส่งไปล่าสุดเกิน threshold (หรือครบทุกค่าถ้าถึงเวลา keyframe) ไม่มีอะไรเปลี่ยนคืน {}
+        with self._lock:
+            if time.time() - self._last_keyframe >= self.keyframe_interval:
+                return dict(self._latest)
+            delta = {}
+            for key, value in self._latest.items():
+                previous = self._sent.get(key)
+                if previous is None or abs(value - previous) >= self.thresholds.get(key, 0):
+                    delta[key] = value
+            return delta
+
+    def mark_sent(self, delta):
+        # เรียกหลัง server รับแล้วเท่านั้น ถ้าส่งไม่ผ่านรอบหน้าจะส่งซ้ำเอง
+        if not delta:
+            return
+        with self._lock:
+            self._sent.update(delta)
+            if set(delta) >= set(self._latest):
+                self._last_keyframe = time.time()
+
+    def encode(self, delta):
+        return json.dumps(delta, separators=(',', ':'))
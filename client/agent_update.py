@@ -0,0 +1,352 @@
+import argparse
+import difflib
+import glob
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+# self-update ของ agent แบบ delta
+# - server มี manifest: version + sha256 ของทุกไฟล์ + delta จาก sha256 เวอร์ชันเก่าที่รู้จัก
+# - agent ดึงแค่ delta ของไฟล์ที่เปลี่ยน (ไม่มี delta ของเวอร์ชันที่ตัวเองมี -> โหลดทั้งไฟล์)
+# - เตรียมไฟล์ใหม่ใน staging dir ตรวจ sha256 ครบ, สำรองไฟล์เดิมทั้งชุดไว้ใน .update/backup
+#   แล้วจด journal (.update/journal.json) ก่อนสลับไฟล์ ชุดไฟล์จึงเปลี่ยนพร้อมกันทั้งชุดเสมอ:
+#     swapping  -> ไฟดับกลางทาง: รอบหน้าที่ start คืนชุดเดิมทั้งหมด (recover_update)
+#     swapped   -> เวอร์ชันใหม่ยังไม่ยืนยันว่าใช้ได้: supervisor (โค้ดชุดเดิม) รอ confirm_healthy()
+#                  ถ้า process ใหม่ตาย (เช่น ImportError) หรือเงียบเกิน timeout คืนชุดเดิมแล้วรันตัวเดิม
+#                  start แล้วไม่ confirm เกิน MAX_UNCONFIRMED_BOOTS ครั้ง ก็คืนชุดเดิมเช่นกัน
+#     healthy / rolled_back -> จบ
+# - โมดูลนี้ import แค่ stdlib (supervisor รันจากไฟล์สำรองได้โดยไม่พึ่งไฟล์อื่น)
+#
+# delta = gzip ของชุดคำสั่งทีละบรรทัด:
+#   C <start> <end>\n     copy บรรทัด [start, end) จากไฟล์เดิม
+#   I <nbytes>\n<bytes>   ใส่ข้อมูลใหม่
+# สร้าง release (ฝั่งคนปล่อยเวอร์ชัน):
+#   python agent_update.py build --version 1.2.0 --release ./client --previous ./old/1.1.0 --out ./update
+
+DELTA_MAGIC = b"FDDCDELTA1\n"
+MANIFEST_ENDPOINT = '/agent/update/manifest'
+BLOB_ENDPOINT = '/agent/update/blob/'
+RELEASE_PATTERNS = ("agent*.py", "requirements.txt")  # ไฟล์ที่อยู่ใน release (ไม่ต้องแก้ list ทุกครั้งที่เพิ่มโมดูล)
+JOURNAL_NAME = 'journal.json'
+MAX_UNCONFIRMED_BOOTS = 3
+HEALTH_TIMEOUT = 300
+
+
+class UpdateError(Exception):
+    pass
+
+
+def _file_sha256(path):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def release_files(release_dir):
+    names = set()
+    for pattern in RELEASE_PATTERNS:
+        names.update(os.path.basename(p) for p in glob.glob(os.path.join(release_dir, pattern)))
+    return sorted(names)
+
+
+# ------------------- journal -------------------
+def _update_dir(install_dir):
+    return os.path.join(install_dir, '.update')
+
+
+def read_journal(install_dir):
+    try:
+        with open(os.path.join(_update_dir(install_dir), JOURNAL_NAME), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_journal(install_dir, journal):
+    path = os.path.join(_update_dir(install_dir), JOURNAL_NAME)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(journal, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def rollback(install_dir, reason):
+    # คืนไฟล์ชุดเดิมจาก .update/backup ทั้งหมด (ไฟล์ที่ update เพิ่มเข้ามาใหม่ลบทิ้ง)
+    journal = read_journal(install_dir)
+    if not journal or journal['state'] not in ('swapping', 'swapped'):
+        return False
+    backup_dir = os.path.join(_update_dir(install_dir), 'backup')
+    for name in journal['files']:
+        target = os.path.join(install_dir, name)
+        if name in journal['added']:
+            if os.path.exists(target):
+                os.remove(target)
+        elif os.path.exists(os.path.join(backup_dir, name)):
+            shutil.copy2(os.path.join(backup_dir, name), target + '.tmp')
+            os.replace(target + '.tmp', target)
+    journal.update(state='rolled_back', reason=reason)
+    write_journal(install_dir, journal)
+    print(f"[update] Rolled back {journal['version']} -> {journal['previous']}: {reason}")
+    return True
+
+
+def recover_update(install_dir):
+    # เรียกตอน start ก่อน import โมดูลอื่นของ agent คืน True ถ้าคืนไฟล์ชุดเดิมแล้ว (ผู้เรียกต้องรันตัวเองใหม่)
+    journal = read_journal(install_dir)
+    if not journal:
+        return False
+    if journal['state'] == 'swapping':
+        return rollback(install_dir, "update interrupted while swapping files")
+    if journal['state'] == 'swapped':
+        journal['boots'] = journal.get('boots', 0) + 1
+        if journal['boots'] > MAX_UNCONFIRMED_BOOTS:
+            return rollback(install_dir, f"not confirmed healthy after {MAX_UNCONFIRMED_BOOTS} starts")
+        write_journal(install_dir, journal)
+    return False
+
+
+def supervise(install_dir, argv, timeout=HEALTH_TIMEOUT, cwd=None):
+    # รันโดยโค้ดชุดเดิม: start agent เวอร์ชันใหม่แล้วรอ confirm_healthy() ไม่ผ่าน = คืนชุดเดิมแล้ว start ตัวเดิม
+    proc = subprocess.Popen(argv, cwd=cwd)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if (read_journal(install_dir) or {}).get('state') != 'swapped':
+            return True  # healthy (หรือ process ใหม่ rollback เองแล้ว)
+        if proc.poll() is not None:
+            reason = f"new version exited with code {proc.returncode} before confirming health"
+            break
+        time.sleep(1)
+    else:
+        reason = f"new version did not confirm health within {timeout}s"
+        proc.kill()
+    if rollback(install_dir, reason):
+        subprocess.Popen(argv, cwd=cwd)
+    return False
+
+
+def make_delta(old, new):
+    a = old.splitlines(keepends=True)
+    b = new.splitlines(keepends=True)
+    out = [DELTA_MAGIC]
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, a, b, autojunk=False).get_opcodes():
+        if tag == 'equal':
+            out.append(b"C %d %d\n" % (i1, i2))
+        elif j2 > j1:
+            data = b"".join(b[j1:j2])
+            out.append(b"I %d\n" % len(data))
+            out.append(data)
+    return gzip.compress(b"".join(out), compresslevel=9)
+
+
+def apply_delta(old, delta):
+    data = gzip.decompress(delta)
+    if not data.startswith(DELTA_MAGIC):
+        raise UpdateError("not a delta file")
+    lines = old.splitlines(keepends=True)
+    out = []
+    pos = len(DELTA_MAGIC)
+    while pos < len(data):
+        end = data.index(b"\n", pos)
+        op = data[pos:end].split()
+        pos = end + 1
+        if op[0] == b"C":
+            out.extend(lines[int(op[1]):int(op[2])])
+        elif op[0] == b"I":
+            size = int(op[1])
+            out.append(data[pos:pos + size])
+            pos += size
+        else:
+            raise UpdateError(f"bad delta op {op[0]!r}")
+    return b"".join(out)
+
+
+def _check_name(name):
+    # manifest ระบุได้แค่ไฟล์ใน install dir ห้ามมี path
+    if not name or os.path.basename(name) != name or name.startswith('.'):
+        raise UpdateError(f"invalid file name in manifest: {name!r}")
+
+
+class AgentUpdater:
+    # client: AgentClient ของ server หลัก, fetch_full(url, sha256) -> path ไฟล์ที่ตรวจแล้ว (ผ่าน content cache)
+    def __init__(self, client, install_dir, fetch_full, current_version=None):
+        self.client = client
+        self.install_dir = install_dir
+        self.fetch_full = fetch_full
+        self.current_version = current_version
+        self.staging_dir = _update_dir(install_dir)
+
+    def manifest(self):
+        resp = self.client.request('GET', MANIFEST_ENDPOINT)
+        if resp.status_code != 200:
+            raise UpdateError(f"manifest HTTP {resp.status_code}")
+        return resp.json()
+
+    def plan(self, manifest):
+        # คืน [(name, entry, local_sha256)] เฉพาะไฟล์ที่ต่างจากในเครื่อง
+        changed = []
+        for name, entry in manifest["files"].items():
+            _check_name(name)
+            path = os.path.join(self.install_dir, name)
+            local = _file_sha256(path) if os.path.exists(path) else None
+            if local != entry["sha256"]:
+                changed.append((name, entry, local))
+        return changed
+
+    def _build(self, name, entry, local, staged_path):
+        # คืนจำนวน byte ที่โหลดจริง
+        delta = entry.get("deltas", {}).get(local) if local else None
+        if delta:
+            try:
+                resp = self.client.request('GET', BLOB_ENDPOINT + delta["blob"])
+                if resp.status_code != 200:
+                    raise UpdateError(f"delta HTTP {resp.status_code}")
+                with open(os.path.join(self.install_dir, name), 'rb') as f:
+                    data = apply_delta(f.read(), resp.content)
+                if hashlib.sha256(data).hexdigest() != entry["sha256"]:
+                    raise UpdateError("sha256 mismatch after applying delta")
+                with open(staged_path, 'wb') as f:
+                    f.write(data)
+                print(f"[update] {name}: delta {len(resp.content)} bytes")
+                return len(resp.content)
+            except Exception as e:
+                print(f"[update] {name}: delta failed ({e}), downloading full file")
+        cached_path = self.fetch_full(self.client.api_url + BLOB_ENDPOINT + entry["blob"], entry["sha256"])
+        shutil.copyfile(cached_path, staged_path)
+        if _file_sha256(staged_path) != entry["sha256"]:
+            raise UpdateError(f"{name}: sha256 mismatch")
+        print(f"[update] {name}: full file {entry['size']} bytes")
+        return entry["size"]
+
+    def apply(self, manifest, cancel=None):
+        # คืน {"version", "files": [ชื่อไฟล์ที่เปลี่ยน], "bytes": จำนวนที่โหลด}
+        # cancel (Event): ถูก set ก่อนถึงขั้น swap (เช่นคำสั่ง update timeout ไปแล้ว) จะไม่แตะไฟล์ที่ติดตั้งอยู่
+        changed = self.plan(manifest)
+        if not changed:
+            return {"version": manifest["version"], "files": [], "bytes": 0}
+        stage = os.path.join(self.staging_dir, manifest["version"])
+        shutil.rmtree(stage, ignore_errors=True)
+        os.makedirs(stage)
+        downloaded = 0
+        for name, entry, local in changed:
+            downloaded += self._build(name, entry, local, os.path.join(stage, name))
+        if cancel is not None and cancel.is_set():
+            shutil.rmtree(stage, ignore_errors=True)
+            raise UpdateError("cancelled before swapping files")
+        self._swap(manifest["version"], [name for name, _, _ in changed], stage)
+        shutil.rmtree(stage, ignore_errors=True)
+        return {"version": manifest["version"], "files": [name for name, _, _ in changed], "bytes": downloaded}
+
+    def _swap(self, version, names, stage):
+        # สำรองไฟล์เดิมทั้งชุด -> journal "swapping" -> replace ทีละไฟล์ -> journal "swapped" (รอ confirm)
+        backup_dir = os.path.join(self.staging_dir, 'backup')
+        shutil.rmtree(backup_dir, ignore_errors=True)
+        os.makedirs(backup_dir)
+        added = []
+        for name in names:
+            target = os.path.join(self.install_dir, name)
+            if os.path.exists(target):
+                shutil.copy2(target, os.path.join(backup_dir, name))
+            else:
+                added.append(name)
+        journal = {"version": version, "previous": self.current_version, "files": names, "added": added,
+                   "state": "swapping", "boots": 0, "started_at": time.time()}
+        write_journal(self.install_dir, journal)
+        try:
+            for name in names:
+                os.replace(os.path.join(stage, name), os.path.join(self.install_dir, name))
+        except Exception as e:
+            rollback(self.install_dir, f"swap failed: {e}")
+            raise
+        journal['state'] = 'swapped'
+        write_journal(self.install_dir, journal)
+
+    def supervisor_command(self, argv, timeout=HEALTH_TIMEOUT):
+        # คำสั่งรัน supervisor ด้วย agent_update.py ชุดเดิม (ใน backup ถ้าไฟล์นี้ถูกเปลี่ยน)
+        script = os.path.join(self.staging_dir, 'backup', 'agent_update.py')
+        if not os.path.exists(script):
+            script = os.path.join(self.install_dir, 'agent_update.py')
+        return [sys.executable, script, "supervise", "--install-dir", self.install_dir,
+                "--timeout", str(timeout), "--"] + list(argv)
+
+    def confirm_healthy(self):
+        # เรียกจาก agent เวอร์ชันใหม่เมื่อ start ได้ครบ คืน version ที่เพิ่งยืนยัน (None ถ้าไม่มี update ค้าง)
+        journal = read_journal(self.install_dir)
+        if not journal or journal['state'] != 'swapped':
+            return None
+        journal['state'] = 'healthy'
+        write_journal(self.install_dir, journal)
+        shutil.rmtree(os.path.join(self.staging_dir, 'backup'), ignore_errors=True)
+        return journal['version']
+
+
+# ------------------- release tooling -------------------
+def build_release(version, release_dir, out_dir, previous_dirs=(), files=None):
+    # เขียน out_dir/manifest.json + out_dir/blobs/<id> (ไฟล์เต็มและ delta) ให้ server เสิร์ฟ
+    # files ไม่ระบุ = ทุกไฟล์ใน release_dir ที่ตรง RELEASE_PATTERNS
+    files = files or release_files(release_dir)
+    blob_dir = os.path.join(out_dir, 'blobs')
+    os.makedirs(blob_dir, exist_ok=True)
+    manifest = {"version": version, "files": {}}
+    for name in files:
+        path = os.path.join(release_dir, name)
+        with open(path, 'rb') as f:
+            new = f.read()
+        sha256 = hashlib.sha256(new).hexdigest()
+        with open(os.path.join(blob_dir, sha256), 'wb') as f:
+            f.write(new)
+        entry = {"sha256": sha256, "size": len(new), "blob": sha256, "deltas": {}}
+        for previous_dir in previous_dirs:
+            old_path = os.path.join(previous_dir, name)
+            if not os.path.exists(old_path):
+                continue
+            with open(old_path, 'rb') as f:
+                old = f.read()
+            old_sha256 = hashlib.sha256(old).hexdigest()
+            if old_sha256 == sha256 or old_sha256 in entry["deltas"]:
+                continue
+            delta = make_delta(old, new)
+            if len(delta) >= len(new):
+                continue  # delta ไม่คุ้ม ให้โหลดทั้งไฟล์
+            blob = f"{old_sha256}-{sha256}.delta"
+            with open(os.path.join(blob_dir, blob), 'wb') as f:
+                f.write(delta)
+            entry["deltas"][old_sha256] = {"blob": blob, "size": len(delta)}
+        manifest["files"][name] = entry
+    with open(os.path.join(out_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build an agent update release (manifest + full files + deltas)")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    build = sub.add_parser("build")
+    build.add_argument("--version", required=True)
+    build.add_argument("--release", required=True, help="directory with the new agent files")
+    build.add_argument("--previous", action="append", default=[], help="directory of an older release (repeatable)")
+    build.add_argument("--out", required=True)
+    watch = sub.add_parser("supervise", help="start the updated agent and roll back if it never confirms health")
+    watch.add_argument("--install-dir", required=True)
+    watch.add_argument("--timeout", type=float, default=HEALTH_TIMEOUT)
+    watch.add_argument("argv", nargs=argparse.REMAINDER, help="-- <python> agent.py ...")
+    args = parser.parse_args()
+    if args.cmd == "supervise":
+        argv = args.argv[1:] if args.argv[:1] == ["--"] else args.argv
+        sys.exit(0 if supervise(args.install_dir, argv, args.timeout) else 1)
+    manifest = build_release(args.version, args.release, args.out, args.previous)
+    for name, entry in manifest["files"].items():
+        deltas = ", ".join(f"{d['size']}B" for d in entry["deltas"].values()) or "-"
+        print(f"{name:<22} {entry['size']:>8}B  deltas: {deltas}")
+
+
+if __name__ == "__main__":
+    main()
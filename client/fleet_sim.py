@@ -0,0 +1,161 @@
+import argparse
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+
+from agent_client import AgentClient, AdaptivePollInterval, PushStreamError
+
+# จำลอง agent หลายร้อย/หลายพันเครื่องในโปรเซสเดียว ยิงใส่ standin_server.py
+# ใช้ AgentClient ตัวจริง (protocol เดียวกับ agent.py) ส่วน Windows (winreg/AnyDesk/sysprep) เป็น stub
+#   python fleet_sim.py --agents 500 --duration 60 --mode both
+
+SIM_COMMANDS = ["shutdown", "reboot", "reset"]
+
+
+class _NullWriter(io.TextIOBase):
+    def write(self, s):
+        return len(s)
+
+
+def start_server():
+    # รัน server แยกโปรเซส เพื่อวัด CPU ของ server ได้ตรงๆ
+    server_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'standin_server.py')
+    proc = subprocess.Popen([sys.executable, server_py, '--port', '0'], stdout=subprocess.PIPE, text=True)
+    line = proc.stdout.readline().strip()
+    url = line.rsplit(' ', 1)[-1]
+    return proc, url
+
+
+def raise_fd_limit():
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+class SimulatedAgent(threading.Thread):
+    def __init__(self, index, api_url, mode, poll_interval, stop_event, set_id=1, adaptive=False):
+        super().__init__(name=f"sim-agent-{index}", daemon=True)
+        self.machine_name = f"SIM-{index:05d}"
+        self.api_url = api_url
+        self.mode = mode
+        self.poll_interval = poll_interval
+        self.schedule = AdaptivePollInterval(base=poll_interval) if adaptive else None
+        self.stop_event = stop_event
+        self.set_id = set_id
+        self.ready = threading.Event()
+        self.client = None
+        self.machine_id = None
+
+    def setup(self):
+        resp = AgentClient(self.api_url).register(self.set_id, self.machine_name)
+        self.client = AgentClient(self.api_url, resp.json()['agent_api_key'], pool_size=2, gzip_min_size=1024)
+        self.machine_id = self.client.get_machine_id(self.machine_name)
+        self.client.report_remote(self.machine_id, f"9{self.machine_id:09d}", None)
+
+    def handle(self, cmd):
+        # stub ของ handler จริง: ไม่แตะ Windows แค่ตอบผลกลับ
+        self.client.report_command_result(self.machine_id, cmd['id'], "done", f"simulated {cmd['command']}")
+
+    def run(self):
+        try:
+            self.setup()
+        finally:
+            self.ready.set()
+        # เริ่มแบบสุ่มเฟส ไม่ให้ทุกเครื่อง poll ตรงจังหวะเดียวกัน
+        self.stop_event.wait(random.uniform(0, self.poll_interval))
+        while not self.stop_event.is_set():
+            try:
+                if self.mode == "push":
+                    try:
+                        self.client.stream_pending_commands(self.machine_id, self.handle)
+                    except PushStreamError:
+                        self.stop_event.wait(1)
+                    continue
+                cmds = self.client.poll_pending_commands(self.machine_id)
+                for cmd in cmds:
+                    self.handle(cmd)
+            except Exception:
+                cmds = []
+            if self.schedule:
+                self.stop_event.wait(self.schedule.next(got_commands=bool(cmds), hint=self.client.poll_hint))
+            else:
+                self.stop_event.wait(self.poll_interval)
+
+
+def run_mode(mode, args):
+    proc, url = start_server()
+    admin = AgentClient(url, pool_size=1)
+    stop_event = threading.Event()
+    try:
+        agents = [SimulatedAgent(i, url, mode, args.poll_interval, stop_event, adaptive=args.adaptive)
+                  for i in range(args.agents)]
+        for agent in agents:
+            agent.start()
+        for agent in agents:
+            agent.ready.wait()
+        machine_ids = [a.machine_id for a in agents if a.machine_id]
+        # warm-up ให้ทุกเครื่องเข้าสู่ loop ก่อนเริ่มนับ
+        time.sleep(min(args.poll_interval, 5))
+        admin.request('POST', '/admin/reset_stats', json_body={})
+        deadline = time.time() + args.duration
+        issue_until = deadline - (args.poll_interval if mode == "poll" else 1)
+        while time.time() < issue_until:
+            admin.request('POST', '/admin/command', json_body={
+                "machine_id": random.choice(machine_ids),
+                "command": random.choice(SIM_COMMANDS),
+            })
+            time.sleep(1.0 / args.command_rate)
+        time.sleep(max(0, deadline - time.time()))
+        stats = admin.request('GET', '/admin/stats').json()
+    finally:
+        stop_event.set()
+        proc.terminate()
+        proc.wait()
+    stats["mode"] = mode
+    stats["agents"] = args.agents
+    return stats
+
+
+def print_report(results):
+    out = sys.__stdout__
+    out.write(f"{'mode':<6} {'agents':>6} {'req/s':>8} {'bytes/s':>10} {'cmds':>6} "
+              f"{'p50 s':>7} {'p99 s':>7} {'cpu %':>6} {'304s':>6}\n")
+    for r in results:
+        bytes_per_s = (r["bytes_in"] + r["bytes_out"]) / r["elapsed"]
+        out.write(f"{r['mode']:<6} {r['agents']:>6} {r['requests_per_s']:>8} {bytes_per_s:>10.0f} "
+                  f"{r['commands_done']:>6} {str(r['latency_p50']):>7} {str(r['latency_p99']):>7} "
+                  f"{r['cpu_percent']:>6} {r['not_modified']:>6}\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fleet simulator / load test for the agent protocol")
+    parser.add_argument("--agents", type=int, default=200)
+    parser.add_argument("--duration", type=float, default=60, help="seconds measured per mode")
+    parser.add_argument("--mode", choices=["poll", "push", "both"], default="both")
+    parser.add_argument("--poll-interval", type=float, default=10)
+    parser.add_argument("--command-rate", type=float, default=5, help="commands issued per second")
+    parser.add_argument("--adaptive", action="store_true", help="poll with AdaptivePollInterval instead of a fixed interval")
+    parser.add_argument("--json", action="store_true", help="print raw stats as JSON")
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    threading.stack_size(512 * 1024)
+    sys.stdout = _NullWriter()  # ปิด print ของ AgentClient ไม่ให้ท่วมหน้าจอ
+    modes = ["poll", "push"] if args.mode == "both" else [args.mode]
+    results = [run_mode(mode, args) for mode in modes]
+    if args.json:
+        sys.__stdout__.write(json.dumps(results, indent=2) + "\n")
+    else:
+        print_report(results)
+
+
+if __name__ == "__main__":
+    main()
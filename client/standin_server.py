@@ -0,0 +1,449 @@
+import argparse
+import gzip
+import hashlib
+import itertools
+import json
+import os
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+# server จำลองสำหรับทดสอบ/วัดโหลด agent ในเครื่อง (ไม่ใช่ server จริง)
+# รองรับ endpoint เดียวกับที่ agent ใช้ + /admin/* สำหรับสั่งงานและดูสถิติ
+#   python standin_server.py --port 8000
+
+HEARTBEAT_INTERVAL = 15
+
+
+class FleetState:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = {}         # machine_id -> Event ปลุก stream ของเครื่องนั้นเมื่อมีคำสั่งใหม่
+        self.ids = itertools.count(1)
+        self.machines = {}       # machine_id -> {"name", "set_id", "key"}
+        self.by_name = {}        # machine_name -> machine_id
+        self.queues = {}         # machine_id -> [command]
+        self.versions = {}       # machine_id -> เลข version ของคิว (ใช้ทำ ETag), เพิ่มทุกครั้งที่มีคำสั่งใหม่
+        self.poll_hint = None    # ถ้าตั้งไว้ ส่ง X-Poll-Interval กลับไปกับทุก poll
+        self.not_modified = 0
+        self.update_dir = None   # โฟลเดอร์ release ของ self-update (--update-dir)
+        self.outputs = {}        # command_id -> {seq: (stream, bytes)} output ระหว่างรันคำสั่ง
+        self.uploads = {}        # command_id -> {"data", "total", "sha256", "complete"} ไฟล์จากคำสั่ง collect
+        self.output_final = set()
+        self.commands = {}       # command_id -> {"machine_id", "command", "created_at", "delivered_at", "done_at"}
+        self.remote = {}         # machine_id -> report_remote payload
+        self.startup = {}        # machine_id -> startup_report payload
+        self.telemetry = {}      # machine_id -> ค่า telemetry ล่าสุด (merge จาก delta)
+        self.telemetry_updates = 0
+        self.requests = 0
+        self.requests_by_path = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.latencies = []      # วินาทีจากสั่ง -> ได้ผลลัพธ์
+        self.started = time.time()
+        self.cpu_started = time.process_time()
+
+    def register(self, set_id, name):
+        with self.lock:
+            if name in self.by_name:
+                machine_id = self.by_name[name]
+            else:
+                machine_id = next(self.ids)
+                self.by_name[name] = machine_id
+                self.machines[machine_id] = {"name": name, "set_id": set_id, "key": f"key-{machine_id}"}
+                self.queues[machine_id] = []
+            return self.machines[machine_id]["key"]
+
+    def add_command(self, machine_id, command, args=None, execute_at=None, repeat=None):
+        with self.lock:
+            command_id = next(self.ids)
+            cmd = {"id": command_id, "command": command}
+            if args:
+                cmd["args"] = args
+            if execute_at:
+                cmd["execute_at"] = execute_at
+            if repeat:
+                cmd["repeat"] = repeat
+            self.commands[command_id] = {"machine_id": machine_id, "command": cmd, "created_at": time.time(),
+                                         "delivered_at": None, "done_at": None}
+            self.queues.setdefault(machine_id, []).append(cmd)
+            self.versions[machine_id] = self.versions.get(machine_id, 0) + 1
+            event = self.events.get(machine_id)
+        if event:
+            event.set()
+        return command_id
+
+    def take_pending(self, machine_id):
+        return self.take_pending_versioned(machine_id)[0]
+
+    def take_pending_versioned(self, machine_id, if_none_match=None):
+        # คืน (คำสั่ง, etag ของคิวหลังดึง) ถ้า etag ตรงกับ if_none_match และคิวว่าง คืน (None, etag) = 304
+        with self.lock:
+            etag = f'"{machine_id}-{self.versions.get(machine_id, 0)}"'
+            cmds = self.queues.get(machine_id) or []
+            if not cmds and if_none_match == etag:
+                self.not_modified += 1
+                return None, etag
+            self.queues[machine_id] = []
+            now = time.time()
+            for cmd in cmds:
+                self.commands[cmd["id"]]["delivered_at"] = now
+                cmd["server_time"] = now  # ให้ agent ชดเชยนาฬิกาเครื่องกับคำสั่งตั้งเวลา
+            return cmds, etag
+
+    def wait_pending(self, machine_id, timeout):
+        with self.lock:
+            event = self.events.setdefault(machine_id, threading.Event())
+            if self.queues.get(machine_id):
+                event.set()
+        event.wait(timeout)
+        event.clear()
+        return self.take_pending(machine_id)
+
+    def add_result(self, command_id, status, result):
+        with self.lock:
+            entry = self.commands.get(command_id)
+            if entry is None or entry["done_at"]:
+                return
+            if status == "scheduled":
+                entry["scheduled"] = result  # แค่รับทราบว่าตั้งเวลาแล้ว ยังไม่ใช่ผลสุดท้าย
+                return
+            entry["done_at"] = time.time()
+            entry["status"] = status
+            entry["result"] = result
+            self.latencies.append(entry["done_at"] - entry["created_at"])
+
+    def count_request(self, path, bytes_in, bytes_out):
+        with self.lock:
+            self.requests += 1
+            self.requests_by_path[path] = self.requests_by_path.get(path, 0) + 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+
+    def reset_stats(self):
+        with self.lock:
+            self.requests = 0
+            self.requests_by_path = {}
+            self.bytes_in = self.bytes_out = 0
+            self.not_modified = 0
+            self.latencies = []
+            self.started = time.time()
+            self.cpu_started = time.process_time()
+
+    def stats(self):
+        with self.lock:
+            elapsed = max(time.time() - self.started, 1e-6)
+            lat = sorted(self.latencies)
+            cpu = time.process_time() - self.cpu_started
+            pending = sum(1 for c in self.commands.values() if not c["done_at"])
+            return {
+                "elapsed": round(elapsed, 2),
+                "machines": len(self.machines),
+                "requests": self.requests,
+                "requests_per_s": round(self.requests / elapsed, 1),
+                "requests_by_path": dict(self.requests_by_path),
+                "not_modified": self.not_modified,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+                "commands_done": len(lat),
+                "commands_pending": pending,
+                "latency_p50": round(percentile(lat, 50), 3) if lat else None,
+                "latency_p99": round(percentile(lat, 99), 3) if lat else None,
+                "cpu_seconds": round(cpu, 2),
+                "cpu_percent": round(100 * cpu / elapsed, 1),
+                "telemetry_machines": len(self.telemetry),
+                "telemetry_updates": self.telemetry_updates,
+            }
+
+
+def percentile(sorted_values, pct):
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state = None  # FleetState ที่ผูกตอนสร้าง server
+
+    def log_message(self, format, *args):
+        pass
+
+    # ------------------- helpers -------------------
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        self._bytes_in = len(body)
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        return json.loads(body) if body else None
+
+    def _send_json(self, payload, status=200, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.state.count_request(self._path, getattr(self, "_bytes_in", 0), len(body))
+
+    def _send_not_modified(self, headers):
+        self.send_response(304)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.state.count_request(self._path, getattr(self, "_bytes_in", 0), 0)
+
+    def _machine_id(self):
+        machine_id = int(self._query["machine_id"][0])
+        machine = self.state.machines.get(machine_id)
+        if machine is None or machine["key"] != self.headers.get("X-AGENT-KEY"):
+            return None
+        telemetry = self.headers.get("X-Agent-Telemetry")
+        if telemetry:
+            with self.state.lock:
+                self.state.telemetry.setdefault(machine_id, {}).update(json.loads(telemetry))
+                self.state.telemetry_updates += 1
+        return machine_id
+
+    def _route(self):
+        url = urlparse(self.path)
+        self._path = url.path
+        self._query = parse_qs(url.query)
+        self._bytes_in = 0
+
+    # ------------------- routes -------------------
+    def do_GET(self):
+        self._route()
+        if self._path == "/machine/config":
+            machine_id = self.state.by_name.get(self._query["name"][0])
+            if machine_id is None:
+                return self._send_json({"detail": "machine not found"}, 404)
+            return self._send_json({"machine_id": machine_id})
+        if self._path == "/machine/command/pending":
+            machine_id = self._machine_id()
+            if machine_id is None:
+                return self._send_json({"detail": "unauthorized"}, 401)
+            cmds, etag = self.state.take_pending_versioned(machine_id, self.headers.get("If-None-Match"))
+            headers = {"ETag": etag}
+            if self.state.poll_hint:
+                headers["X-Poll-Interval"] = str(self.state.poll_hint)
+            if cmds is None:
+                return self._send_not_modified(headers)
+            return self._send_json(cmds, headers=headers)
+        if self._path == "/machine/command/stream":
+            machine_id = self._machine_id()
+            if machine_id is None:
+                return self._send_json({"detail": "unauthorized"}, 401)
+            return self._stream(machine_id)
+        if self._path == "/admin/stats":
+            return self._send_json(self.state.stats())
+        if self._path == "/machine/command/upload":
+            if self._machine_id() is None:
+                return self._send_json({"detail": "unauthorized"}, 401)
+            with self.state.lock:
+                upload = self.state.uploads.get(int(self._query["command_id"][0]))
+            return self._send_json({"offset": len(upload["data"]) if upload else 0})
+        if self._path == "/admin/upload":
+            with self.state.lock:
+                upload = self.state.uploads.get(int(self._query["command_id"][0]))
+            if not upload or not upload["complete"]:
+                return self._send_json({"detail": "not complete"}, 404)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(upload["data"])))
+            self.end_headers()
+            self.wfile.write(bytes(upload["data"]))
+            return self.state.count_request(self._path, 0, len(upload["data"]))
+        if self._path == "/admin/output":
+            # output ที่ได้รับของคำสั่งหนึ่ง เรียงตาม seq
+            command_id = int(self._query["command_id"][0])
+            with self.state.lock:
+                chunks = sorted(self.state.outputs.get(command_id, {}).items())
+                final = command_id in self.state.output_final
+            return self._send_json({
+                "final": final,
+                "chunks": len(chunks),
+                "stdout": b"".join(d for _, (s, d) in chunks if s == "stdout").decode("utf-8", "replace"),
+                "stderr": b"".join(d for _, (s, d) in chunks if s == "stderr").decode("utf-8", "replace"),
+            })
+        if self._path.startswith("/agent/update/") and self.state.update_dir:
+            return self._serve_update()
+        return self._send_json({"detail": "not found"}, 404)
+
+    def _receive_output(self):
+        # body = gzip ของ output ดิบ 1 ชิ้น, seq ซ้ำ (agent retry) เขียนทับของเดิม
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        self._bytes_in = len(body)
+        machine_id = self._machine_id()
+        if machine_id is None:
+            return self._send_json({"detail": "unauthorized"}, 401)
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        command_id = int(self._query["command_id"][0])
+        seq = int(self._query["seq"][0])
+        with self.state.lock:
+            self.state.outputs.setdefault(command_id, {})[seq] = (self._query["stream"][0], body)
+            if self._query.get("final", ["0"])[0] == "1":
+                self.state.output_final.add(command_id)
+        return self._send_json({"ok": True})
+
+    def _receive_upload(self):
+        # รับไฟล์ทีละชิ้น ต้องต่อท้ายพอดี (offset = ขนาดที่มีอยู่) ไม่งั้นตอบ 409 พร้อม offset ที่ถูก
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        self._bytes_in = len(body)
+        if self._machine_id() is None:
+            return self._send_json({"detail": "unauthorized"}, 401)
+        command_id = int(self._query["command_id"][0])
+        offset = int(self._query["offset"][0])
+        with self.state.lock:
+            upload = self.state.uploads.setdefault(command_id, {
+                "data": bytearray(), "total": int(self._query["total"][0]),
+                "sha256": self._query["sha256"][0], "complete": False})
+            if offset != len(upload["data"]):
+                status = 409
+            else:
+                status = 200
+                upload["data"] += body
+                if len(upload["data"]) >= upload["total"]:
+                    upload["complete"] = hashlib.sha256(upload["data"]).hexdigest() == upload["sha256"]
+                    if not upload["complete"]:
+                        upload["data"] = bytearray()  # เสีย เริ่มใหม่
+            current = len(upload["data"])
+        return self._send_json({"offset": current}, status)
+
+    def _serve_update(self):
+        # release ที่สร้างด้วย agent_update.py build: manifest.json + blobs/<id>
+        if self._path == "/agent/update/manifest":
+            path = os.path.join(self.state.update_dir, "manifest.json")
+        elif self._path.startswith("/agent/update/blob/"):
+            path = os.path.join(self.state.update_dir, "blobs", os.path.basename(self._path))
+        else:
+            path = None
+        if not path or not os.path.isfile(path):
+            return self._send_json({"detail": "not found"}, 404)
+        with open(path, "rb") as f:
+            body = f.read()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json" if path.endswith(".json") else "application/octet-stream")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.state.count_request(self._path, 0, len(body))
+
+    def do_POST(self):
+        self._route()
+        if self._path == "/machine/command/output":
+            return self._receive_output()
+        if self._path == "/machine/command/upload":
+            return self._receive_upload()
+        payload = self._read_json()
+        if self._path == "/machine/register":
+            key = self.state.register(payload["set_id"], payload["machine_name"])
+            return self._send_json({"agent_api_key": key})
+        if self._path.startswith("/machine/"):
+            machine_id = self._machine_id()
+            if machine_id is None:
+                return self._send_json({"detail": "unauthorized"}, 401)
+            if self._path == "/machine/command/result":
+                self.state.add_result(payload["command_id"], payload["status"], payload.get("result"))
+                return self._send_json({"ok": True})
+            if self._path == "/machine/command/result/batch":
+                for item in payload["results"]:
+                    self.state.add_result(item["command_id"], item["status"], item.get("result"))
+                return self._send_json({"ok": True})
+            if self._path == "/machine/report_remote":
+                with self.state.lock:
+                    self.state.remote[machine_id] = payload
+                return self._send_json({"ok": True})
+            if self._path == "/machine/startup_report":
+                with self.state.lock:
+                    self.state.startup[machine_id] = payload
+                return self._send_json({"ok": True})
+            if self._path == "/machine/gateway/pending":
+                commands = {}
+                for machine in payload["machines"]:
+                    if self.state.machines.get(machine["machine_id"], {}).get("key") == machine["agent_key"]:
+                        commands[str(machine["machine_id"])] = self.state.take_pending(machine["machine_id"])
+                        if machine.get("telemetry"):
+                            with self.state.lock:
+                                self.state.telemetry.setdefault(machine["machine_id"], {}).update(machine["telemetry"])
+                                self.state.telemetry_updates += 1
+                return self._send_json({"commands": commands})
+            if self._path == "/machine/gateway/report":
+                for item in payload["results"]:
+                    self.state.add_result(item["command_id"], item["status"], item.get("result"))
+                with self.state.lock:
+                    for remote in payload["remotes"]:
+                        self.state.remote[remote["machine_id"]] = remote
+                return self._send_json({"ok": True})
+        if self._path == "/admin/command":
+            command_id = self.state.add_command(payload["machine_id"], payload["command"], payload.get("args"),
+                                                payload.get("execute_at"), payload.get("repeat"))
+            return self._send_json({"command_id": command_id})
+        if self._path == "/admin/reset_stats":
+            self.state.reset_stats()
+            return self._send_json({"ok": True})
+        return self._send_json({"detail": "not found"}, 404)
+
+    def _stream(self, machine_id):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        self.state.count_request(self._path, 0, 0)
+
+        def send(data):
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.flush()
+            with self.state.lock:
+                self.state.bytes_out += len(data)
+
+        try:
+            send(b": connected\n\n")
+            while True:
+                cmds = self.state.wait_pending(machine_id, HEARTBEAT_INTERVAL)
+                if cmds:
+                    send(b"data: " + json.dumps(cmds).encode("utf-8") + b"\n\n")
+                else:
+                    send(b": ping\n\n")
+        except (BrokenPipeError, ConnectionResetError, OSError):
+            pass
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def make_server(host="127.0.0.1", port=0, state=None):
+    state = state or FleetState()
+    handler = type("BoundStandInHandler", (StandInHandler,), {"state": state})
+    server = StandInServer((host, port), handler)
+    server.state = state
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the FinoDDC control server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--poll-hint", type=float, default=None, help="send X-Poll-Interval with every poll")
+    parser.add_argument("--update-dir", default=None, help="serve an agent_update.py release from this directory")
+    args = parser.parse_args()
+    server = make_server(args.host, args.port)
+    server.state.poll_hint = args.poll_hint
+    server.state.update_dir = args.update_dir
+    print(f"Stand-in server listening on http://{args.host}:{server.server_address[1]}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()